@@ -0,0 +1,262 @@
+""" backends.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Provides selectable CPU inference backends for the models in the SafeTuber pipeline.
+    The toxicity classifier can run as:
+        pytorch: fp32 PyTorch in eager mode (the reference)
+        int8:    PyTorch with dynamically int8-quantized linear layers
+        onnx:    an exported ONNX Runtime graph (requires the optimum[onnxruntime] package)
+
+    All backends are wrapped in a HuggingFace text-classification pipeline, so they can be used wherever the classifier is used.
+
+    Likewise, the Whisper transcriber can run as:
+        pytorch: fp32 PyTorch (the reference)
+        int8:    PyTorch with dynamically int8-quantized linear layers
+        onnx:    exported ONNX Runtime encoder/decoder graphs (requires the optimum[onnxruntime] package)
+    with explicit intra-op and inter-op thread counts for every backend.
+
+    Use evaluate_backends.py to check how many labels a backend changes and how fast it is.
+
+    The pytorch and int8 backends load local safetensors snapshots written by prepare_models.py when they exist,
+    falling back to the HuggingFace hub otherwise.
+"""
+
+from pathlib import Path
+from transformers import pipeline, AutoTokenizer
+import importlib.util
+import torch
+
+
+def backend_model_name(model, backend):
+    """
+    Names a model together with its backend, e.g. for cache keys, as backends may give slightly different labels.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+        backend (str): Name of the backend
+
+    Returns:
+        name (str): Name of the model and backend
+    """
+
+    # keep the plain model name for the reference backend, so existing cache entries stay valid
+    if backend == "pytorch":
+        return model
+
+    return f"{model}:{backend}"
+
+
+def define_onnx_path(model):
+    """
+    Defines the path to the exported ONNX graph of a model.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+
+    Returns:
+        onnx_path (pathlib.PosixPath): Path to the exported model
+    """
+
+    # define path
+    path = Path(__file__)
+
+    return path.parents[1] / "cache" / "onnx" / model.replace("/", "--")
+
+
+def define_snapshot_path(model):
+    """
+    Defines the path to the local snapshot of a model written by prepare_models.py.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+
+    Returns:
+        snapshot_path (pathlib.PosixPath): Path to the snapshot
+    """
+
+    # define path
+    path = Path(__file__)
+
+    return path.parents[1] / "models" / model.replace("/", "--")
+
+
+def model_source(model):
+    """
+    Finds where to load a model from and how, preferring the local snapshot over the HuggingFace hub.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+
+    Returns:
+        source (str): Path to the local snapshot if it exists, else the name of the model on the hub
+        model_kwargs (dict): Keyword arguments for from_pretrained
+    """
+
+    snapshot_path = define_snapshot_path(model)
+    source = str(snapshot_path) if (snapshot_path / "config.json").exists() else model
+
+    # load weights straight into the model instead of initializing it randomly first (requires accelerate)
+    model_kwargs = {"low_cpu_mem_usage": True} if importlib.util.find_spec("accelerate") is not None else {}
+
+    return source, model_kwargs
+
+
+def build_classifier(model="martin-ha/toxic-comment-model", backend="pytorch"):
+    """
+    Initializes a HuggingFace text-classification pipeline running on the given backend.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+        backend (str): Name of the backend, one of "pytorch", "int8" or "onnx"
+
+    Returns:
+        classifier (pipeline): HuggingFace pipeline for text classification
+    """
+
+    # fp32 PyTorch in eager mode
+    if backend == "pytorch":
+        source, model_kwargs = model_source(model)
+        return pipeline("text-classification", model = source, model_kwargs = model_kwargs)
+
+    # PyTorch with int8 dynamically quantized linear layers
+    if backend == "int8":
+        source, model_kwargs = model_source(model)
+        classifier = pipeline("text-classification", model = source, model_kwargs = model_kwargs)
+        classifier.model = torch.quantization.quantize_dynamic(classifier.model, {torch.nn.Linear}, dtype=torch.qint8)
+        return classifier
+
+    # exported ONNX Runtime graph
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+        except ImportError:
+            raise ImportError("The onnx backend requires optimum with onnxruntime: pip install optimum[onnxruntime]")
+
+        onnx_path = define_onnx_path(model)
+
+        # export the model once and reuse the export afterwards
+        if not (onnx_path / "model.onnx").exists():
+            ort_model = ORTModelForSequenceClassification.from_pretrained(model, export=True)
+            tokenizer = AutoTokenizer.from_pretrained(model)
+            ort_model.save_pretrained(onnx_path)
+            tokenizer.save_pretrained(onnx_path)
+
+        return pipeline("text-classification",
+                        model = ORTModelForSequenceClassification.from_pretrained(onnx_path),
+                        tokenizer = AutoTokenizer.from_pretrained(onnx_path))
+
+    raise ValueError(f"Unknown classifier backend: {backend}")
+
+
+def set_threads(intra_threads=None, inter_threads=None):
+    """
+    Sets the number of intra-op and inter-op threads used by PyTorch.
+    The number of inter-op threads can only be set once per process, before any parallel work has started.
+
+    Args:
+        intra_threads (int): Number of threads used within an op, None to keep the default
+        inter_threads (int): Number of threads used to run independent ops in parallel, None to keep the default
+    """
+
+    if intra_threads is not None:
+        torch.set_num_threads(intra_threads)
+
+    if inter_threads is not None and torch.get_num_interop_threads() != inter_threads:
+        try:
+            torch.set_num_interop_threads(inter_threads)
+        except RuntimeError:
+            print(f"Could not set inter-op threads to {inter_threads}, keeping {torch.get_num_interop_threads()}")
+
+
+def ort_session_options(intra_threads=None, inter_threads=None):
+    """
+    Creates ONNX Runtime session options with the given thread counts.
+
+    Args:
+        intra_threads (int): Number of threads used within an op, None to keep the default
+        inter_threads (int): Number of threads used to run independent ops in parallel, None to keep the default
+
+    Returns:
+        session_options (onnxruntime.SessionOptions): Session options
+    """
+
+    from onnxruntime import SessionOptions
+
+    session_options = SessionOptions()
+
+    if intra_threads is not None:
+        session_options.intra_op_num_threads = intra_threads
+
+    if inter_threads is not None:
+        session_options.inter_op_num_threads = inter_threads
+
+    return session_options
+
+
+def build_transcriber(model="openai/whisper-base.en", backend="pytorch", intra_threads=None, inter_threads=None):
+    """
+    Initializes a HuggingFace automatic-speech-recognition pipeline running on the given backend.
+    The pipeline chunks audio in 30 second windows and returns timestamps, like the pipeline used throughout SafeTuber.
+
+    Args:
+        model (str): Name of the Whisper model on the HuggingFace hub
+        backend (str): Name of the backend, one of "pytorch", "int8" or "onnx"
+        intra_threads (int): Number of threads used within an op, None to keep the default
+        inter_threads (int): Number of threads used to run independent ops in parallel, None to keep the default
+
+    Returns:
+        transcriber (pipeline): HuggingFace pipeline for transcription
+    """
+
+    # set thread counts before the model does any work
+    set_threads(intra_threads, inter_threads)
+
+    # fp32 PyTorch
+    if backend == "pytorch":
+        source, model_kwargs = model_source(model)
+        return pipeline('automatic-speech-recognition',
+                        model = source,
+                        model_kwargs = model_kwargs,
+                        chunk_length_s = 30, # must be 30 to chunk correctly
+                        return_timestamps = True)
+
+    # PyTorch with int8 dynamically quantized linear layers
+    if backend == "int8":
+        source, model_kwargs = model_source(model)
+        transcriber = pipeline('automatic-speech-recognition',
+                               model = source,
+                               model_kwargs = model_kwargs,
+                               chunk_length_s = 30, # must be 30 to chunk correctly
+                               return_timestamps = True)
+        transcriber.model = torch.quantization.quantize_dynamic(transcriber.model, {torch.nn.Linear}, dtype=torch.qint8)
+        return transcriber
+
+    # exported ONNX Runtime encoder/decoder graphs
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+            from transformers import AutoProcessor
+        except ImportError:
+            raise ImportError("The onnx backend requires optimum with onnxruntime: pip install optimum[onnxruntime]")
+
+        onnx_path = define_onnx_path(model)
+
+        # export the model once and reuse the export afterwards
+        if not (onnx_path / "encoder_model.onnx").exists():
+            ort_model = ORTModelForSpeechSeq2Seq.from_pretrained(model, export=True)
+            processor = AutoProcessor.from_pretrained(model)
+            ort_model.save_pretrained(onnx_path)
+            processor.save_pretrained(onnx_path)
+
+        processor = AutoProcessor.from_pretrained(onnx_path)
+
+        return pipeline('automatic-speech-recognition',
+                        model = ORTModelForSpeechSeq2Seq.from_pretrained(onnx_path, session_options = ort_session_options(intra_threads, inter_threads)),
+                        tokenizer = processor.tokenizer,
+                        feature_extractor = processor.feature_extractor,
+                        chunk_length_s = 30, # must be 30 to chunk correctly
+                        return_timestamps = True)
+
+    raise ValueError(f"Unknown transcriber backend: {backend}")
@@ -0,0 +1,545 @@
+""" benchmark.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Offline, stage-by-stage benchmark suite for the SafeTuber pipeline. Nothing is fetched from YouTube or the HuggingFace hub:
+        - A fake YoutubeDL stands in for yt_dlp in get_channel_vids, download_wav, download_channel and probe_candidates.
+          It serves a synthetic catalog of channels and videos (including Shorts, too long videos and age restricted videos),
+          and can add latency and transient failures (network blips) to every call.
+        - WAV fixtures of controlled length are generated for the downloads and the transcriber.
+        - Tiny, randomly initialised Whisper and DistilBERT models are built from configs, with tokenizers written to a temporary folder.
+        - Synthetic chunk streams are generated for utils.clean_text and classifier.toxicity_aggregates.
+
+    Every benchmark records its throughput and peak memory (Python allocations traced by tracemalloc) to a JSON results file.
+    With --compare, results are checked against a saved baseline and regressions beyond --tolerance are flagged (exit code 1).
+
+Usage:
+    $ python src/benchmark.py --output out/benchmarks/baseline.json
+    $ python src/benchmark.py --compare out/benchmarks/baseline.json --tolerance 0.2
+"""
+
+from pathlib import Path
+from yt_dlp.utils import DownloadError
+import numpy as np
+import argparse
+import json
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+import wave
+import transcriber
+import classifier
+import utils
+
+
+def arg_parse():
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - Where to save the results
+    - A baseline to compare the results with and the tolerated regression
+    - Which benchmarks to run
+    - The size of the synthetic workloads
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Run offline benchmarks of every SafeTuber stage')
+
+    # add arguments
+    parser.add_argument('-o', '--output', default=str(Path(__file__).parents[1] / "out" / "benchmarks" / "results.json"), help='Path to save the results to')
+    parser.add_argument('-c', '--compare', default=None, help='Path to baseline results to compare with')
+    parser.add_argument('-t', '--tolerance', default=0.2, type=float, help='Tolerated relative loss in throughput (or gain in peak memory) before flagging a regression')
+    parser.add_argument('-b', '--benchmarks', nargs='+', default=None, help='Names of benchmarks to run (default: all)')
+    parser.add_argument('-r', '--repeats', default=3, type=int, help='Number of timed repeats, the fastest is kept')
+    parser.add_argument('--n_channels', default=5, type=int, help='Number of synthetic channels')
+    parser.add_argument('--n_chunks', default=20000, type=int, help='Number of synthetic chunks')
+    parser.add_argument('--audio_seconds', default=60, type=int, help='Length of the WAV fixtures in seconds')
+    parser.add_argument('--latency', default=0.05, type=float, help='Seconds every call of the fake YoutubeDL takes when benchmarking probing')
+    parser.add_argument('--failure_rate', default=0.1, type=float, help='Share of probes that fail with a transient error when benchmarking probing')
+    parser.add_argument('--probe_workers', default=4, type=int, help='Number of candidate videos probed at once when benchmarking probing')
+
+    # parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+class FakeYoutubeDL:
+    """
+    Offline stand-in for yt_dlp.YoutubeDL, serving a synthetic catalog.
+    Set the catalog, fixture, latency and failure rate on the class before patching it into the transcriber module.
+    """
+
+    # dict with "channels" (channel url to list of video ids) and "videos" (video id to dict with title, duration and optional error)
+    catalog = {"channels": {}, "videos": {}}
+
+    # WAV file copied for every download
+    fixture = None
+
+    # seconds every network call takes
+    latency = 0.0
+
+    # share of video probes that fail with a transient error, and the random generator deciding which
+    failure_rate = 0.0
+    rng = random.Random(1)
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def extract_info(self, url, download=False):
+        time.sleep(self.latency)
+
+        # channel listing
+        channel_url = url[:-len("/videos")] if url.endswith("/videos") else url
+        if channel_url in self.catalog["channels"]:
+            video_ids = self.catalog["channels"][channel_url][:self.params.get("playlistend")]
+            return {"_type": "playlist", "id": channel_url,
+                    "entries": [{"_type": "url", "ie_key": "Youtube", "id": video_id, "title": self.catalog["videos"][video_id]["title"],
+                                 "duration": self.catalog["videos"][video_id]["duration"]} for video_id in video_ids]}
+
+        # single video
+        video = self.catalog["videos"][transcriber.video_id_from_url(url)]
+        if video.get("error"):
+            raise DownloadError(video["error"])
+        if self.rng.random() < self.failure_rate:
+            raise DownloadError("Unable to download webpage: <urlopen error [Errno 104] Connection reset by peer>")
+
+        info_dict = {"id": transcriber.video_id_from_url(url), "title": video["title"], "duration": video["duration"],
+                     "ext": "wav", "url": str(self.fixture)}
+
+        if download:
+            self.process_ie_result(info_dict, download=True)
+
+        return info_dict
+
+    def process_ie_result(self, info_dict, download=True):
+        time.sleep(self.latency)
+
+        # copy the fixture to where yt_dlp would have put the .wav file
+        out_file = self.params["outtmpl"].replace("%(title)s", info_dict["title"]).replace("%(ext)s", "wav")
+        shutil.copyfile(self.fixture, out_file)
+
+        return info_dict
+
+
+def write_wav_fixture(file_path, seconds, sampling_rate=16000, seed=1):
+    """
+    Writes a 16-bit mono WAV file with speech-like bursts of noise separated by short pauses.
+
+    Args:
+        file_path (pathlib.PosixPath): Path to the WAV file
+        seconds (float): Length of the audio in seconds
+        sampling_rate (int): Sampling rate of the audio
+
+    Returns:
+        audio (np.ndarray): Array of float32 samples that were written
+    """
+
+    rng = np.random.default_rng(seed)
+    n_samples = int(seconds * sampling_rate)
+
+    # noise, amplitude-modulated at syllable rate, with a pause every few seconds
+    t = np.arange(n_samples) / sampling_rate
+    envelope = (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)) * ((t % 5) < 4)
+    audio = (0.3 * envelope * rng.standard_normal(n_samples)).astype(np.float32)
+
+    with wave.open(str(file_path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sampling_rate)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+
+    return audio
+
+
+def make_catalog(n_channels, n_videos=30, seed=1):
+    """
+    Creates a synthetic catalog of channels and videos.
+    Every channel mixes usable videos with Shorts, too long videos and videos that fail (e.g. age restrictions), like real channels.
+
+    Args:
+        n_channels (int): Number of channels
+        n_videos (int): Number of videos per channel
+        seed (int): Seed of the random generator
+
+    Returns:
+        catalog (dict): Dict with "channels" (channel url to list of video ids) and "videos" (video id to dict with title, duration and optional error)
+    """
+
+    rng = random.Random(seed)
+    catalog = {"channels": {}, "videos": {}}
+
+    for i in range(n_channels):
+        channel_url = f"https://www.youtube.com/channel/FAKE{i:04d}"
+        catalog["channels"][channel_url] = []
+
+        for j in range(n_videos):
+            video_id = f"fake{i:04d}{j:03d}"
+            kind = rng.random()
+
+            if kind < 0.3:
+                video = {"title": video_id, "duration": rng.randint(10, 60)} # Shorts
+            elif kind < 0.4:
+                video = {"title": video_id, "duration": rng.randint(1500, 5000)} # too long
+            elif kind < 0.5:
+                video = {"title": video_id, "duration": None, "error": "Sign in to confirm your age"} # age restricted
+            else:
+                video = {"title": video_id, "duration": rng.randint(180, 1100)}
+
+            catalog["videos"][video_id] = video
+            catalog["channels"][channel_url].append(video_id)
+
+    return catalog
+
+
+def make_chunk_stream(n_chunks, seed=1):
+    """
+    Creates a synthetic stream of Whisper chunks: mostly short segments, some long repeated-phrase hallucinations and some exact repeats.
+
+    Args:
+        n_chunks (int): Number of chunks
+        seed (int): Seed of the random generator
+
+    Returns:
+        text_chunks (list): List of text chunks
+    """
+
+    rng = random.Random(seed)
+    words = ["so", "today", "we", "are", "going", "to", "try", "the", "new", "game", "and", "it", "is", "crazy", "what", "oh", "no", "guys"]
+
+    text_chunks = []
+    for _ in range(n_chunks):
+        kind = rng.random()
+
+        if kind < 0.05 and text_chunks:
+            text_chunks.append(text_chunks[-1]) # repeated chunk
+        elif kind < 0.08:
+            text_chunks.append(" ".join(["oh no"] * rng.randint(50, 150))) # hallucination
+        else:
+            text_chunks.append(" " + " ".join(rng.choice(words) for _ in range(rng.randint(1, 12))) + rng.choice(["", ".", "?", ","]))
+
+    return text_chunks
+
+
+def build_tiny_classifier(model_path):
+    """
+    Builds a tiny, randomly initialised DistilBERT text-classification pipeline without downloading anything.
+
+    Args:
+        model_path (pathlib.PosixPath): Folder to write the tokenizer vocabulary to
+
+    Returns:
+        classifier (pipeline): HuggingFace pipeline for text classification
+    """
+
+    from transformers import DistilBertConfig, DistilBertForSequenceClassification, DistilBertTokenizerFast, pipeline
+
+    # write a small wordpiece vocabulary
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + list("abcdefghijklmnopqrstuvwxyz0123456789.,?!'") + [f"##{c}" for c in "abcdefghijklmnopqrstuvwxyz"]
+    (model_path / "vocab.txt").write_text("\n".join(vocab))
+    tokenizer = DistilBertTokenizerFast(vocab_file=str(model_path / "vocab.txt"), model_max_length=512)
+
+    # build a tiny model with the labels of the real classifier
+    config = DistilBertConfig(vocab_size=len(vocab), dim=32, n_layers=1, n_heads=2, hidden_dim=64, max_position_embeddings=512,
+                              id2label={0: "non-toxic", 1: "toxic"}, label2id={"non-toxic": 0, "toxic": 1})
+    model = DistilBertForSequenceClassification(config).eval()
+
+    return pipeline("text-classification", model=model, tokenizer=tokenizer)
+
+
+def build_tiny_transcriber(model_path):
+    """
+    Builds a tiny, randomly initialised Whisper automatic-speech-recognition pipeline without downloading anything.
+    Its transcripts are gibberish, but it runs the same chunking, feature extraction, generation and timestamp decoding as the real model.
+
+    Args:
+        model_path (pathlib.PosixPath): Folder to write the tokenizer files to
+
+    Returns:
+        transcriber (pipeline): HuggingFace pipeline for transcription
+    """
+
+    from transformers import WhisperConfig, WhisperForConditionalGeneration, WhisperTokenizer, WhisperFeatureExtractor, pipeline
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+    # write a byte-level vocabulary without merges, followed by the special and timestamp tokens Whisper needs
+    vocab = {char: i for i, char in enumerate(bytes_to_unicode().values())}
+    special_tokens = ["<|endoftext|>", "<|startoftranscript|>", "<|en|>", "<|translate|>", "<|transcribe|>", "<|startoflm|>",
+                      "<|startofprev|>", "<|nocaptions|>", "<|notimestamps|>"] + [f"<|{i * 0.02:.2f}|>" for i in range(1501)]
+    for token in special_tokens:
+        vocab[token] = len(vocab)
+    (model_path / "vocab.json").write_text(json.dumps(vocab))
+    (model_path / "merges.txt").write_text("#version: 0.2\n")
+    tokenizer = WhisperTokenizer(str(model_path / "vocab.json"), str(model_path / "merges.txt"), additional_special_tokens=special_tokens[1:],
+                                 pad_token="<|endoftext|>")
+
+    # build a tiny model that starts decoding like whisper-*.en
+    config = WhisperConfig(vocab_size=len(vocab), d_model=32, encoder_layers=1, decoder_layers=1, encoder_attention_heads=2,
+                           decoder_attention_heads=2, encoder_ffn_dim=64, decoder_ffn_dim=64, num_mel_bins=80,
+                           max_source_positions=1500, max_target_positions=448,
+                           pad_token_id=vocab["<|endoftext|>"], bos_token_id=vocab["<|endoftext|>"], eos_token_id=vocab["<|endoftext|>"],
+                           decoder_start_token_id=vocab["<|startoftranscript|>"])
+    model = WhisperForConditionalGeneration(config).eval()
+    model.generation_config.decoder_start_token_id = vocab["<|startoftranscript|>"]
+    model.generation_config.no_timestamps_token_id = vocab["<|notimestamps|>"]
+    # same generation settings as whisper-*.en, which the timestamp decoding of transformers 4.28 relies on
+    model.generation_config.forced_decoder_ids = [[1, vocab["<|notimestamps|>"]]]
+    model.generation_config.max_initial_timestamp_index = 1
+    model.generation_config.begin_suppress_tokens = None
+    model.generation_config.suppress_tokens = None
+    model.generation_config.max_length = 448
+
+    return pipeline("automatic-speech-recognition", model=model, tokenizer=tokenizer, feature_extractor=WhisperFeatureExtractor(),
+                    chunk_length_s=30, return_timestamps=True)
+
+
+def use_fake_downloader(work_path, n_channels=5, audio_seconds=60):
+    """
+    Patches the transcriber module to download from a synthetic catalog with FakeYoutubeDL, and to keep its caches in work_path,
+    so nothing touches the network or the real caches.
+
+    Args:
+        work_path (pathlib.PosixPath): Temporary folder for the audio fixture and caches
+        n_channels (int): Number of synthetic channels
+        audio_seconds (float): Length of the audio fixture in seconds
+
+    Returns:
+        catalog (dict): Synthetic catalog from make_catalog
+        audio (np.ndarray): Array of float32 samples of the audio fixture
+    """
+
+    # synthetic catalog and audio fixture
+    catalog = make_catalog(n_channels)
+    fixture = work_path / "fixture.wav"
+    audio = write_wav_fixture(fixture, audio_seconds)
+    FakeYoutubeDL.catalog = catalog
+    FakeYoutubeDL.fixture = fixture
+
+    # keep caches in work_path
+    def define_cache_path(name):
+        cache_path = work_path / "cache" / name
+        cache_path.mkdir(parents=True, exist_ok=True)
+        return cache_path
+
+    transcriber.YoutubeDL = FakeYoutubeDL
+    transcriber.define_cache_path = define_cache_path
+
+    return catalog, audio
+
+
+def run_benchmark(run, n_items, unit, repeats):
+    """
+    Times a benchmark and measures its peak memory.
+    Timing and memory are measured in separate runs, as tracing allocations slows the code down.
+
+    Args:
+        run (function): Function that runs the benchmark once
+        n_items (float): Number of items processed per run
+        unit (str): Unit of the items, e.g. "chunks"
+        repeats (int): Number of timed repeats, the fastest is kept
+
+    Returns:
+        result (dict): Dict with throughput (items/sec), seconds, peak memory and max resident memory
+    """
+
+    # time the benchmark
+    seconds = float("inf")
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start_time)
+
+    # measure peak memory of python allocations
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"throughput": round(n_items / seconds, 2) if seconds > 0 else 0.0,
+            "unit": f"{unit}/sec",
+            "seconds": round(seconds, 4),
+            "peak_mb": round(peak / 1024**2, 2),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def define_benchmarks(args, work_path):
+    """
+    Defines all benchmarks on the synthetic workloads.
+
+    Args:
+        args (argparse.Namespace): Parsed arguments
+        work_path (pathlib.PosixPath): Temporary folder for fixtures, downloads and tokenizer files
+
+    Returns:
+        benchmarks (dict): Dict from benchmark name to a function that sets it up and returns (run, n_items, unit)
+    """
+
+    # synthetic catalog and audio fixture for the fake YoutubeDL
+    catalog, audio = use_fake_downloader(work_path, args.n_channels, args.audio_seconds)
+
+    channel_urls = list(catalog["channels"])
+    video_urls = ["https://www.youtube.com/watch?v=" + video_id for video_id in catalog["channels"][channel_urls[0]]]
+    download_path = work_path / "downloads"
+    download_path.mkdir()
+
+    # synthetic chunk stream, split in transcripts of 100 chunks
+    text_chunks = make_chunk_stream(args.n_chunks)
+    transcripts = [text_chunks[i:i + 100] for i in range(0, len(text_chunks), 100)]
+    cleaned_chunks = utils.clean_text(text_chunks)
+    classifications = [random.Random(i).choice(["toxic", "non-toxic", "non-toxic", "non-toxic"]) for i in range(len(cleaned_chunks))]
+
+    def listing():
+        return (lambda: [transcriber.get_channel_vids(channel_url, ttl=0) for channel_url in channel_urls]), len(channel_urls), "channels"
+
+    def download_wav():
+        def run():
+            for url in video_urls:
+                transcriber.download_wav(download_path, url, max_duration=1200, min_duration=120)
+            shutil.rmtree(download_path)
+            download_path.mkdir()
+        return run, len(video_urls), "videos"
+
+    def download_channel():
+        def run():
+            for channel_url in channel_urls:
+                transcriber.download_channel(3, transcriber.get_channel_vids(channel_url, ttl=0), download_path)
+            shutil.rmtree(download_path)
+            download_path.mkdir()
+        return run, len(channel_urls), "channels"
+
+    def probe_channel():
+        # the rate limit is set high, so the benchmark measures how well probes overlap instead of the limit itself
+        prober = transcriber.define_prober(workers=args.probe_workers, rate=1000, retries=3, backoff_s=0.01, ydl_factory=FakeYoutubeDL)
+
+        def run():
+            FakeYoutubeDL.latency, FakeYoutubeDL.failure_rate = args.latency, args.failure_rate
+            try:
+                for channel_url in channel_urls:
+                    candidates = transcriber.probe_candidates(transcriber.get_channel_vids(channel_url, ttl=0), prober)
+                    for _ in range(3):
+                        next(candidates, None)
+                    candidates.close()
+            finally:
+                FakeYoutubeDL.latency, FakeYoutubeDL.failure_rate = 0.0, 0.0
+        return run, len(channel_urls), "channels"
+
+    def clean_text():
+        return (lambda: utils.clean_texts(transcripts)), len(text_chunks), "chunks"
+
+    def toxicity_aggregates():
+        return (lambda: classifier.toxicity_aggregates(cleaned_chunks, classifications)), len(cleaned_chunks), "chunks"
+
+    def classify():
+        tiny_classifier = build_tiny_classifier(work_path)
+        sample = cleaned_chunks[:2000]
+        return (lambda: classifier.classify_batched(sample, tiny_classifier, batch_size=32)), len(sample), "chunks"
+
+    def transcribe():
+        tiny_transcriber = build_tiny_transcriber(work_path)
+        return (lambda: transcriber.transcribe_batch([{"raw": audio.copy(), "sampling_rate": 16000}], tiny_transcriber, batch_size=4)), len(audio) / 16000, "audio seconds"
+
+    return {"listing": listing,
+            "download_wav": download_wav,
+            "download_channel": download_channel,
+            "probe_channel": probe_channel,
+            "clean_text": clean_text,
+            "toxicity_aggregates": toxicity_aggregates,
+            "classify": classify,
+            "transcribe": transcribe}
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Compares results with a baseline and flags regressions.
+
+    Args:
+        results (dict): Dict from benchmark name to result
+        baseline (dict): Dict from benchmark name to baseline result
+        tolerance (float): Tolerated relative loss in throughput (or gain in peak memory)
+
+    Returns:
+        regressions (list): List of messages describing each regression
+    """
+
+    regressions = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+
+        # skip benchmarks without a baseline or that failed
+        if base is None or "error" in base or "error" in result:
+            continue
+
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']} {result['unit']} vs. baseline {base['throughput']}")
+
+        if result["peak_mb"] > base["peak_mb"] * (1 + tolerance) and result["peak_mb"] - base["peak_mb"] > 1:
+            regressions.append(f"{name}: peak memory {result['peak_mb']} MB vs. baseline {base['peak_mb']} MB")
+
+    return regressions
+
+
+def main():
+    args = arg_parse()
+
+    # fixtures, downloads and caches live in a temporary folder
+    work_path = Path(tempfile.mkdtemp())
+
+    try:
+        benchmarks = define_benchmarks(args, work_path)
+        names = args.benchmarks or list(benchmarks)
+
+        # run benchmarks, recording failures instead of stopping the suite
+        results = {}
+        for name in names:
+            print(f"Running {name}...")
+            try:
+                run, n_items, unit = benchmarks[name]()
+                results[name] = run_benchmark(run, n_items, unit, args.repeats)
+                print(f"    {results[name]['throughput']} {results[name]['unit']}, peak {results[name]['peak_mb']} MB")
+            except Exception as e:
+                results[name] = {"error": f"{type(e).__name__}: {e}"}
+                print(f"    failed: {results[name]['error']}")
+
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    # save results
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+                   "machine": platform.machine(), "results": results}, f, indent=2)
+    print(f"Results saved to {output}")
+
+    # compare with baseline
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+
+        if regressions:
+            raise SystemExit(1)
+
+        print(f"No regressions beyond {args.tolerance:.0%} compared with {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
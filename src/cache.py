@@ -0,0 +1,464 @@
+""" cache.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Provides on-disk caches for the SafeTuber pipeline, so repeated runs on the same channels can skip work that was already done.
+    All caches live in the cache folder in the root of the repository.
+"""
+
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def define_cache_path(name):
+    """
+    Defines the path to a cache and creates it if it doesn't exist.
+
+    Args:
+        name (str): Name of the cache
+
+    Returns:
+        cache_path (pathlib.PosixPath): Path to the cache folder
+    """
+
+    # define path
+    path = Path(__file__)
+
+    # define path to cache
+    cache_path = path.parents[1] / "cache" / name
+
+    # create dir for cache if it doesn't exist
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    return cache_path
+
+
+def cache_key(*parts):
+    """
+    Creates a file-name safe key from one or more strings.
+
+    Args:
+        *parts (str): Strings that together identify a cache entry
+
+    Returns:
+        key (str): Hex digest of the parts
+    """
+
+    return hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def read_json_cache(file_path, ttl=None):
+    """
+    Reads a JSON cache entry if it exists and is not older than ttl.
+
+    Args:
+        file_path (pathlib.PosixPath): Path to the cache entry
+        ttl (float): Max age of the entry in seconds, None for no max age
+
+    Returns:
+        value: Cached value, None if the entry is missing, expired or unreadable
+    """
+
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # ignore expired entries
+    if ttl is not None and time.time() - entry.get("created_at", 0) > ttl:
+        return None
+
+    return entry.get("value")
+
+
+def write_json_cache(file_path, value):
+    """
+    Writes a JSON cache entry. The entry is written to a temporary file first and then moved in place,
+    so concurrent readers never see a half-written entry.
+
+    Args:
+        file_path (pathlib.PosixPath): Path to the cache entry
+        value: JSON-serializable value to cache
+    """
+
+    # write to temporary file next to the entry
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"created_at": time.time(), "value": value}, f)
+
+    # move it in place
+    os.replace(tmp_path, file_path)
+
+
+def define_video_store():
+    """
+    Defines the path to the persistent store of probed videos and creates its table if it doesn't exist.
+    The store keeps the duration and failure status of every video seen, so later runs never probe them again.
+
+    Returns:
+        store_path (pathlib.PosixPath): Path to the SQLite database
+    """
+
+    # define path to store
+    store_path = define_cache_path("videos") / "videos.sqlite"
+
+    # create table if it doesn't exist
+    with closing(sqlite3.connect(store_path, timeout=30)) as conn, conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS videos (
+                            video_id TEXT PRIMARY KEY,
+                            duration REAL,
+                            status TEXT,
+                            error TEXT,
+                            updated_at REAL)""")
+
+    return store_path
+
+
+def lookup_video(store_path, video_id):
+    """
+    Looks up what is known about a video.
+
+    Args:
+        store_path (pathlib.PosixPath): Path to the SQLite database
+        video_id (str): YouTube id of the video
+
+    Returns:
+        video (dict): Dict with duration, status and error of the video, None if the video is unknown
+    """
+
+    with closing(sqlite3.connect(store_path, timeout=30)) as conn:
+        row = conn.execute("SELECT duration, status, error FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+
+    if row is None:
+        return None
+
+    return {"duration": row[0], "status": row[1], "error": row[2]}
+
+
+def record_video(store_path, video_id, duration=None, status=None, error=None):
+    """
+    Records what is known about a video. Fields that are None keep their stored value.
+
+    Args:
+        store_path (pathlib.PosixPath): Path to the SQLite database
+        video_id (str): YouTube id of the video
+        duration (float): Duration of the video in seconds
+        status (str): Status of the video, e.g. "ok" or "unavailable"
+        error (str): Error message if the video failed
+    """
+
+    with closing(sqlite3.connect(store_path, timeout=30)) as conn, conn:
+        conn.execute("""INSERT INTO videos (video_id, duration, status, error, updated_at) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(video_id) DO UPDATE SET
+                            duration = COALESCE(excluded.duration, duration),
+                            status = COALESCE(excluded.status, status),
+                            error = COALESCE(excluded.error, error),
+                            updated_at = excluded.updated_at""",
+                     (video_id, duration, status, error, time.time()))
+
+
+def define_transcript_cache(model, settings, max_gb=2):
+    """
+    Defines a cache of raw timestamped transcripts, keyed by video id, Whisper model and generation settings.
+    With it, re-running the pipeline (or re-cleaning with a changed clean_text) skips both download and transcription.
+
+    Args:
+        model (str): Model used for transcription
+        settings (dict): Generation settings of the transcriber, e.g. chunk length and max new tokens
+        max_gb (float): Max size of the cache in gigabytes, least recently used transcripts are evicted beyond it
+
+    Returns:
+        transcript_cache (dict): Dict with the path, key parts, max size, running size and hit/miss counters of the cache, and a lock guarding the counters
+    """
+
+    return {"path": define_cache_path("transcripts"),
+            "model": model,
+            "settings": json.dumps(settings, sort_keys=True),
+            "max_bytes": int(max_gb * 1024**3),
+            "total_bytes": None,
+            "lock": threading.Lock(),
+            "hits": 0,
+            "misses": 0}
+
+
+def transcript_cache_file(transcript_cache, video_id):
+    """
+    Defines the path to the cached transcript of a video.
+
+    Args:
+        transcript_cache (dict): Transcript cache from define_transcript_cache
+        video_id (str): YouTube id of the video
+
+    Returns:
+        file_path (pathlib.PosixPath): Path to the cached transcript
+    """
+
+    return transcript_cache["path"] / f"{cache_key(video_id, transcript_cache['model'], transcript_cache['settings'])}.json"
+
+
+def read_transcript(transcript_cache, video_id):
+    """
+    Reads the cached transcript of a video and counts the hit or miss. Safe to call from several threads.
+
+    Args:
+        transcript_cache (dict): Transcript cache from define_transcript_cache
+        video_id (str): YouTube id of the video
+
+    Returns:
+        all_chunks (list): List with the timestamped chunks of every audio file of the video, None if it is not cached
+    """
+
+    file_path = transcript_cache_file(transcript_cache, video_id)
+    all_chunks = read_json_cache(file_path)
+
+    if all_chunks is None:
+        with transcript_cache["lock"]:
+            transcript_cache["misses"] += 1
+        return None
+
+    # mark as recently used, so it is evicted last
+    try:
+        os.utime(file_path)
+    except OSError:
+        pass
+
+    with transcript_cache["lock"]:
+        transcript_cache["hits"] += 1
+
+    return all_chunks
+
+
+def evict_transcripts(transcript_cache, target_bytes):
+    """
+    Evicts the least recently used transcripts until the cache fits in target_bytes, and counts the size of the cache on disk.
+
+    Args:
+        transcript_cache (dict): Transcript cache from define_transcript_cache
+        target_bytes (int): Size in bytes to evict down to
+
+    Returns:
+        total_bytes (int): Size of the cache after eviction in bytes
+    """
+
+    # list cached transcripts, least recently used first
+    entries = []
+    for file_path in transcript_cache["path"].glob("*.json"):
+        try:
+            stat = file_path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file_path))
+    entries.sort()
+
+    # evict until the cache fits
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, file_path in entries:
+        if total_bytes <= target_bytes:
+            break
+        try:
+            file_path.unlink()
+        except OSError:
+            continue
+        total_bytes -= size
+
+    return total_bytes
+
+
+def write_transcript(transcript_cache, video_id, all_chunks):
+    """
+    Writes the transcript of a video to the cache and evicts the least recently used transcripts if the cache is too big.
+    The size of the cache is counted on disk once per run and then kept as a running total, so the cache folder is only
+    listed again when the total goes beyond the max size. It is then evicted down to 90% of the max size, so a full cache
+    is not listed again on every write. Safe to call from several threads.
+
+    Args:
+        transcript_cache (dict): Transcript cache from define_transcript_cache
+        video_id (str): YouTube id of the video
+        all_chunks (list): List with the timestamped chunks of every audio file of the video
+    """
+
+    file_path = transcript_cache_file(transcript_cache, video_id)
+
+    with transcript_cache["lock"]:
+        # size of an earlier transcript of the video, which is replaced
+        old_bytes = file_path.stat().st_size if file_path.exists() else 0
+
+        write_json_cache(file_path, all_chunks)
+
+        # count the cache once, afterwards add the size of every new transcript
+        if transcript_cache["total_bytes"] is None:
+            transcript_cache["total_bytes"] = evict_transcripts(transcript_cache, transcript_cache["max_bytes"])
+        else:
+            transcript_cache["total_bytes"] += file_path.stat().st_size - old_bytes
+
+        # evict, counting the cache on disk again as other processes may have written to it too
+        if transcript_cache["total_bytes"] > transcript_cache["max_bytes"]:
+            transcript_cache["total_bytes"] = evict_transcripts(transcript_cache, int(transcript_cache["max_bytes"] * 0.9))
+
+
+def report_transcript_cache(transcript_cache):
+    """
+    Prints hits and misses of the transcript cache in this run.
+
+    Args:
+        transcript_cache (dict): Transcript cache from define_transcript_cache
+    """
+
+    n_lookups = transcript_cache["hits"] + transcript_cache["misses"]
+    hit_rate = transcript_cache["hits"] / n_lookups if n_lookups else 0.0
+
+    print(f"Transcript cache: {transcript_cache['hits']} hits, {transcript_cache['misses']} misses ({hit_rate:.1%} hit rate)")
+
+
+def normalize_text(text):
+    """
+    Normalizes a text chunk for cache lookups. The classifier is uncased and ignores whitespace, so neither changes its label.
+
+    Args:
+        text (str): Text chunk
+
+    Returns:
+        normalized (str): Lowercased text chunk with collapsed whitespace
+    """
+
+    return " ".join(text.lower().split())
+
+
+def define_label_cache(model, max_memory=100000):
+    """
+    Defines a cache of classification labels keyed by the hash of the normalized chunk text and the classifier model.
+    It has an in-memory LRU tier and a persistent SQLite tier, so repeated chunks (e.g. sponsor reads, intros and outros)
+    are only classified once, also across channels and runs.
+
+    Args:
+        model (str): Model used for classification
+        max_memory (int): Max number of labels kept in memory
+
+    Returns:
+        label_cache (dict): Dict with the path, model, memory tier, lock and hit/miss counters of the cache
+    """
+
+    # define path to persistent tier
+    store_path = define_cache_path("labels") / "labels.sqlite"
+
+    # create table if it doesn't exist
+    with closing(sqlite3.connect(store_path, timeout=30)) as conn, conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, label TEXT)")
+
+    return {"path": store_path,
+            "model": model,
+            "memory": OrderedDict(),
+            "max_memory": max_memory,
+            "lock": threading.Lock(),
+            "hits": 0,
+            "misses": 0}
+
+
+def label_keys(label_cache, text_chunks):
+    """
+    Creates the cache keys of text chunks.
+
+    Args:
+        label_cache (dict): Label cache from define_label_cache
+        text_chunks (list): List of text chunks
+
+    Returns:
+        keys (list): List of cache keys
+    """
+
+    return [cache_key(normalize_text(text_chunk), label_cache["model"]) for text_chunk in text_chunks]
+
+
+def remember_labels(label_cache, labels):
+    """
+    Puts labels in the in-memory tier, evicting the least recently used ones beyond its max size.
+
+    Args:
+        label_cache (dict): Label cache from define_label_cache
+        labels (dict): Dict from cache key to label
+    """
+
+    memory = label_cache["memory"]
+
+    for key, label in labels.items():
+        memory[key] = label
+        memory.move_to_end(key)
+
+    while len(memory) > label_cache["max_memory"]:
+        memory.popitem(last=False)
+
+
+def read_labels(label_cache, keys):
+    """
+    Looks up labels in the in-memory tier first and then in the persistent tier.
+
+    Args:
+        label_cache (dict): Label cache from define_label_cache
+        keys (list): List of cache keys
+
+    Returns:
+        labels (dict): Dict from cache key to label for the keys that are cached
+    """
+
+    labels = {}
+
+    with label_cache["lock"]:
+        # look in memory
+        memory = label_cache["memory"]
+        for key in set(keys):
+            if key in memory:
+                memory.move_to_end(key)
+                labels[key] = memory[key]
+
+        # look on disk for the rest, in groups to stay below SQLite's max number of variables
+        missing = set(keys) - labels.keys()
+        missing_keys = list(missing)
+        with closing(sqlite3.connect(label_cache["path"], timeout=30)) as conn:
+            for start in range(0, len(missing_keys), 500):
+                group = missing_keys[start:start + 500]
+                rows = conn.execute(f"SELECT key, label FROM labels WHERE key IN ({','.join('?' * len(group))})", group).fetchall()
+                labels.update(rows)
+
+        # keep labels found on disk in memory
+        remember_labels(label_cache, {key: label for key, label in labels.items() if key in missing})
+
+    return labels
+
+
+def write_labels(label_cache, labels):
+    """
+    Writes labels to both tiers of the cache.
+
+    Args:
+        label_cache (dict): Label cache from define_label_cache
+        labels (dict): Dict from cache key to label
+    """
+
+    with label_cache["lock"]:
+        remember_labels(label_cache, labels)
+
+        with closing(sqlite3.connect(label_cache["path"], timeout=30)) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO labels (key, label) VALUES (?, ?)", labels.items())
+
+
+def report_label_cache(label_cache):
+    """
+    Prints hits and misses of the label cache in this run.
+
+    Args:
+        label_cache (dict): Label cache from define_label_cache
+    """
+
+    n_lookups = label_cache["hits"] + label_cache["misses"]
+    hit_rate = label_cache["hits"] / n_lookups if n_lookups else 0.0
+
+    print(f"Label cache: {label_cache['hits']} hits, {label_cache['misses']} misses ({hit_rate:.1%} hit rate)")
@@ -0,0 +1,219 @@
+""" checkpoints.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Provides checkpointing for transcriber.py, so a run that crashes (e.g. because yt_dlp breaks halfway) can be resumed.
+    Cleaned chunks of every video are committed to disk as soon as the video is done, and a channel is marked complete
+    once all its videos are done. A restart skips complete channels and resumes partial channels at video granularity.
+    The transcribed table is built from the checkpoints in a final merge step.
+
+    Checkpoints are stored per run configuration (model and number of videos) in data/checkpoints:
+        data/checkpoints/<run>/<channel>/channel.json        <----- used video urls, written when the channel is complete
+        data/checkpoints/<run>/<channel>/videos/<video>.json <----- cleaned chunks of a single video
+    An incremental refresh (transcriber.py --refresh) checkpoints only its new videos, in a <run>-refresh folder that is cleared once the refresh is merged.
+"""
+
+from pathlib import Path
+from cache import cache_key, read_json_cache, write_json_cache
+import random
+import shutil
+import time
+
+
+def define_checkpoint_path(model, n_vids, refresh=False, queue=False):
+    """
+    Defines the path to the checkpoints of a run configuration and creates it if it doesn't exist.
+
+    Args:
+        model (str): Model used for transcription
+        n_vids (int): Number of videos analyzed per channel
+        refresh (bool): Whether the run is an incremental refresh, which keeps its checkpoints apart from full runs
+        queue (bool): Whether the run is worked from a job queue (see worker.py), which keeps its queue and checkpoints apart from transcriber.py
+
+    Returns:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+    """
+
+    # define path
+    path = Path(__file__)
+
+    # define path to checkpoints of this run configuration
+    suffix = ("-refresh" if refresh else "") + ("-queue" if queue else "")
+    checkpoint_path = path.parents[1] / "data" / "checkpoints" / f"{model.replace('/', '--')}-{n_vids}-vids{suffix}"
+
+    # create dir for checkpoints if it doesn't exist
+    checkpoint_path.mkdir(parents=True, exist_ok=True)
+
+    return checkpoint_path
+
+
+def clear_checkpoints(checkpoint_path):
+    """
+    Deletes all checkpoints of a run, so the next run starts from scratch.
+
+    Args:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+    """
+
+    shutil.rmtree(checkpoint_path, ignore_errors=True)
+    checkpoint_path.mkdir(parents=True, exist_ok=True)
+
+
+def channel_checkpoint_path(checkpoint_path, channel_url):
+    """
+    Defines the path to the checkpoints of a single channel.
+
+    Args:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+        channel_url (str): URL of the YouTube channel
+
+    Returns:
+        channel_path (pathlib.PosixPath): Path to the checkpoints of the channel
+    """
+
+    return checkpoint_path / cache_key(channel_url)
+
+
+def save_video_checkpoint(checkpoint_path, channel_url, url, text_chunks):
+    """
+    Commits the cleaned chunks of a single video to disk, with the time it was done, so a resumed channel keeps its videos in the order they were done.
+
+    Args:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+        channel_url (str): URL of the YouTube channel
+        url (str): URL of the video
+        text_chunks (list): List of cleaned text chunks of the video
+    """
+
+    # create dir for the videos of the channel
+    videos_path = channel_checkpoint_path(checkpoint_path, channel_url) / "videos"
+    videos_path.mkdir(parents=True, exist_ok=True)
+
+    write_json_cache(videos_path / f"{cache_key(url)}.json", {"url": url, "text_chunks": text_chunks, "done_at": time.time()})
+
+
+def save_channel_checkpoint(checkpoint_path, channel_url, used_urls):
+    """
+    Marks a channel as complete.
+
+    Args:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+        channel_url (str): URL of the YouTube channel
+        used_urls (list): List of urls that were used to download videos
+    """
+
+    # create dir for the channel
+    channel_path = channel_checkpoint_path(checkpoint_path, channel_url)
+    channel_path.mkdir(parents=True, exist_ok=True)
+
+    write_json_cache(channel_path / "channel.json", {"channel_url": channel_url, "used_urls": used_urls})
+
+
+def load_channel_progress(checkpoint_path, channel_url):
+    """
+    Loads how far a channel got on earlier runs.
+
+    Args:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+        channel_url (str): URL of the YouTube channel
+
+    Returns:
+        complete (bool): True if the channel is complete
+        done_urls (list): List of urls of videos that are done, in the order they were done (i.e. listing order)
+    """
+
+    channel_path = channel_checkpoint_path(checkpoint_path, channel_url)
+
+    # complete channels know their used urls
+    channel = read_json_cache(channel_path / "channel.json")
+    if channel is not None:
+        return True, channel["used_urls"]
+
+    # partial channels only have some of their videos
+    done_videos = []
+    for video_file in sorted((channel_path / "videos").glob("*.json")):
+        video = read_json_cache(video_file)
+        if video is not None:
+            done_videos.append(video)
+
+    # checkpoints written before done_at existed keep their file order
+    done_videos.sort(key=lambda video: video.get("done_at", 0))
+
+    return False, [video["url"] for video in done_videos]
+
+
+def load_channel_chunks(checkpoint_path, channel_url, used_urls):
+    """
+    Loads the cleaned chunks of the given videos of a channel.
+
+    Args:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+        channel_url (str): URL of the YouTube channel
+        used_urls (list): List of urls of the videos to load
+
+    Returns:
+        all_text_chunks (list): List of cleaned text chunks from all the videos
+    """
+
+    videos_path = channel_checkpoint_path(checkpoint_path, channel_url) / "videos"
+
+    all_text_chunks = []
+    for url in used_urls:
+        video = read_json_cache(videos_path / f"{cache_key(url)}.json")
+        if video is not None:
+            all_text_chunks.extend(video["text_chunks"])
+
+    return all_text_chunks
+
+
+def load_video_chunks(checkpoint_path, channel_url, url):
+    """
+    Loads the cleaned chunks of a single video of a channel.
+
+    Args:
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+        channel_url (str): URL of the YouTube channel
+        url (str): URL of the video
+
+    Returns:
+        text_chunks (list): List of cleaned text chunks of the video, None if the video has no checkpoint
+    """
+
+    video = read_json_cache(channel_checkpoint_path(checkpoint_path, channel_url) / "videos" / f"{cache_key(url)}.json")
+
+    return video["text_chunks"] if video is not None else None
+
+
+def merge_checkpoints(data, checkpoint_path):
+    """
+    Builds the transcribed table from the checkpoints of a run.
+    Channels that are not complete are left with empty values.
+
+    Args:
+        data (pd.DataFrame): Dataframe with a channel_url column
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+
+    Returns:
+        data (pd.DataFrame): Dataframe with transcript_chunks and video_urls columns
+    """
+
+    # create empty columns for later variables
+    data["transcript_chunks"] = None
+    data["video_urls"] = None
+
+    for i, row in data.iterrows():
+        complete, used_urls = load_channel_progress(checkpoint_path, row["channel_url"])
+
+        # skip channels that are not done yet
+        if not complete:
+            continue
+
+        # merge and shuffle transcripts of the channel
+        all_text_chunks = load_channel_chunks(checkpoint_path, row["channel_url"], used_urls)
+        random.shuffle(all_text_chunks)
+
+        data.at[i, "video_urls"] = used_urls
+        data.at[i, "transcript_chunks"] = all_text_chunks
+
+    return data
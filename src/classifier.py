@@ -14,15 +14,76 @@ Desc:
     This script analyzes all the 200 channels in the top-youtubers-transcribed.csv file and provides transcriptions of their recent
     videos in out/top-youtubers-classified.csv.
 
+    By default, chunks from all channels are gathered, sorted by length and classified in batches to minimize padding.
+    The old one-chunk-at-a-time path is kept with --sequential, so the reported throughput of the two can be compared.
+
+    Chunks are read from the columnar chunk table (data/top-youtubers-chunks.parquet) and written back with their labels,
+    together with a small per-channel summary table. out/top-youtubers-classified.csv is still written as an export format.
+
+    Labels are cached per normalized chunk text and model (in memory and in cache/labels), so only unseen text is classified.
+    Chunks that already have a label in the chunk table (kept by transcriber.py --refresh) are not classified again, and the
+    per-channel aggregates are recomputed from the stored labels. If no chunk lacks a label, the model is not even loaded.
+    Every run writes a report with per-stage wall times and chunks/sec to out/metrics/classifier-run.json (see metrics.py).
+    With --processes, chunks are classified by a pool of worker processes, each pinned to its own slice of cores with a matching
+    torch thread count (see scheduler.py). --processes 0 auto-tunes the split of the cores into processes x threads for the host.
+
 Usage:
-    $ python src/classifier.py
+    $ python src/classifier.py --batch_size 32
+    $ python src/classifier.py --processes 0
 """
 
 
 from pathlib import Path
-from transformers import pipeline
 import pandas as pd
 from tqdm import tqdm
+from backends import build_classifier, backend_model_name
+from cache import define_label_cache, label_keys, read_labels, write_labels, report_label_cache
+from storage import define_storage_paths, chunks_from_csv, read_table, write_table, summarize_chunks
+from metrics import define_metrics, count, add_time, time_stage, write_run_report, define_report_path
+from scheduler import define_classifier_pool, close_classifier_pool, classify_parallel, tuned_pool_shape
+import argparse
+import time
+
+
+def arg_parse():
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - The number of chunks classified in one forward pass
+    - Whether to classify one chunk at a time instead (the old path)
+    - Whether to skip the label cache
+    - Whether to classify chunks that already have a label again
+    - The inference backend of the classifier
+    - The number of worker processes and threads per process, or to auto-tune them for the host
+    - Where to write the run report and Prometheus textfile
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Classify toxicity of transcribed YouTube channels')
+
+    # add arguments
+    parser.add_argument('-b', '--batch_size', default=32, type=int, help='Number of chunks classified in one forward pass')
+    parser.add_argument('-s', '--sequential', action='store_true', help='Classify one chunk at a time instead of in batches')
+    parser.add_argument('--backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the classifier (check backends.py for more info)')
+    parser.add_argument('-p', '--processes', default=1, type=int, help='Number of worker processes classifying chunks, each pinned to its own cores and holding its own copy of the model (0 to auto-tune for the host, which loads the model in up to one process per core, as many as fit in memory; check scheduler.py for more info)')
+    parser.add_argument('--threads', default=None, type=int, help='Number of torch threads per worker process (default: cores divided by processes)')
+    parser.add_argument('--retune', action='store_true', help='Auto-tune processes x threads again, also if a tuned split is cached for the host (loads a copy of the model per process of every split tried)')
+    parser.add_argument('--no_label_cache', action='store_true', help='Classify every chunk, also chunks with a cached label')
+    parser.add_argument('--relabel', action='store_true', help='Classify chunks that already have a label (e.g. kept by transcriber.py --refresh) again')
+    parser.add_argument('--metrics_path', default=str(define_report_path("classifier")), help='Path to write the JSON run report to')
+    parser.add_argument('--prometheus', default=None, help='Path to write a Prometheus textfile to, e.g. for the node_exporter textfile collector')
+
+    # parse arguments
+    args = parser.parse_args()
+
+    # the old path classifies in this process
+    if args.sequential and args.processes != 1:
+        parser.error("--sequential classifies one chunk at a time in this process and can't be used with --processes")
+
+    return args
 
 def define_paths():
     """
@@ -70,6 +131,123 @@ def classify_transcript(text_chunks, classifier):
 
     return classifications
 
+def classify_batched(text_chunks, classifier, batch_size=32):
+    """
+    Classifies text chunks as either toxic or not toxic in batches.
+    Chunks are sorted by their number of tokens before batching, so each batch holds chunks of similar length and little padding is needed.
+    The classifications are returned in the same order as the text chunks.
+
+    Args:
+        text_chunks (list): List of text chunks
+        classifier (pipeline): HuggingFace pipeline for text classification
+        batch_size (int): Number of chunks classified in one forward pass
+
+    Returns:
+        classifications (list): List of classifications
+    """
+
+    # count tokens of every chunk
+    lengths = [len(input_ids) for input_ids in classifier.tokenizer(text_chunks)["input_ids"]] if text_chunks else []
+
+    # sort chunk indices by length so that neighbouring chunks fall in the same length bucket
+    order = sorted(range(len(text_chunks)), key=lambda i: lengths[i])
+
+    # initialize list to scatter classifications back into
+    classifications = [None] * len(text_chunks)
+
+    # loop over length buckets of batch_size chunks
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+
+        # classify all chunks in the bucket in one forward pass
+        outputs = classifier([text_chunks[i] for i in bucket], batch_size = len(bucket))
+
+        # put classification labels back in their original position
+        for i, output in zip(bucket, outputs):
+            classifications[i] = output["label"]
+
+    return classifications
+
+def lookup_labels(text_chunks, label_cache):
+    """
+    Looks up the cached labels of text chunks and gathers the text that is not in the label cache, once per key.
+
+    Args:
+        text_chunks (list): List of text chunks
+        label_cache (dict): Label cache from define_label_cache
+
+    Returns:
+        keys (list): List with the cache key of every chunk
+        labels (dict): Dict from cache key to cached label
+        unseen (dict): Dict from cache key to text of the chunks that are not in the label cache
+    """
+
+    # look up cached labels
+    keys = label_keys(label_cache, text_chunks)
+    labels = read_labels(label_cache, keys)
+
+    # gather unseen text, once per key
+    unseen = {}
+    for key, text_chunk in zip(keys, text_chunks):
+        if key not in labels and key not in unseen:
+            unseen[key] = text_chunk
+
+    return keys, labels, unseen
+
+def classify_cached(text_chunks, classifier, label_cache, batch_size=32, sequential=False, classifier_pool=None, lookup=None):
+    """
+    Classifies text chunks, only running inference on text that is not in the label cache.
+    Chunks that repeat within the input are classified once.
+
+    Args:
+        text_chunks (list): List of text chunks
+        classifier (pipeline): HuggingFace pipeline for text classification, None if a classifier pool is used
+        label_cache (dict): Label cache from define_label_cache
+        batch_size (int): Number of chunks classified in one forward pass
+        sequential (bool): Whether to classify unseen chunks one at a time instead of in batches
+        classifier_pool (dict): Classifier pool from define_classifier_pool to classify unseen chunks on, None to use the classifier
+        lookup (tuple): Keys, labels and unseen text of the chunks from lookup_labels, None to look them up here
+
+    Returns:
+        classifications (list): List of classifications
+    """
+
+    # look up cached labels and unseen text
+    keys, labels, unseen = lookup or lookup_labels(text_chunks, label_cache)
+
+    # classify unseen text
+    if classifier_pool is not None:
+        new_classifications = classify_parallel(list(unseen.values()), classifier_pool, batch_size = batch_size)
+    elif sequential:
+        new_classifications = classify_transcript(list(unseen.values()), classifier)
+    else:
+        new_classifications = classify_batched(list(unseen.values()), classifier, batch_size = batch_size)
+
+    # cache new labels
+    new_labels = dict(zip(unseen.keys(), new_classifications))
+    write_labels(label_cache, new_labels)
+    labels.update(new_labels)
+
+    # count hits and misses
+    label_cache["hits"] += len(text_chunks) - len(unseen)
+    label_cache["misses"] += len(unseen)
+
+    return [labels[key] for key in keys]
+
+def report_throughput(n_chunks, seconds):
+    """
+    Prints the classification throughput.
+
+    Args:
+        n_chunks (int): Number of classified chunks
+        seconds (float): Time spent classifying in seconds
+    """
+
+    # guard against division by zero for empty inputs
+    chunks_per_sec = n_chunks / seconds if seconds > 0 else 0.0
+
+    print(f"Classified {n_chunks} chunks in {seconds:.1f} seconds ({chunks_per_sec:.1f} chunks/sec)")
+
 def toxicity_aggregates(text_chunks, classifications):
     """
     Calculate toxicity aggregates based on classifications.
@@ -106,39 +284,175 @@ def toxicity_aggregates(text_chunks, classifications):
 
     return n_comments, n_toxic, pct_toxic, toxic_comments
 
-def main():
-    print("Classifying text chunks...")
-    # define paths
-    inpath, outpath = define_paths()
+def wilson_interval(n_toxic, n_comments, z=1.96):
+    """
+    Calculates the Wilson score interval of the share of toxic comments.
+    Unlike the normal approximation, it stays within [0, 1] and is reliable for shares close to 0, which is common for channels.
 
-    # load data from inpath
-    data = pd.read_csv(inpath / "top-youtubers-transcribed.csv")
+    Args:
+        n_toxic (int): Number of toxic comments
+        n_comments (int): Total number of comments
+        z (float): Quantile of the standard normal distribution (1.96 for a 95% interval)
 
-    # change data type of transcript_chunks to list
-    data["transcript_chunks"] = data["transcript_chunks"].apply(lambda x: eval(x))
+    Returns:
+        lower (float): Lower bound of the share of toxic comments
+        upper (float): Upper bound of the share of toxic comments
+    """
+
+    # no comments, no information
+    if n_comments == 0:
+        return 0.0, 1.0
+
+    share = n_toxic / n_comments
+    denominator = 1 + z**2 / n_comments
+    center = (share + z**2 / (2 * n_comments)) / denominator
+    margin = z * ((share * (1 - share) / n_comments + z**2 / (4 * n_comments**2)) ** 0.5) / denominator
+
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+def classified_export(chunks, channels):
+    """
+    Creates the classified table in its CSV export format, with one row per channel and stringified lists of chunks.
+
+    Args:
+        chunks (pd.DataFrame): Table of classified chunks
+        channels (pd.DataFrame): Table of channel metadata with a channel_url column
+
+    Returns:
+        data (pd.DataFrame): Channel metadata with transcript_chunks, video_urls, n_comments, n_toxic, pct_toxic and toxic_comments columns
+    """
+
+    # group chunks per channel
+    channel_chunks = {channel_url: group for channel_url, group in chunks.groupby("channel_url", sort=False)}
 
-    # initialize classifier
-    classifier = pipeline("text-classification", 
-                          model = "martin-ha/toxic-comment-model")
-    # loop with tqdm
-    for i, row in tqdm(data.iterrows(), total = len(data)):
-        # get transcript chunks
-        transcript_chunks = row["transcript_chunks"]
+    data = channels.copy()
+    data["transcript_chunks"] = None
+    data["video_urls"] = None
 
-        # classify transcript chunks
-        classifications = classify_transcript(transcript_chunks, classifier)
+    for i, row in data.iterrows():
+        group = channel_chunks.get(row["channel_url"], chunks.iloc[0:0])
+
+        # get transcript chunks, their classifications and the videos they came from
+        transcript_chunks = group["text"].tolist()
+        classifications = group["label"].tolist()
+        video_urls = ["https://www.youtube.com/watch?v=" + video_id for video_id in group["video_id"].dropna().unique()]
 
         # calculate toxicity aggregates
         n_comments, n_toxic, pct_toxic, toxic_comments = toxicity_aggregates(transcript_chunks, classifications)
-        
+
         # save data
+        data.at[i, "transcript_chunks"] = transcript_chunks
+        data.at[i, "video_urls"] = video_urls
         data.loc[i, "n_comments"] = n_comments
         data.loc[i, "n_toxic"] = n_toxic
         data.loc[i, "pct_toxic"] = pct_toxic
         data.loc[i, "toxic_comments"] = toxic_comments
 
-    # save data
-    data.to_csv(outpath / "top-youtubers-classified.csv", index = False)
+    return data
+
+def main():
+    args = arg_parse()
+
+    print("Classifying text chunks...")
+    # collect per-stage metrics of the run
+    metrics = define_metrics("classifier")
+
+    # define paths
+    inpath, outpath = define_paths()
+    chunks_path, classified_path, summary_path = define_storage_paths()
+
+    # load one row per chunk, converting the transcribed CSV if there is no chunk table yet
+    with time_stage(metrics, "load"):
+        if chunks_path.exists():
+            chunks = read_table(chunks_path)
+        else:
+            chunks = chunks_from_csv(inpath / "top-youtubers-transcribed.csv")
+
+    # only classify chunks without a label, e.g. the new videos of an incremental refresh
+    unlabeled = chunks["label"].isna() | args.relabel
+    text_chunks = chunks.loc[unlabeled, "text"].tolist()
+    count(metrics, "chunks_kept_labels", int((~unlabeled).sum()))
+
+    # look up cached labels first, so only text that is not in the label cache needs a model
+    model = "martin-ha/toxic-comment-model"
+    label_cache = None if args.no_label_cache else define_label_cache(backend_model_name(model, args.backend))
+    lookup = lookup_labels(text_chunks, label_cache) if text_chunks and label_cache is not None else None
+    uncached_chunks = list(lookup[2].values()) if lookup is not None else text_chunks
+
+    # initialize classifier on the chosen backend, unless there is nothing to classify
+    classifier, classifier_pool = None, None
+    if uncached_chunks and args.processes == 1 and args.threads is None:
+        with time_stage(metrics, "load_models"):
+            classifier = build_classifier(model, backend = args.backend)
+
+    # or start a pool of classifier processes pinned to their own cores, auto-tuning its shape on the uncached chunks if asked to
+    elif uncached_chunks:
+        processes, threads = args.processes, args.threads
+        if processes == 0:
+            with time_stage(metrics, "tune"):
+                processes, threads = tuned_pool_shape(uncached_chunks, model, args.backend, args.batch_size, retune = args.retune)
+
+        with time_stage(metrics, "load_models"):
+            classifier_pool = define_classifier_pool(model, backend = args.backend, processes = processes, threads = threads)
+        print(f"Classifying on {classifier_pool['processes']} processes x {classifier_pool['threads']} threads")
+
+    # start timing the classification
+    start_time = time.perf_counter()
+
+    if not text_chunks:
+        classifications = []
+
+    elif label_cache is not None:
+        # only classify text that is not in the label cache
+        classifications = classify_cached(text_chunks, classifier, label_cache, batch_size = args.batch_size, sequential = args.sequential,
+                                          classifier_pool = classifier_pool, lookup = lookup)
+
+    elif args.sequential:
+        # classify one chunk at a time
+        classifications = classify_transcript(tqdm(text_chunks), classifier)
+
+    elif classifier_pool is not None:
+        # classify length-bucketed batches on the pool
+        classifications = classify_parallel(text_chunks, classifier_pool, batch_size = args.batch_size)
+
+    else:
+        # classify chunks from all channels in length-bucketed batches
+        classifications = classify_batched(text_chunks, classifier, batch_size = args.batch_size)
+
+    # stop timing the classification, then stop the pool
+    seconds = time.perf_counter() - start_time
+    if classifier_pool is not None:
+        close_classifier_pool(classifier_pool)
+
+    # report throughput and label cache hits
+    report_throughput(len(text_chunks), seconds)
+    add_time(metrics, "classify", seconds)
+    count(metrics, "chunks_classified", len(text_chunks))
+    if text_chunks and label_cache is not None:
+        report_label_cache(label_cache)
+        count(metrics, "label_cache_hits", label_cache["hits"])
+        count(metrics, "label_cache_misses", label_cache["misses"])
+
+    # save classified chunks
+    chunks["label"] = chunks["label"].astype("string")
+    chunks.loc[unlabeled, "label"] = pd.Series(classifications, index = chunks.index[unlabeled], dtype = "string")
+    count(metrics, "chunks_toxic", int((chunks["label"] == "toxic").sum()))
+    with time_stage(metrics, "save"):
+        write_table(chunks, classified_path)
+
+    # calculate toxicity aggregates per channel and save summary
+    with time_stage(metrics, "aggregate"):
+        channels = pd.read_csv(inpath / "top-youtubers-raw.csv")
+        summary = summarize_chunks(chunks, channels)
+    with time_stage(metrics, "save"):
+        write_table(summary, summary_path)
+
+        # save data in CSV export format
+        data = classified_export(chunks, channels)
+        data.to_csv(outpath / "top-youtubers-classified.csv", index = False)
+
+    # write run report
+    write_run_report(metrics, args.metrics_path, args.prometheus)
 
 
 if __name__ == "__main__":
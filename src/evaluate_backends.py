@@ -0,0 +1,233 @@
+""" evaluate_backends.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Compares the CPU inference backends of the toxicity classifier and the Whisper transcriber (see backends.py).
+
+    For every classifier backend, it runs a parity check and a benchmark:
+        1. Parity: chunks in out/top-youtubers-classified.csv are classified again and compared with the reference labels in that file.
+        2. Benchmark: chunks/sec when classifying the chunks in length-bucketed batches.
+    The report is printed and saved to out/classifier-backends.csv, so the fastest backend that stays accurate enough can be picked.
+
+    For every transcriber backend and number of intra-op threads, it measures the real-time factor (seconds spent transcribing
+    per second of audio, lower is faster) on a fixed local audio file. Without --fixture, a deterministic fixture of speech-like
+    noise is generated (see benchmark.py) in cache/fixtures, so the report is reproducible. The report is saved to out/transcriber-backends.csv.
+
+Usage:
+    $ python src/evaluate_backends.py --backends pytorch int8 onnx --batch_size 32
+    $ python src/evaluate_backends.py --component asr --backends pytorch int8 onnx --threads 1 2 4
+    $ python src/evaluate_backends.py --component asr --fixture path/to/fixture.wav
+"""
+
+from pathlib import Path
+from backends import build_classifier, build_transcriber
+from benchmark import write_wav_fixture
+from cache import define_cache_path
+from classifier import classify_batched
+from transcriber import decode_audio, transcribe_batch
+import pandas as pd
+import argparse
+import ast
+import random
+import time
+
+
+def arg_parse():
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - Whether to evaluate the classifier or the transcriber
+    - The backends to evaluate
+    - The number of chunks (or 30 second windows) processed in one forward pass
+    - The number of reference chunks to evaluate on
+    - The audio file, Whisper model and intra-op thread counts to evaluate the transcriber on
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Compare labels and speed of classifier and transcriber backends')
+
+    # add arguments
+    parser.add_argument('-c', '--component', default="classifier", choices=["classifier", "asr"], help='Whether to evaluate the classifier or the transcriber')
+    parser.add_argument('--backends', nargs='+', default=["pytorch", "int8", "onnx"], help='Backends to evaluate')
+    parser.add_argument('-b', '--batch_size', default=None, type=int, help='Number of chunks (default: 32) or 30 second windows (default: 1) processed in one forward pass')
+    parser.add_argument('-n', '--n_chunks', default=None, type=int, help='Number of reference chunks to evaluate on (default: all)')
+    parser.add_argument('-f', '--fixture', default=None, help='Local audio file to measure the real-time factor of the transcriber on (default: a generated fixture)')
+    parser.add_argument('--fixture_seconds', default=120, type=int, help='Length of the generated fixture in seconds')
+    parser.add_argument('-m', '--model', default="openai/whisper-base.en", help='Whisper model to evaluate')
+    parser.add_argument('-t', '--threads', nargs='+', type=int, default=[None], help='Intra-op thread counts to evaluate the transcriber with (default: torch default)')
+
+    # parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+def load_reference(reference_path, n_chunks=None):
+    """
+    Loads chunks and their reference labels from the classified CSV file.
+    The file only stores the toxic chunks of every channel, so all other chunks of the channel are non-toxic.
+
+    Args:
+        reference_path (pathlib.PosixPath): Path to the classified CSV file
+        n_chunks (int): Number of chunks to sample, None for all chunks
+
+    Returns:
+        text_chunks (list): List of text chunks
+        reference_labels (list): List of reference labels
+    """
+
+    # load chunks and toxic chunks of every channel
+    data = pd.read_csv(reference_path, usecols=["transcript_chunks", "toxic_comments"])
+
+    text_chunks = []
+    reference_labels = []
+
+    for _, row in data.iterrows():
+        transcript_chunks = ast.literal_eval(row["transcript_chunks"]) if isinstance(row["transcript_chunks"], str) else []
+        toxic_comments = set(ast.literal_eval(row["toxic_comments"])) if isinstance(row["toxic_comments"], str) else set()
+
+        for text_chunk in transcript_chunks:
+            text_chunks.append(text_chunk)
+            reference_labels.append("toxic" if text_chunk in toxic_comments else "non-toxic")
+
+    # sample chunks, with a fixed seed so every backend sees the same chunks
+    if n_chunks is not None and n_chunks < len(text_chunks):
+        sample = sorted(random.Random(1).sample(range(len(text_chunks)), n_chunks))
+        text_chunks = [text_chunks[i] for i in sample]
+        reference_labels = [reference_labels[i] for i in sample]
+
+    return text_chunks, reference_labels
+
+
+def evaluate_backend(backend, text_chunks, reference_labels, batch_size):
+    """
+    Runs the parity check and benchmark of a single backend.
+
+    Args:
+        backend (str): Name of the backend
+        text_chunks (list): List of text chunks
+        reference_labels (list): List of reference labels
+        batch_size (int): Number of chunks classified in one forward pass
+
+    Returns:
+        result (dict): Dict with load time, chunks/sec, number and share of labels that disagree with the reference
+    """
+
+    # initialize classifier
+    start_time = time.perf_counter()
+    classifier = build_classifier(backend = backend)
+    load_seconds = time.perf_counter() - start_time
+
+    # warm up, so one-off costs are not part of the benchmark
+    classify_batched(text_chunks[:batch_size], classifier, batch_size = batch_size)
+
+    # classify all chunks
+    start_time = time.perf_counter()
+    labels = classify_batched(text_chunks, classifier, batch_size = batch_size)
+    seconds = time.perf_counter() - start_time
+
+    # count labels that disagree with the reference
+    n_disagree = sum(label != reference for label, reference in zip(labels, reference_labels))
+
+    return {"backend": backend,
+            "load_seconds": round(load_seconds, 2),
+            "chunks_per_sec": round(len(text_chunks) / seconds, 1) if seconds > 0 else 0.0,
+            "n_chunks": len(text_chunks),
+            "n_disagree": n_disagree,
+            "pct_disagree": round(n_disagree / len(text_chunks), 4) if text_chunks else 0.0}
+
+
+def evaluate_transcriber(model, backend, audio, intra_threads, batch_size):
+    """
+    Measures the real-time factor of a single transcriber backend with a given number of intra-op threads.
+
+    Args:
+        model (str): Name of the Whisper model
+        backend (str): Name of the backend
+        audio (np.ndarray): Array of 16 kHz mono float32 samples
+        intra_threads (int): Number of threads used within an op, None for the torch default
+        batch_size (int): Number of 30 second windows decoded in one forward pass
+
+    Returns:
+        result (dict): Dict with load time, transcription time and real-time factor
+    """
+
+    # initialize transcriber
+    start_time = time.perf_counter()
+    transcriber = build_transcriber(model, backend = backend, intra_threads = intra_threads)
+    load_seconds = time.perf_counter() - start_time
+
+    # warm up on the first window, so one-off costs are not part of the measurement
+    transcribe_batch([{"raw": audio[:30 * 16000].copy(), "sampling_rate": 16000}], transcriber, batch_size = batch_size)
+
+    # transcribe the whole fixture
+    start_time = time.perf_counter()
+    transcribe_batch([{"raw": audio.copy(), "sampling_rate": 16000}], transcriber, batch_size = batch_size)
+    seconds = time.perf_counter() - start_time
+
+    # real-time factor is seconds spent per second of audio
+    audio_seconds = len(audio) / 16000
+
+    return {"backend": backend,
+            "intra_threads": intra_threads if intra_threads is not None else "default",
+            "load_seconds": round(load_seconds, 2),
+            "audio_seconds": round(audio_seconds, 1),
+            "seconds": round(seconds, 2),
+            "real_time_factor": round(seconds / audio_seconds, 4) if audio_seconds > 0 else 0.0}
+
+
+def main():
+    args = arg_parse()
+
+    # define paths
+    outpath = Path(__file__).parents[1] / "out"
+
+    if args.component == "asr":
+        # generate a deterministic fixture once, unless a local audio file is given
+        if args.fixture is None:
+            fixture_path = define_cache_path("fixtures") / f"fixture-{args.fixture_seconds}s.wav"
+            if not fixture_path.exists():
+                write_wav_fixture(fixture_path, args.fixture_seconds)
+        else:
+            fixture_path = Path(args.fixture)
+            if not fixture_path.exists():
+                raise FileNotFoundError(f"Audio fixture not found: {fixture_path}")
+
+        # load the audio fixture into memory
+        print(f"Measuring on {fixture_path}...")
+        audio = decode_audio(str(fixture_path))
+
+        # evaluate every backend with every number of threads
+        results = []
+        for backend in args.backends:
+            for intra_threads in args.threads:
+                print(f"Evaluating {backend} backend with {intra_threads or 'default'} intra-op threads...")
+                results.append(evaluate_transcriber(args.model, backend, audio, intra_threads, args.batch_size or 1))
+
+        report_path = outpath / "transcriber-backends.csv"
+
+    else:
+        # load reference chunks and labels
+        print("Loading reference labels...")
+        text_chunks, reference_labels = load_reference(outpath / "top-youtubers-classified.csv", n_chunks = args.n_chunks)
+
+        # evaluate every backend
+        results = []
+        for backend in args.backends:
+            print(f"Evaluating {backend} backend...")
+            results.append(evaluate_backend(backend, text_chunks, reference_labels, args.batch_size or 32))
+
+        report_path = outpath / "classifier-backends.csv"
+
+    # print and save report
+    report = pd.DataFrame(results)
+    print(report.to_string(index = False))
+    report.to_csv(report_path, index = False)
+
+
+if __name__ == "__main__":
+    main()
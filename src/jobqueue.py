@@ -0,0 +1,332 @@
+""" jobqueue.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Provides a durable job queue for worker.py, so channels can be processed by any number of worker processes, on one host
+    or on several hosts that share a filesystem. The queue is a single SQLite file and needs no services.
+
+    Every job has a kind (e.g. "channel" or "video"), a JSON payload and a state:
+        pending  ----->  running  ----->  done
+                            |
+                            +----->  pending (retried)  or  failed (after max_attempts)
+
+    A worker that claims a job holds a lease on it, which it extends with heartbeats while working. If a worker crashes,
+    its lease expires and the job is handed to the next worker that claims work. A worker that lost its lease can no longer
+    finish or fail the job, so work is only ever recorded once, although it may be done twice.
+
+    The queue uses SQLite's default rollback journal (not WAL, which needs shared memory and only works on one host), and
+    claims happen in IMMEDIATE transactions, so two workers never claim the same job. Shared filesystems must support POSIX locks.
+"""
+
+from contextlib import closing, contextmanager
+from cache import cache_key
+import json
+import sqlite3
+import threading
+import time
+
+
+def define_job_queue(queue_path):
+    """
+    Creates the table of a job queue if it doesn't exist.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+
+    Returns:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+    """
+
+    queue_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # create table if it doesn't exist
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn, conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            job_id TEXT PRIMARY KEY,
+                            kind TEXT,
+                            payload TEXT,
+                            state TEXT,
+                            attempts INTEGER,
+                            worker TEXT,
+                            lease_until REAL,
+                            heartbeat_at REAL,
+                            result TEXT,
+                            error TEXT,
+                            created_at REAL,
+                            updated_at REAL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, kind, created_at)")
+
+    return queue_path
+
+
+def add_jobs(queue_path, kind, jobs):
+    """
+    Adds jobs to the queue. Jobs that are already in the queue (with the same kind and key) are left as they are,
+    so adding the same jobs again, e.g. from a worker that lost its lease, does nothing.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        kind (str): Kind of the jobs, e.g. "channel"
+        jobs (list): List of (key, payload) tuples, where the key identifies the job within its kind and the payload is JSON-serializable
+
+    Returns:
+        n_added (int): Number of jobs that were new
+    """
+
+    now = time.time()
+
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn, conn:
+        n_before = conn.total_changes
+        conn.executemany("""INSERT OR IGNORE INTO jobs (job_id, kind, payload, state, attempts, created_at, updated_at)
+                            VALUES (?, ?, ?, 'pending', 0, ?, ?)""",
+                         [(cache_key(kind, key), kind, json.dumps(payload), now, now) for key, payload in jobs])
+
+        return conn.total_changes - n_before
+
+
+def recover_expired(conn, max_attempts=3):
+    """
+    Hands jobs whose lease expired (e.g. because their worker crashed) back to the queue, or fails them after max_attempts.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the queue, within a transaction
+        max_attempts (int): Max number of times a job is claimed
+
+    Returns:
+        n_recovered (int): Number of jobs whose lease expired
+    """
+
+    now = time.time()
+
+    cursor = conn.execute("""UPDATE jobs SET
+                                 state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                                 error = 'lease of worker ' || worker || ' expired',
+                                 worker = NULL,
+                                 lease_until = NULL,
+                                 updated_at = ?
+                             WHERE state = 'running' AND lease_until < ?""",
+                          (max_attempts, now, now))
+
+    return cursor.rowcount
+
+
+def claim_job(queue_path, worker, kinds=None, lease_s=300, max_attempts=3):
+    """
+    Claims the oldest pending job, after handing expired leases back to the queue.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        worker (str): Id of the worker, e.g. host name and process id
+        kinds (list): List of kinds of jobs the worker takes, None to take all kinds
+        lease_s (float): Seconds the job is leased for, until a heartbeat extends it
+        max_attempts (int): Max number of times a job is claimed
+
+    Returns:
+        job (dict): Dict with job_id, kind, payload and attempts of the job, None if no job is pending
+    """
+
+    now = time.time()
+
+    with closing(sqlite3.connect(queue_path, timeout=30, isolation_level=None)) as conn:
+        # take the write lock upfront, so no other worker claims the same job in between
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            recover_expired(conn, max_attempts)
+
+            # find oldest pending job of the given kinds
+            query = "SELECT job_id, kind, payload, attempts FROM jobs WHERE state = 'pending'"
+            params = []
+            if kinds:
+                query += f" AND kind IN ({','.join('?' * len(kinds))})"
+                params += list(kinds)
+            row = conn.execute(query + " ORDER BY created_at, rowid LIMIT 1", params).fetchone()
+
+            if row is not None:
+                conn.execute("""UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, heartbeat_at = ?, updated_at = ?
+                                WHERE job_id = ?""",
+                             (worker, now + lease_s, now, now, row[0]))
+
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    if row is None:
+        return None
+
+    return {"job_id": row[0], "kind": row[1], "payload": json.loads(row[2]), "attempts": row[3] + 1, "worker": worker}
+
+
+def heartbeat(queue_path, job, lease_s=300):
+    """
+    Extends the lease of a running job.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        job (dict): Job from claim_job
+        lease_s (float): Seconds the lease is extended to, from now
+
+    Returns:
+        held (bool): Whether the worker still holds the lease, False if it expired and the job was handed to another worker
+    """
+
+    now = time.time()
+
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn, conn:
+        cursor = conn.execute("""UPDATE jobs SET lease_until = ?, heartbeat_at = ?, updated_at = ?
+                                 WHERE job_id = ? AND worker = ? AND state = 'running'""",
+                              (now + lease_s, now, now, job["job_id"], job["worker"]))
+
+        return cursor.rowcount == 1
+
+
+@contextmanager
+def keep_alive(queue_path, job, lease_s=300):
+    """
+    Sends heartbeats for a job from a background thread while the block runs, three per lease.
+    If the lease is lost, job["lost"] is set to True, so the worker can stop early.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        job (dict): Job from claim_job
+        lease_s (float): Seconds the job is leased for
+    """
+
+    stop_event = threading.Event()
+    job["lost"] = False
+
+    def beat():
+        while not stop_event.wait(lease_s / 3):
+            try:
+                if not heartbeat(queue_path, job, lease_s):
+                    job["lost"] = True
+                    return
+            except sqlite3.Error:
+                # e.g. the database is locked for too long, the next heartbeat tries again
+                continue
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+
+    try:
+        yield job
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def finish_job(queue_path, job, result=None):
+    """
+    Marks a running job as done and stores its result.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        job (dict): Job from claim_job
+        result: JSON-serializable result of the job
+
+    Returns:
+        finished (bool): Whether the job was marked as done, False if the worker lost its lease
+    """
+
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn, conn:
+        cursor = conn.execute("""UPDATE jobs SET state = 'done', result = ?, error = NULL, lease_until = NULL, updated_at = ?
+                                 WHERE job_id = ? AND worker = ? AND state = 'running'""",
+                              (json.dumps(result), time.time(), job["job_id"], job["worker"]))
+
+        return cursor.rowcount == 1
+
+
+def fail_job(queue_path, job, error, max_attempts=3, retry=True):
+    """
+    Hands a running job back to the queue after an error, or marks it as failed after max_attempts.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        job (dict): Job from claim_job
+        error (str): Error message of the job
+        max_attempts (int): Max number of times a job is claimed
+        retry (bool): Whether the job may be retried, False for errors that will not go away (e.g. an unavailable video)
+
+    Returns:
+        failed (bool): Whether the job was handed back or marked as failed, False if the worker lost its lease
+    """
+
+    state = "pending" if retry and job["attempts"] < max_attempts else "failed"
+
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn, conn:
+        cursor = conn.execute("""UPDATE jobs SET state = ?, error = ?, worker = NULL, lease_until = NULL, updated_at = ?
+                                 WHERE job_id = ? AND worker = ? AND state = 'running'""",
+                              (state, error, time.time(), job["job_id"], job["worker"]))
+
+        return cursor.rowcount == 1
+
+
+def retry_failed(queue_path, kinds=None):
+    """
+    Hands failed jobs back to the queue with a fresh number of attempts, e.g. after YouTube blocked a host for a while.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        kinds (list): List of kinds of jobs to retry, None to retry all kinds
+
+    Returns:
+        n_retried (int): Number of jobs handed back
+    """
+
+    query = "UPDATE jobs SET state = 'pending', attempts = 0, updated_at = ? WHERE state = 'failed'"
+    params = [time.time()]
+    if kinds:
+        query += f" AND kind IN ({','.join('?' * len(kinds))})"
+        params += list(kinds)
+
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn, conn:
+        return conn.execute(query, params).rowcount
+
+
+def queue_counts(queue_path):
+    """
+    Counts the jobs of every kind in every state.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+
+    Returns:
+        counts (dict): Dict from kind to a dict from state to number of jobs
+    """
+
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn:
+        rows = conn.execute("SELECT kind, state, COUNT(*) FROM jobs GROUP BY kind, state").fetchall()
+
+    counts = {}
+    for kind, state, n_jobs in rows:
+        counts.setdefault(kind, {})[state] = n_jobs
+
+    return counts
+
+
+def read_jobs(queue_path, kind, states=None):
+    """
+    Reads the jobs of a kind with their results, e.g. to merge the results of all workers.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the SQLite database
+        kind (str): Kind of the jobs
+        states (list): List of states of the jobs to read, None to read jobs in every state
+
+    Returns:
+        jobs (list): List of dicts with job_id, state, payload, result, error and attempts of every job, oldest first
+    """
+
+    query = "SELECT job_id, state, payload, result, error, attempts FROM jobs WHERE kind = ?"
+    params = [kind]
+    if states:
+        query += f" AND state IN ({','.join('?' * len(states))})"
+        params += list(states)
+
+    with closing(sqlite3.connect(queue_path, timeout=30)) as conn:
+        rows = conn.execute(query + " ORDER BY created_at, rowid", params).fetchall()
+
+    return [{"job_id": job_id, "state": state, "payload": json.loads(payload), "result": json.loads(result) if result is not None else None,
+             "error": error, "attempts": attempts}
+            for job_id, state, payload, result, error, attempts in rows]
@@ -0,0 +1,223 @@
+""" metrics.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Collects per-stage metrics of a SafeTuber run, so it is visible where the time of a long run went:
+        - Wall time of every step (load, list, download, transcribe, clean, classify, merge, save)
+        - Videos listed, probed, rejected (too long, too short, no duration, errors, known unavailable), downloaded, cached and kept by a refresh
+        - Seconds of audio transcribed, the share skipped by voice-activity detection and the real-time factor of the transcriber
+        - Chunks before and after cleaning, and chunks/sec of the classifier
+
+    Metrics are kept in a plain dict that is passed to the functions that are instrumented (None disables them), and are
+    exported as a JSON run report and optionally as a Prometheus textfile (for the node_exporter textfile collector).
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import threading
+import time
+
+
+def define_metrics(script):
+    """
+    Defines the metrics of a run.
+
+    Args:
+        script (str): Name of the script that is run, e.g. "transcriber"
+
+    Returns:
+        metrics (dict): Dict with the script, start time, stage timings, counters and a lock shared by the pipeline threads
+    """
+
+    return {"script": script, "started_at": time.time(), "stages": {}, "counters": {}, "lock": threading.Lock()}
+
+
+def count(metrics, name, n=1):
+    """
+    Increments a counter. Safe to call from several threads.
+
+    Args:
+        metrics (dict): Metrics from define_metrics, None to not count
+        name (str): Name of the counter, e.g. "videos_downloaded"
+        n (float): Amount to add
+    """
+
+    if metrics is None:
+        return
+
+    with metrics["lock"]:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + n
+
+
+def add_time(metrics, stage, seconds):
+    """
+    Adds wall time to a stage. Stages that run many times (e.g. once per video) add up.
+
+    Args:
+        metrics (dict): Metrics from define_metrics, None to not time
+        stage (str): Name of the stage, e.g. "download"
+        seconds (float): Seconds spent in the stage
+    """
+
+    if metrics is None:
+        return
+
+    with metrics["lock"]:
+        metrics["stages"][stage] = metrics["stages"].get(stage, 0.0) + seconds
+
+
+@contextmanager
+def time_stage(metrics, stage):
+    """
+    Times the wall time of the code in the with block and adds it to a stage.
+
+    Args:
+        metrics (dict): Metrics from define_metrics, None to not time
+        stage (str): Name of the stage, e.g. "download"
+    """
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(metrics, stage, time.perf_counter() - start_time)
+
+
+def run_report(metrics):
+    """
+    Creates the report of a run, adding rates derived from the counters and stage timings.
+    Stages of the pipeline overlap, so their wall times may add up to more than the total wall time.
+
+    Args:
+        metrics (dict): Metrics from define_metrics
+
+    Returns:
+        report (dict): JSON-serializable report of the run
+    """
+
+    with metrics["lock"]:
+        stages = {stage: round(seconds, 3) for stage, seconds in metrics["stages"].items()}
+        counters = dict(metrics["counters"])
+
+    # seconds spent transcribing per second of audio, lower is faster
+    rates = {}
+    if counters.get("audio_seconds"):
+        rates["asr_real_time_factor"] = round(stages.get("transcribe", 0.0) / counters["audio_seconds"], 4)
+
+    # share of audio skipped by voice-activity detection
+    if counters.get("audio_seconds") and "speech_seconds" in counters:
+        rates["pct_audio_skipped"] = round(1 - counters["speech_seconds"] / counters["audio_seconds"], 4)
+
+    # share of chunks removed by cleaning
+    if counters.get("chunks_raw"):
+        rates["pct_chunks_removed"] = round(1 - counters.get("chunks_clean", 0) / counters["chunks_raw"], 4)
+
+    # share of videos kept from earlier runs by an incremental refresh, i.e. work that was not done again
+    if counters.get("videos_known"):
+        rates["pct_videos_kept"] = round(counters["videos_known"] / (counters["videos_known"] + counters.get("videos_downloaded", 0) + counters.get("videos_cached", 0)), 4)
+
+    # classifier throughput
+    if stages.get("classify"):
+        rates["classifier_chunks_per_sec"] = round(counters.get("chunks_classified", 0) / stages["classify"], 1)
+
+    return {"script": metrics["script"],
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(metrics["started_at"])),
+            "wall_seconds": round(time.time() - metrics["started_at"], 3),
+            "stages": stages,
+            "counters": counters,
+            "rates": rates}
+
+
+def write_atomic(file_path, text):
+    """
+    Writes a text file to a temporary file first and then moves it in place, so readers (e.g. node_exporter) never see a half-written file.
+
+    Args:
+        file_path (pathlib.PosixPath): Path to the file
+        text (str): Content of the file
+    """
+
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+    os.replace(tmp_path, file_path)
+
+
+def prometheus_text(report):
+    """
+    Formats a run report in the Prometheus text exposition format.
+
+    Args:
+        report (dict): Report from run_report
+
+    Returns:
+        text (str): Metrics with one sample per line
+    """
+
+    script = report["script"]
+    lines = ["# HELP safetuber_run_wall_seconds Wall time of the whole run.",
+             "# TYPE safetuber_run_wall_seconds gauge",
+             f'safetuber_run_wall_seconds{{script="{script}"}} {report["wall_seconds"]}',
+             "# HELP safetuber_stage_seconds Wall time spent in a stage of the run.",
+             "# TYPE safetuber_stage_seconds gauge"]
+    lines += [f'safetuber_stage_seconds{{script="{script}",stage="{stage}"}} {seconds}' for stage, seconds in report["stages"].items()]
+
+    # counters and rates are exported under their own name
+    for name, value in list(report["counters"].items()) + list(report["rates"].items()):
+        lines += [f"# TYPE safetuber_{name} gauge", f'safetuber_{name}{{script="{script}"}} {value}']
+
+    lines += ["# TYPE safetuber_run_finished_timestamp_seconds gauge",
+              f'safetuber_run_finished_timestamp_seconds{{script="{script}"}} {round(time.time(), 3)}']
+
+    return "\n".join(lines) + "\n"
+
+
+def write_run_report(metrics, report_path, prometheus_path=None):
+    """
+    Writes the JSON run report and optionally the Prometheus textfile, and prints a short summary.
+
+    Args:
+        metrics (dict): Metrics from define_metrics
+        report_path (pathlib.PosixPath): Path to the JSON run report
+        prometheus_path (pathlib.PosixPath): Path to the Prometheus textfile (should end in .prom), None to not write it
+
+    Returns:
+        report (dict): Report of the run
+    """
+
+    report = run_report(metrics)
+
+    write_atomic(Path(report_path), json.dumps(report, indent=2))
+    if prometheus_path:
+        write_atomic(Path(prometheus_path), prometheus_text(report))
+
+    # print summary
+    print(f"Run took {report['wall_seconds']:.1f} s: " + ", ".join(f"{stage} {seconds:.1f} s" for stage, seconds in report["stages"].items()))
+    for name, value in report["rates"].items():
+        print(f"    {name}: {value}")
+    print(f"Run report saved to {report_path}")
+
+    return report
+
+
+def define_report_path(script):
+    """
+    Defines the default path to the JSON run report of a script.
+
+    Args:
+        script (str): Name of the script, e.g. "transcriber"
+
+    Returns:
+        report_path (pathlib.PosixPath): Path to the run report
+    """
+
+    # define path
+    path = Path(__file__)
+
+    return path.parents[1] / "out" / "metrics" / f"{script}-run.json"
@@ -0,0 +1,215 @@
+""" prepare_models.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Writes local snapshots of the models used by SafeTuber to models/, so the pipelines start faster.
+    Snapshots are stored as safetensors, which are memory-mapped instead of unpickled, and are loaded with low_cpu_mem_usage
+    (when accelerate is installed), so weights are not first initialized randomly and then overwritten.
+    The pytorch and int8 backends (see backends.py) load a snapshot when it exists and fall back to the HuggingFace hub otherwise.
+
+    Afterwards, the start time of every model is measured in fresh processes:
+        - cold_seconds: importing transformers and loading the model in a new process
+        - warm_seconds: loading the model again in the same process (files in the OS page cache, packages imported)
+    both before (from the HuggingFace hub cache) and after (from the local snapshot), together with the time of
+    single_classify.py --help, which does not import any heavy package.
+    The report is printed and saved to out/model-startup.csv.
+
+Usage:
+    $ python src/prepare_models.py
+    $ python src/prepare_models.py --models openai/whisper-base.en --force
+"""
+
+from pathlib import Path
+from backends import define_snapshot_path
+from transformers import AutoConfig, AutoProcessor, AutoTokenizer, AutoModelForSequenceClassification, AutoModelForSpeechSeq2Seq
+import pandas as pd
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import time
+
+
+# loads a model twice in a fresh process and prints the cold and warm start times
+TIMING_SCRIPT = """
+import json, time
+start_time = time.perf_counter()
+{imports}
+load = lambda: {load}
+load()
+cold_seconds = time.perf_counter() - start_time
+start_time = time.perf_counter()
+load()
+print(json.dumps({{"cold_seconds": cold_seconds, "warm_seconds": time.perf_counter() - start_time}}))
+"""
+
+
+def arg_parse():
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - The models to write snapshots of
+    - Whether to overwrite existing snapshots
+    - Whether to skip measuring start times
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Write local model snapshots for fast loading and report start times')
+
+    # add arguments
+    parser.add_argument('-m', '--models', nargs='+', default=["openai/whisper-base.en", "martin-ha/toxic-comment-model"], help='Models on the HuggingFace hub to write snapshots of')
+    parser.add_argument('--force', action='store_true', help='Overwrite existing snapshots')
+    parser.add_argument('--skip_timing', action='store_true', help='Only write snapshots, without measuring start times')
+
+    # parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+def is_whisper(model):
+    """
+    Checks whether a model is a Whisper transcriber, as opposed to a text classifier.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+
+    Returns:
+        is_whisper (bool): Whether the model is a Whisper model
+    """
+
+    return AutoConfig.from_pretrained(model).model_type == "whisper"
+
+
+def write_snapshot(model, force=False):
+    """
+    Writes the weights of a model as safetensors, together with its config and tokenizer (or processor).
+    The snapshot is written to a temporary folder first and then moved in place, so a half-written snapshot is never loaded.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+        force (bool): Whether to overwrite an existing snapshot
+
+    Returns:
+        snapshot_path (pathlib.PosixPath): Path to the snapshot
+    """
+
+    snapshot_path = define_snapshot_path(model)
+
+    if (snapshot_path / "config.json").exists() and not force:
+        print(f"Snapshot of {model} already exists at {snapshot_path}")
+        return snapshot_path
+
+    # load model and preprocessing from the hub
+    if is_whisper(model):
+        model_object = AutoModelForSpeechSeq2Seq.from_pretrained(model)
+        preprocessor = AutoProcessor.from_pretrained(model)
+    else:
+        model_object = AutoModelForSequenceClassification.from_pretrained(model)
+        preprocessor = AutoTokenizer.from_pretrained(model)
+
+    # write snapshot
+    tmp_path = snapshot_path.with_name(f"{snapshot_path.name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    model_object.save_pretrained(tmp_path, safe_serialization=True)
+    preprocessor.save_pretrained(tmp_path)
+
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    tmp_path.rename(snapshot_path)
+
+    print(f"Wrote snapshot of {model} to {snapshot_path}")
+
+    return snapshot_path
+
+
+def time_start(imports, load):
+    """
+    Measures the cold and warm start time of a model in a fresh Python process.
+
+    Args:
+        imports (str): Import statements run before loading
+        load (str): Expression that loads the model
+
+    Returns:
+        timing (dict): Dict with cold and warm start time in seconds
+    """
+
+    output = subprocess.run([sys.executable, "-c", TIMING_SCRIPT.format(imports = imports, load = load)],
+                            cwd = Path(__file__).parent, capture_output = True, text = True, check = True).stdout
+
+    # the timing is the last line, anything printed while loading comes before it
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def time_model(model):
+    """
+    Measures the start time of a model before (from the HuggingFace hub cache) and after (from the local snapshot).
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+
+    Returns:
+        results (list): List of dicts with model, source, cold and warm start time
+    """
+
+    task = "automatic-speech-recognition" if is_whisper(model) else "text-classification"
+    builder = "build_transcriber" if task == "automatic-speech-recognition" else "build_classifier"
+
+    timings = {"hub": time_start("from transformers import pipeline", f"pipeline({task!r}, model = {model!r})"),
+               "snapshot": time_start(f"from backends import {builder}", f"{builder}({model!r})")}
+
+    return [{"model": model,
+             "source": source,
+             "cold_seconds": round(timing["cold_seconds"], 2),
+             "warm_seconds": round(timing["warm_seconds"], 2)} for source, timing in timings.items()]
+
+
+def time_cli():
+    """
+    Measures the time of single_classify.py --help, i.e. of parsing arguments without importing any heavy package.
+
+    Returns:
+        seconds (float): Wall time of the command in seconds
+    """
+
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, str(Path(__file__).parent / "single_classify.py"), "--help"], capture_output = True, check = True)
+
+    return time.perf_counter() - start_time
+
+
+def main():
+    args = arg_parse()
+
+    # write snapshots
+    for model in args.models:
+        write_snapshot(model, force = args.force)
+
+    if args.skip_timing:
+        return
+
+    # measure start times before and after
+    results = []
+    for model in args.models:
+        print(f"Measuring start time of {model}...")
+        results.extend(time_model(model))
+
+    cli_seconds = time_cli()
+    results.append({"model": "single_classify.py --help", "source": "cli", "cold_seconds": round(cli_seconds, 2), "warm_seconds": None})
+
+    # print and save report
+    report = pd.DataFrame(results)
+    print(report.to_string(index = False))
+
+    report_path = Path(__file__).parents[1] / "out" / "model-startup.csv"
+    report.to_csv(report_path, index = False)
+    print(f"Report saved to {report_path}")
+
+
+if __name__ == "__main__":
+    main()
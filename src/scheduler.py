@@ -0,0 +1,376 @@
+""" scheduler.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Provides a core-aware pool of classifier processes for classifier.py, for hosts with many CPU cores.
+    A single text-classification pipeline in one process leaves most cores idle, or lets torch's default thread pool spread
+    over all cores where threads fight over caches. Instead, every worker process in the pool:
+        - is pinned to its own slice of neighbouring cores (with os.sched_setaffinity, on Linux)
+        - uses as many torch threads as it has cores, and a single inter-op thread
+        - loads the classifier once
+    Chunks are sorted by length and sent to the workers in batches, and the labels are returned in the order of the chunks.
+    If a worker process dies (e.g. killed for running out of memory), the pool breaks and classifying fails with BrokenProcessPool
+    instead of waiting for the batch forever.
+
+    How to split the cores of a host into processes x threads is auto-tuned: every split is timed on a sample of the chunks,
+    the scaling curve is printed and saved to out/metrics/classifier-scaling.csv, and the fastest split is cached per host,
+    model, backend and batch size in cache/scheduler, so later runs reuse it. Every process holds its own copy of the model in memory,
+    so splits are only tried while their processes fit in the available memory (measured with one process, on Linux).
+"""
+
+from pathlib import Path
+from backends import build_classifier, set_threads
+from cache import define_cache_path, cache_key, read_json_cache, write_json_cache
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import pandas as pd
+import os
+import random
+import socket
+import time
+
+
+# classifier of a worker process, set by init_worker
+WORKER = {}
+
+
+def available_cores():
+    """
+    Lists the CPU cores this process may run on.
+
+    Returns:
+        cores (list): Sorted list of core ids
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+
+def available_memory():
+    """
+    Gets the memory available for new processes without swapping (MemAvailable in /proc/meminfo, on Linux).
+
+    Returns:
+        n_bytes (int): Available memory in bytes, None if it can't be read
+    """
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def core_slices(cores, processes, threads):
+    """
+    Splits cores into one slice of neighbouring cores per process. Neighbouring core ids usually share caches (and a socket).
+    If processes x threads is more than the number of cores, slices wrap around and share cores.
+
+    Args:
+        cores (list): List of core ids
+        processes (int): Number of processes
+        threads (int): Number of cores per process
+
+    Returns:
+        slices (list): List with the core ids of every process
+    """
+
+    return [[cores[(i * threads + j) % len(cores)] for j in range(threads)] for i in range(processes)]
+
+
+def init_worker(model, backend, slices, n_started, threads):
+    """
+    Initializes a worker process of the pool: pins it to a slice of cores, matches the torch thread count and loads the classifier.
+    Every worker takes the next slice by the number of workers started before it, so it never waits on other workers.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+        backend (str): Name of the backend, one of "pytorch", "int8" or "onnx"
+        slices (list): List with the core ids of every process
+        n_started (multiprocessing.Value): Number of workers of the pool started so far, shared by all workers
+        threads (int): Number of torch threads of the worker
+    """
+
+    with n_started.get_lock():
+        cores = slices[n_started.value % len(slices)]
+        n_started.value += 1
+
+    # pin process to its cores, threads started afterwards (e.g. by torch) inherit the affinity
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    # tokenizers would start a thread pool of their own on every core
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    set_threads(threads, 1)
+
+    WORKER["classifier"] = build_classifier(model, backend = backend)
+    WORKER["cores"] = cores
+
+
+def worker_pid(_):
+    """
+    Gets the process id of a worker process, used to wait for the pool to be ready.
+
+    Returns:
+        pid (int): Process id of the worker
+    """
+
+    return os.getpid()
+
+
+def worker_memory(_):
+    """
+    Gets the peak resident memory of a worker process (VmHWM in /proc/self/status, on Linux), i.e. its copy of the classifier
+    and the largest batch it classified so far.
+
+    Returns:
+        n_bytes (int): Peak resident memory in bytes, None if it can't be read
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def classify_bucket(text_chunks):
+    """
+    Classifies one batch of text chunks in a worker process.
+
+    Args:
+        text_chunks (list): List of text chunks of similar length
+
+    Returns:
+        classifications (list): List of classifications
+    """
+
+    return [output["label"] for output in WORKER["classifier"](text_chunks, batch_size = len(text_chunks))]
+
+
+def define_classifier_pool(model="martin-ha/toxic-comment-model", backend="pytorch", processes=1, threads=None, cores=None):
+    """
+    Starts a pool of classifier processes, each pinned to its own slice of cores, and waits until every process loaded the model.
+    Processes are spawned rather than forked, so they do not inherit the thread pools of the parent. A process that fails to load
+    the model breaks the pool (BrokenProcessPool) instead of leaving it waiting.
+
+    Args:
+        model (str): Name of the model on the HuggingFace hub
+        backend (str): Name of the backend, one of "pytorch", "int8" or "onnx"
+        processes (int): Number of worker processes
+        threads (int): Number of torch threads (and cores) per process, None to split the cores evenly
+        cores (list): List of core ids to use, None to use all cores this process may run on
+
+    Returns:
+        classifier_pool (dict): Dict with the executor of the pool, its shape and the core slices of its processes
+    """
+
+    cores = cores or available_cores()
+    threads = threads or max(len(cores) // processes, 1)
+    slices = core_slices(cores, processes, threads)
+
+    if processes * threads > len(cores):
+        print(f"{processes} processes x {threads} threads is more than the {len(cores)} cores available, processes will share cores")
+
+    # every process takes its own slice of cores as it starts
+    ctx = mp.get_context("spawn")
+    executor = ProcessPoolExecutor(processes, mp_context = ctx, initializer = init_worker, initargs = (model, backend, slices, ctx.Value("i", 0), threads))
+
+    # wait until every process loaded the model, i.e. answered a task, processes that are loaded already answer right away
+    pids = set()
+    while len(pids) < processes:
+        pids.update(executor.map(worker_pid, range(processes)))
+        if len(pids) < processes:
+            time.sleep(0.1)
+
+    return {"executor": executor, "processes": processes, "threads": threads, "slices": slices}
+
+
+def close_classifier_pool(classifier_pool):
+    """
+    Stops the processes of a classifier pool.
+
+    Args:
+        classifier_pool (dict): Classifier pool from define_classifier_pool
+    """
+
+    classifier_pool["executor"].shutdown()
+
+
+def classify_parallel(text_chunks, classifier_pool, batch_size=32):
+    """
+    Classifies text chunks as either toxic or not toxic on a classifier pool.
+    Like classify_batched, chunks are sorted by length before batching so each batch needs little padding (by characters,
+    as the tokenizer lives in the workers). Batches are handed to whichever process is free, and the classifications are
+    returned in the same order as the text chunks.
+
+    Args:
+        text_chunks (list): List of text chunks
+        classifier_pool (dict): Classifier pool from define_classifier_pool
+        batch_size (int): Number of chunks classified in one forward pass
+
+    Returns:
+        classifications (list): List of classifications
+    """
+
+    # sort chunk indices by length so that neighbouring chunks fall in the same length bucket
+    order = sorted(range(len(text_chunks)), key=lambda i: len(text_chunks[i]))
+    buckets = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+    # initialize list to scatter classifications back into
+    classifications = [None] * len(text_chunks)
+
+    # classify buckets on the pool, results arrive in the order of the buckets
+    outputs = classifier_pool["executor"].map(classify_bucket, ([text_chunks[i] for i in bucket] for bucket in buckets))
+    for bucket, labels in zip(buckets, outputs):
+        for i, label in zip(bucket, labels):
+            classifications[i] = label
+
+    return classifications
+
+
+def pool_shapes(n_cores):
+    """
+    Lists the ways to split the cores of a host into processes x threads that are tried when tuning,
+    from one process with all cores to one process per core, doubling the number of processes.
+
+    Args:
+        n_cores (int): Number of cores
+
+    Returns:
+        shapes (list): List of (processes, threads) tuples
+    """
+
+    processes = [1]
+    while processes[-1] * 2 <= n_cores:
+        processes.append(processes[-1] * 2)
+    if processes[-1] != n_cores:
+        processes.append(n_cores)
+
+    return [(n_processes, n_cores // n_processes) for n_processes in processes]
+
+
+def tune_classifier_pool(text_chunks, model="martin-ha/toxic-comment-model", backend="pytorch", batch_size=32, cores=None, n_chunks=1024, memory_fraction=0.8):
+    """
+    Times every split of the cores into processes x threads (see pool_shapes) on a sample of the chunks.
+    Every process loads its own copy of the model, so the peak memory of the single process of the first split is measured,
+    and splits with more processes than fit in memory_fraction of the available memory are not tried.
+
+    Args:
+        text_chunks (list): List of text chunks to sample from
+        model (str): Name of the model on the HuggingFace hub
+        backend (str): Name of the backend, one of "pytorch", "int8" or "onnx"
+        batch_size (int): Number of chunks classified in one forward pass
+        cores (list): List of core ids to use, None to use all cores this process may run on
+        n_chunks (int): Number of chunks timed for every split
+        memory_fraction (float): Share of the available memory the processes of a split may use
+
+    Returns:
+        curve (list): List of dicts with processes, threads, load time, chunks/sec, peak memory per process and speedup over one process of every split
+    """
+
+    cores = cores or available_cores()
+
+    # sample chunks, so long and short chunks are timed like in the full run
+    sample = random.Random(1).sample(text_chunks, min(n_chunks, len(text_chunks)))
+
+    curve = []
+    process_bytes = None
+    for processes, threads in pool_shapes(len(cores)):
+        # skip splits whose copies of the model don't fit in memory, splits further on only have more processes
+        memory = available_memory()
+        if process_bytes and memory is not None and processes * process_bytes > memory * memory_fraction:
+            print(f"Skipping {processes} processes and more: {processes} x {process_bytes / 1024**2:.0f} MB is more than {memory_fraction:.0%} of the {memory / 1024**2:.0f} MB available")
+            break
+
+        print(f"Timing {processes} processes x {threads} threads...")
+
+        start_time = time.perf_counter()
+        classifier_pool = define_classifier_pool(model, backend, processes, threads, cores)
+        load_seconds = time.perf_counter() - start_time
+
+        try:
+            # warm up every process with one batch
+            classify_parallel(sample[:processes * batch_size], classifier_pool, batch_size)
+
+            start_time = time.perf_counter()
+            classify_parallel(sample, classifier_pool, batch_size)
+            seconds = time.perf_counter() - start_time
+
+            # peak memory of a process, with the model loaded and after classifying
+            peaks = [n_bytes for n_bytes in classifier_pool["executor"].map(worker_memory, range(processes)) if n_bytes is not None]
+            if peaks and process_bytes is None:
+                process_bytes = max(peaks)
+        finally:
+            close_classifier_pool(classifier_pool)
+
+        curve.append({"processes": processes,
+                      "threads": threads,
+                      "load_seconds": round(load_seconds, 2),
+                      "chunks_per_sec": round(len(sample) / seconds, 1) if seconds > 0 else 0.0,
+                      "process_mb": round(max(peaks) / 1024**2) if peaks else None})
+
+    # speedup over one process using all cores
+    for point in curve:
+        point["speedup"] = round(point["chunks_per_sec"] / curve[0]["chunks_per_sec"], 2) if curve[0]["chunks_per_sec"] else 0.0
+
+    return curve
+
+
+def tuned_pool_shape(text_chunks, model="martin-ha/toxic-comment-model", backend="pytorch", batch_size=32, retune=False, report_path=None):
+    """
+    Finds the fastest split of the cores of this host into processes x threads, tuning it on the chunks if it is not cached yet.
+    The scaling curve of a tuning run is printed and saved.
+
+    Args:
+        text_chunks (list): List of text chunks to tune on
+        model (str): Name of the model on the HuggingFace hub
+        backend (str): Name of the backend, one of "pytorch", "int8" or "onnx"
+        batch_size (int): Number of chunks classified in one forward pass
+        retune (bool): Whether to tune again, also if a split is cached
+        report_path (pathlib.PosixPath): Path to save the scaling curve to, None for out/metrics/classifier-scaling.csv
+
+    Returns:
+        processes (int): Number of worker processes
+        threads (int): Number of torch threads per process
+    """
+
+    cores = available_cores()
+
+    # the best split depends on the host (and the cores this process may use), the model, the backend and the batch size
+    cache_file = define_cache_path("scheduler") / f"{cache_key(socket.gethostname(), cores, model, backend, batch_size)}.json"
+    shape = None if retune else read_json_cache(cache_file)
+
+    if shape is not None:
+        print(f"Using tuned split of {len(cores)} cores: {shape['processes']} processes x {shape['threads']} threads")
+        return shape["processes"], shape["threads"]
+
+    # time every split
+    curve = tune_classifier_pool(text_chunks, model, backend, batch_size, cores)
+
+    # print and save scaling curve
+    report = pd.DataFrame(curve)
+    print(report.to_string(index = False))
+
+    report_path = report_path or Path(__file__).parents[1] / "out" / "metrics" / "classifier-scaling.csv"
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report.to_csv(report_path, index = False)
+    print(f"Scaling curve saved to {report_path}")
+
+    # keep the fastest split
+    best = max(curve, key=lambda point: point["chunks_per_sec"])
+    write_json_cache(cache_file, {"processes": best["processes"], "threads": best["threads"]})
+    print(f"Fastest split of {len(cores)} cores: {best['processes']} processes x {best['threads']} threads")
+
+    return best["processes"], best["threads"]
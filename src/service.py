@@ -0,0 +1,527 @@
+""" service.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Long-lived SafeTuber scoring service on local HTTP. Whisper and the toxicity classifier are loaded once and shared by all jobs,
+    instead of being loaded again for every single_classify.py run.
+
+    Jobs are put on a queue and run by worker threads through the same pipeline functions as single_classify.py:
+        - channel jobs are listed, downloaded, transcribed and cleaned with run_pipeline
+        - audio jobs transcribe a local audio file
+    Calls to the transcriber are serialized, while classifier calls from concurrent jobs are gathered by a single classifier thread
+    and run as micro-batches (up to --max_batch chunks, waiting at most --max_wait_ms for more chunks to arrive).
+
+    Endpoints:
+        POST /jobs                 <----- {"url": channel url, "n_vids": 4} or {"audio": path to local audio file}, returns the job id
+        GET  /jobs/<job id>        <----- status of the job (queued, running, done or failed)
+        GET  /jobs/<job id>/result <----- toxicity of the channel or audio file, once the job is done
+        GET  /health               <----- number of jobs per status and micro-batching stats
+
+    With --offline, a fake downloader (see benchmark.py) serves a synthetic catalog of channels and tiny randomly initialised
+    models are used, so the service can be tested entirely on localhost.
+
+Usage:
+    $ python src/service.py --port 8765
+    $ curl -X POST localhost:8765/jobs -d '{"url": "https://www.youtube.com/@jakepaul", "n_vids": 4}'
+    $ curl localhost:8765/jobs/<job id>/result
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from transcriber import run_pipeline, transcribe_batch, chunk_texts, define_sampling, define_prober, transcript_settings
+from classifier import classify_batched, classify_cached
+from cache import define_video_store, define_label_cache, define_transcript_cache
+from backends import build_classifier, build_transcriber, backend_model_name
+from utils import clean_text
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+
+
+def arg_parse(argv=None):
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - The host and port to serve on
+    - The number of jobs run at once
+    - The max number of chunks in a classifier micro-batch and how long to wait for more chunks
+    - The models, backends and thread counts
+    - The pipeline settings also found in single_classify.py
+    - Whether to run offline with a fake downloader and tiny models
+
+    Args:
+      argv (list): List of arguments, None to parse the arguments of the script
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Serve SafeTuber toxicity scoring over local HTTP')
+
+    # add arguments
+    parser.add_argument('--host', default="127.0.0.1", help='Host to serve on')
+    parser.add_argument('-p', '--port', default=8765, type=int, help='Port to serve on')
+    parser.add_argument('-w', '--workers', default=2, type=int, help='Number of jobs run at once')
+    parser.add_argument('--max_batch', default=64, type=int, help='Max number of chunks classified in one micro-batch')
+    parser.add_argument('--max_wait_ms', default=20, type=float, help='Max milliseconds the classifier waits for more chunks before running a micro-batch')
+    parser.add_argument('-m', '--model', default="openai/whisper-base.en", help='Model to be used for transcription')
+    parser.add_argument('--classifier_backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the classifier (check backends.py for more info)')
+    parser.add_argument('--asr_backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the transcriber (check backends.py for more info)')
+    parser.add_argument('--intra_threads', default=None, type=int, help='Number of threads used within an op of the transcriber (default: torch default)')
+    parser.add_argument('--inter_threads', default=None, type=int, help='Number of threads used to run independent ops of the transcriber in parallel (default: torch default)')
+    parser.add_argument('-q', '--queue_depth', default=2, type=int, help='Max number of downloaded videos waiting for transcription per job')
+    parser.add_argument('-b', '--asr_batch_size', default=1, type=int, help='Number of 30 second windows decoded in one forward pass')
+    parser.add_argument('-t', '--listing_ttl', default=6, type=float, help='Hours a cached channel listing is reused (0 to always list the channel again)')
+    parser.add_argument('-c', '--transcript_cache_gb', default=2, type=float, help='Max size of the transcript cache in gigabytes (0 to disable it)')
+    parser.add_argument('-s', '--stream_audio', action='store_true', help='Stream audio into memory instead of writing .wav files to audio_files')
+    parser.add_argument('--vad', action='store_true', help='Only transcribe speech regions found by voice-activity detection (check vad.py for more info)')
+    parser.add_argument('--sample_windows', default=0, type=int, help='Number of windows spread across every video to download instead of the whole video (0 to download whole videos)')
+    parser.add_argument('--window_s', default=30, type=float, help='Length of every sampled window in seconds')
+    parser.add_argument('--probe_workers', default=4, type=int, help='Number of candidate videos of a channel probed at once')
+    parser.add_argument('--probe_rate', default=4, type=float, help='Max number of probes per second, across all jobs')
+    parser.add_argument('--probe_retries', default=3, type=int, help='Number of retries of a probe that failed with a transient error (e.g. a network blip)')
+    parser.add_argument('--no_label_cache', action='store_true', help='Classify every chunk, also chunks with a cached label')
+    parser.add_argument('--offline', action='store_true', help='Use a fake downloader with a synthetic catalog and tiny models, for testing on localhost')
+
+    # parse arguments
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def locked(transcriber, lock):
+    """
+    Wraps the transcriber so only one job uses it at a time, as HuggingFace pipelines are not safe to call from several threads.
+
+    Args:
+        transcriber (pipeline): HuggingFace pipeline for transcription
+        lock (threading.Lock): Lock shared by all jobs
+
+    Returns:
+        transcribe (function): Function that calls the transcriber while holding the lock
+    """
+
+    def transcribe(*args, **kwargs):
+        with lock:
+            return transcriber(*args, **kwargs)
+
+    return transcribe
+
+
+def define_service(transcriber, classifier, label_cache=None, transcript_cache=None, video_store=None, audio_path=None, max_batch=64, max_wait_ms=20, pipeline_kwargs=None):
+    """
+    Defines the shared state of the service.
+
+    Args:
+        transcriber (pipeline): HuggingFace pipeline for transcription, shared by all jobs
+        classifier (pipeline): HuggingFace pipeline for text classification, only used by the classifier thread
+        label_cache (dict): Label cache from define_label_cache, None to classify every chunk
+        transcript_cache (dict): Transcript cache from define_transcript_cache, None to always transcribe
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        audio_path (pathlib.PosixPath): Path to temporary audio storage
+        max_batch (int): Max number of chunks classified in one micro-batch
+        max_wait_ms (float): Max milliseconds the classifier waits for more chunks before running a micro-batch
+        pipeline_kwargs (dict): Further keyword arguments to run_pipeline, e.g. queue_depth
+
+    Returns:
+        service (dict): Dict with the models, caches, jobs, queues and micro-batching stats of the service
+    """
+
+    return {"transcriber": locked(transcriber, threading.Lock()),
+            "classifier": classifier,
+            "label_cache": label_cache,
+            "transcript_cache": transcript_cache,
+            "video_store": video_store,
+            "audio_path": audio_path,
+            "max_batch": max_batch,
+            "max_wait_ms": max_wait_ms,
+            "pipeline_kwargs": pipeline_kwargs or {},
+            "jobs": {},
+            "jobs_lock": threading.Lock(),
+            "job_queue": queue.Queue(),
+            "classify_queue": queue.Queue(),
+            "stop_event": threading.Event(),
+            "n_batches": 0,
+            "n_requests": 0,
+            "n_chunks": 0}
+
+
+def classifier_loop(service):
+    """
+    Runs the classifier thread. Requests from concurrent jobs are gathered into micro-batches, classified together,
+    and the labels are handed back to every job.
+
+    Args:
+        service (dict): Service from define_service
+    """
+
+    while not service["stop_event"].is_set():
+        try:
+            requests = [service["classify_queue"].get(timeout=0.1)]
+        except queue.Empty:
+            continue
+
+        # gather more requests until the batch is full or the wait is over
+        n_chunks = len(requests[0]["text_chunks"])
+        deadline = time.monotonic() + service["max_wait_ms"] / 1000
+        while n_chunks < service["max_batch"]:
+            try:
+                requests.append(service["classify_queue"].get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+            n_chunks += len(requests[-1]["text_chunks"])
+
+        # classify all chunks of the micro-batch at once
+        text_chunks = [text_chunk for request in requests for text_chunk in request["text_chunks"]]
+        try:
+            if service["label_cache"] is None:
+                classifications = classify_batched(text_chunks, service["classifier"], batch_size = service["max_batch"])
+            else:
+                classifications = classify_cached(text_chunks, service["classifier"], service["label_cache"], batch_size = service["max_batch"])
+        except Exception as e:
+            for request in requests:
+                request["error"] = e
+                request["event"].set()
+            continue
+
+        service["n_batches"] += 1
+        service["n_requests"] += len(requests)
+        service["n_chunks"] += len(text_chunks)
+
+        # hand labels back to every job
+        offset = 0
+        for request in requests:
+            request["classifications"] = classifications[offset:offset + len(request["text_chunks"])]
+            offset += len(request["text_chunks"])
+            request["event"].set()
+
+
+def classify_chunks(service, text_chunks):
+    """
+    Classifies text chunks on the classifier thread, waiting for the micro-batch they end up in.
+    Chunks are sent in pieces of max_batch, so large jobs do not hold up small ones.
+
+    Args:
+        service (dict): Service from define_service
+        text_chunks (list): List of text chunks
+
+    Returns:
+        classifications (list): List of classifications
+    """
+
+    requests = [{"text_chunks": text_chunks[i:i + service["max_batch"]], "event": threading.Event()}
+                for i in range(0, len(text_chunks), service["max_batch"])]
+
+    for request in requests:
+        service["classify_queue"].put(request)
+
+    # the classifier thread exits once the service stops, so stop waiting then
+    classifications = []
+    for request in requests:
+        while not request["event"].wait(0.1):
+            if service["stop_event"].is_set():
+                raise RuntimeError("service stopped before the job was done")
+        if "error" in request:
+            raise request["error"]
+        classifications.extend(request["classifications"])
+
+    return classifications
+
+
+def run_job(service, job):
+    """
+    Runs a job: transcribes the channel or audio file, cleans and classifies its chunks, and stores the result on the job.
+
+    Args:
+        service (dict): Service from define_service
+        job (dict): Job with a url and n_vids, or a path to an audio file
+    """
+
+    job.update(status = "running", started_at = time.time())
+
+    try:
+        if job.get("url"):
+            # list, download, transcribe and clean videos of the channel, stopping after the current video once the service stops
+            results = list(run_pipeline([(0, job["url"])], service["transcriber"], service["audio_path"], n_vids = job["n_vids"],
+                                        video_store = service["video_store"], transcript_cache = service["transcript_cache"],
+                                        on_video = lambda channel_idx, url, text_chunks: service["stop_event"].is_set(), **service["pipeline_kwargs"]))
+            _, used_urls, all_text_chunks = results[0] if results else (0, [], [])
+
+            # a job stopped halfway has no meaningful result
+            if service["stop_event"].is_set():
+                raise RuntimeError("service stopped before the job was done")
+        else:
+            # transcribe and clean the audio file
+            all_chunks = transcribe_batch([Path(job["audio"])], service["transcriber"])
+            used_urls, all_text_chunks = [], clean_text(chunk_texts(all_chunks[0]))
+
+        # classify chunks together with chunks of other jobs
+        classifications = classify_chunks(service, all_text_chunks)
+
+        n_toxic = classifications.count("toxic")
+        toxic_comments = [text_chunk for text_chunk, label in zip(all_text_chunks, classifications) if label == "toxic"]
+
+        job.update(status = "done",
+                   result = {"n_comments": len(classifications),
+                             "n_toxic": n_toxic,
+                             "pct_toxic": round(n_toxic / len(classifications), 4) if classifications else 0,
+                             "toxic_example": toxic_comments[0] if toxic_comments else None,
+                             "video_urls": used_urls})
+
+    except Exception as e:
+        job.update(status = "failed", error = f"{type(e).__name__}: {e}")
+
+    job["finished_at"] = time.time()
+
+
+def worker_loop(service):
+    """
+    Runs a worker thread that takes jobs off the job queue until the service stops.
+
+    Args:
+        service (dict): Service from define_service
+    """
+
+    while not service["stop_event"].is_set():
+        try:
+            job = service["job_queue"].get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+        run_job(service, job)
+
+
+def submit_job(service, body):
+    """
+    Validates a job and puts it on the job queue.
+
+    Args:
+        service (dict): Service from define_service
+        body (dict): Request body with a url (and optionally n_vids) or a path to an audio file
+
+    Returns:
+        job (dict): The queued job
+    """
+
+    if bool(body.get("url")) == bool(body.get("audio")):
+        raise ValueError('Provide either "url" or "audio"')
+
+    if body.get("audio") and not Path(body["audio"]).exists():
+        raise ValueError(f"Audio file not found: {body['audio']}")
+
+    job = {"job_id": uuid.uuid4().hex[:12],
+           "url": body.get("url"),
+           "audio": body.get("audio"),
+           "n_vids": int(body.get("n_vids", 4)),
+           "status": "queued",
+           "created_at": time.time()}
+
+    with service["jobs_lock"]:
+        service["jobs"][job["job_id"]] = job
+
+    service["job_queue"].put(job)
+
+    return job
+
+
+def job_status(job):
+    """
+    Describes the status of a job, without its result.
+
+    Args:
+        job (dict): Job from submit_job
+
+    Returns:
+        status (dict): Dict with id, input, status, timings and error of the job
+    """
+
+    return {key: job[key] for key in ["job_id", "url", "audio", "n_vids", "status", "created_at", "started_at", "finished_at", "error"] if key in job}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Handles HTTP requests to the service. The service state is found on the server as server.service.
+    """
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        service = self.server.service
+
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "Not found"})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = submit_job(service, body)
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+
+        self.send_json(202, job_status(job))
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+
+        if parts == ["health"]:
+            with service["jobs_lock"]:
+                statuses = [job["status"] for job in service["jobs"].values()]
+            return self.send_json(200, {"jobs": {status: statuses.count(status) for status in set(statuses)},
+                                        "classifier_batches": service["n_batches"],
+                                        "classifier_requests": service["n_requests"],
+                                        "classifier_chunks": service["n_chunks"]})
+
+        if len(parts) in (2, 3) and parts[0] == "jobs":
+            with service["jobs_lock"]:
+                job = service["jobs"].get(parts[1])
+
+            if job is None:
+                return self.send_json(404, {"error": "Unknown job"})
+
+            if len(parts) == 2:
+                return self.send_json(200, job_status(job))
+
+            if parts[2] == "result":
+                if job["status"] != "done":
+                    return self.send_json(409, job_status(job))
+                return self.send_json(200, {**job_status(job), "result": job["result"]})
+
+        self.send_json(404, {"error": "Not found"})
+
+    def log_message(self, format, *args):
+        # only log errors, not every status poll
+        pass
+
+
+def start_service(service, host="127.0.0.1", port=8765, workers=2):
+    """
+    Starts the classifier thread, the worker threads and the HTTP server in the background.
+
+    Args:
+        service (dict): Service from define_service
+        host (str): Host to serve on
+        port (int): Port to serve on, 0 for any free port
+        workers (int): Number of jobs run at once
+
+    Returns:
+        server (ThreadingHTTPServer): Running server, stop it with stop_service
+    """
+
+    threads = [threading.Thread(target=classifier_loop, args=(service,), daemon=True)]
+    threads += [threading.Thread(target=worker_loop, args=(service,), daemon=True) for _ in range(workers)]
+
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    threads.append(threading.Thread(target=server.serve_forever, daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    service["threads"] = threads
+
+    return server
+
+
+def stop_service(service, server):
+    """
+    Stops the HTTP server and all threads of the service. Running channel jobs stop once their current video is done, and are marked as failed.
+
+    Args:
+        service (dict): Service from define_service
+        server (ThreadingHTTPServer): Server from start_service
+    """
+
+    server.shutdown()
+    server.server_close()
+    service["stop_event"].set()
+
+    for thread in service.get("threads", []):
+        thread.join(timeout=5)
+
+
+def load_service(args):
+    """
+    Loads the models and caches of the service, or tiny models and a fake downloader with --offline.
+
+    Args:
+        args (argparse.Namespace): Parsed arguments from arg_parse
+
+    Returns:
+        service (dict): Service from define_service, not started yet
+    """
+
+    # define how videos are sampled
+    sampling = define_sampling(args.sample_windows, args.window_s)
+
+    if args.offline:
+        # serve a synthetic catalog with tiny models, nothing is fetched from YouTube or the HuggingFace hub
+        from benchmark import use_fake_downloader, build_tiny_transcriber, build_tiny_classifier
+
+        work_path = Path(tempfile.mkdtemp())
+        catalog, _ = use_fake_downloader(work_path)
+        audio_path = work_path / "audio_files"
+        audio_path.mkdir()
+
+        print("Loading tiny models...")
+        transcriber = build_tiny_transcriber(work_path)
+        classifier = build_tiny_classifier(work_path)
+        label_cache, transcript_cache, video_store = None, None, None
+
+        print("Offline channels: " + ", ".join(catalog["channels"]))
+
+    else:
+        # create dir for audio files if it doesn't exist
+        audio_path = Path(__file__).parents[1] / "audio_files"
+        os.makedirs(audio_path, exist_ok=True)
+
+        # load both models once for all jobs
+        print("Loading models...")
+        transcriber = build_transcriber(args.model, backend = args.asr_backend, intra_threads = args.intra_threads, inter_threads = args.inter_threads)
+        classifier = build_classifier("martin-ha/toxic-comment-model", backend = args.classifier_backend)
+
+        label_cache = None if args.no_label_cache else define_label_cache(backend_model_name("martin-ha/toxic-comment-model", args.classifier_backend))
+        video_store = define_video_store()
+        transcript_cache = define_transcript_cache(backend_model_name(args.model, args.asr_backend), transcript_settings(args.vad, sampling), max_gb = args.transcript_cache_gb) if args.transcript_cache_gb > 0 else None
+
+    pipeline_kwargs = {"queue_depth": args.queue_depth,
+                       "asr_batch_size": args.asr_batch_size,
+                       "listing_ttl": args.listing_ttl*60*60,
+                       "stream": args.stream_audio,
+                       "vad": args.vad,
+                       "sampling": sampling,
+                       "prober": define_prober(args.probe_workers, args.probe_rate, retries = args.probe_retries)} # one rate limit for all jobs
+
+    return define_service(transcriber, classifier, label_cache = label_cache, transcript_cache = transcript_cache, video_store = video_store,
+                          audio_path = audio_path, max_batch = args.max_batch, max_wait_ms = args.max_wait_ms, pipeline_kwargs = pipeline_kwargs)
+
+
+def main():
+    args = arg_parse()
+
+    service = load_service(args)
+    server = start_service(service, args.host, args.port, args.workers)
+    print(f"Serving on http://{args.host}:{server.server_address[1]} (Ctrl+C to stop)")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping...")
+        stop_service(service, server)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,39 @@
 Utilizes functions from the transcriper.py and classifier.py to setup a pipeline for new channel classifications.
 Channels provided for this analysis must conform with requirements specified in channel_reqs.txt.
 
+With --ci_width, chunks are classified as soon as each video is transcribed and a 95% Wilson interval is kept on the share
+of toxic comments. Once the interval is narrower than --ci_width, no more chunks are classified and no more videos are
+downloaded or transcribed. The interval and the skipped work are printed with the output.
+
+Heavy packages (torch, transformers, yt_dlp and pandas) are only imported once the arguments are parsed and validated,
+so --help and argument errors are near-instant. Run prepare_models.py once to load the models from fast local snapshots.
+
 """
 
-from transcriber import *
-from classifier import *
-from utils import *
+from pathlib import Path
+from urllib.parse import urlparse
+from metrics import define_metrics, count, time_stage, write_run_report, define_report_path
 import argparse
+import os
+import random
+
+def is_youtube_url(url):
+    """
+    Checks whether a url points to YouTube by its host, e.g. www.youtube.com, m.youtube.com or youtu.be.
+    Anything else about the url (e.g. whether the channel exists) is left to yt_dlp.
+
+    Args:
+        url (str): URL given on the command line, with or without scheme
+
+    Returns:
+        is_youtube (bool): Whether the host of the url is a YouTube host
+    """
+
+    # urls without scheme (e.g. youtube.com/@jakepaul) have no host to urlparse
+    host = (urlparse(url if "//" in url else "//" + url).hostname or "").lower()
+
+    return host in ("youtube.com", "youtu.be") or host.endswith(".youtube.com")
+
 
 def arg_parse():
     """
@@ -16,6 +43,19 @@ def arg_parse():
     - The number of videos to be analyzed
     - The model to be used for transcription
     - The YouTube URL of the channel to be analyzed.
+    - The number of downloaded videos that may wait for transcription.
+    - The number of 30 second windows decoded in one forward pass.
+    - How long cached channel listings are reused.
+    - The max size of the transcript cache.
+    - Whether to stream audio into memory instead of writing .wav files.
+    - Whether to only transcribe speech regions found by voice-activity detection.
+    - Whether to only download sampled windows of every video, and the max audio downloaded for the channel.
+    - How many videos are probed at once, how many probes per second are allowed and how often transient errors are retried.
+    - Whether to skip the label cache.
+    - The inference backend of the classifier.
+    - The inference backend and thread counts of the transcriber.
+    - Where to write the run report and Prometheus textfile.
+    - The interval width to stop early at, and the min number of chunks and videos before stopping.
 
     Returns:
       args (argparse.Namespace): Parsed arguments.
@@ -28,10 +68,41 @@ def arg_parse():
     parser.add_argument('-n', '--n_vids', default=4, type=int, help='Number of videos to be analyzed')
     parser.add_argument('-m', '--model', default="openai/whisper-base.en", help='Model to be used for transcription')
     parser.add_argument('-u', '--url', default='https://www.youtube.com/channel/UCuAXFkgsw1L7xaCfnd5JJOw', help='YouTube URL of channel')
+    parser.add_argument('-q', '--queue_depth', default=2, type=int, help='Max number of downloaded videos waiting for transcription (bounds disk usage)')
+    parser.add_argument('-b', '--asr_batch_size', default=1, type=int, help='Number of 30 second windows decoded in one forward pass, packed across videos')
+    parser.add_argument('-t', '--listing_ttl', default=6, type=float, help='Hours a cached channel listing is reused (0 to always list the channel again)')
+    parser.add_argument('-c', '--transcript_cache_gb', default=2, type=float, help='Max size of the transcript cache in gigabytes (0 to disable it)')
+    parser.add_argument('-s', '--stream_audio', action='store_true', help='Stream audio into memory instead of writing .wav files to audio_files')
+    parser.add_argument('--vad', action='store_true', help='Only transcribe speech regions found by voice-activity detection (check vad.py for more info)')
+    parser.add_argument('--sample_windows', default=0, type=int, help='Number of windows spread across every video to download instead of the whole video (0 to download whole videos)')
+    parser.add_argument('--window_s', default=30, type=float, help='Length of every sampled window in seconds')
+    parser.add_argument('--channel_seconds', default=None, type=float, help='Max seconds of audio downloaded for the channel (default: no limit)')
+    parser.add_argument('--channel_mb', default=None, type=float, help='Max megabytes of audio downloaded for the channel (default: no limit)')
+    parser.add_argument('--probe_workers', default=4, type=int, help='Number of candidate videos of a channel probed at once')
+    parser.add_argument('--probe_rate', default=4, type=float, help='Max number of probes per second')
+    parser.add_argument('--probe_retries', default=3, type=int, help='Number of retries of a probe that failed with a transient error (e.g. a network blip)')
+    parser.add_argument('--classifier_backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the classifier (check backends.py for more info)')
+    parser.add_argument('--asr_backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the transcriber (check backends.py for more info)')
+    parser.add_argument('--intra_threads', default=None, type=int, help='Number of threads used within an op of the transcriber (default: torch default)')
+    parser.add_argument('--inter_threads', default=None, type=int, help='Number of threads used to run independent ops of the transcriber in parallel (default: torch default)')
+    parser.add_argument('--no_label_cache', action='store_true', help='Classify every chunk, also chunks with a cached label')
+    parser.add_argument('--metrics_path', default=str(define_report_path("single_classify")), help='Path to write the JSON run report to')
+    parser.add_argument('--prometheus', default=None, help='Path to write a Prometheus textfile to, e.g. for the node_exporter textfile collector')
+    parser.add_argument('-w', '--ci_width', default=None, type=float, help='Stop once the 95%% interval of the toxic share is narrower than this, e.g. 0.05 (default: classify all videos)')
+    parser.add_argument('--min_chunks', default=50, type=int, help='Min number of classified chunks before stopping early')
+    parser.add_argument('--min_videos', default=2, type=int, help='Min number of videos before stopping early, as chunks of one video are alike')
 
     # parse arguments
     args = parser.parse_args()
 
+    # validate arguments before any heavy package is imported
+    if args.n_vids < 1:
+        parser.error("--n_vids must be at least 1")
+    if not is_youtube_url(args.url):
+        parser.error(f"--url must be a YouTube url (youtube.com or youtu.be), got {args.url}")
+    if args.ci_width is not None and not 0 < args.ci_width < 1:
+        parser.error("--ci_width must be between 0 and 1")
+
     return args
 
 
@@ -47,15 +118,13 @@ def initialize_models(args):
         classifier (pipeline): HuggingFace pipeline for text classification
     """
 
-    # initialize transcriber
-    transcriber = pipeline('automatic-speech-recognition', 
-                           model=args.model,
-                           chunk_length_s = 30, # must be 30 to chunk correctly
-                           return_timestamps=True)
+    from backends import build_classifier, build_transcriber
+
+    # initialize transcriber on the chosen backend
+    transcriber = build_transcriber(args.model, backend = args.asr_backend, intra_threads = args.intra_threads, inter_threads = args.inter_threads)
     
-    # initialize classifier
-    classifier = pipeline("text-classification", 
-                          model = "martin-ha/toxic-comment-model")
+    # initialize classifier on the chosen backend
+    classifier = build_classifier("martin-ha/toxic-comment-model", backend = args.classifier_backend)
 
     return transcriber, classifier
 
@@ -126,59 +195,173 @@ def toxicity_output(all_text_chunks, classifications):
     return main_output, toxic_output
 
 
-def main():
-    args = arg_parse()
+def define_estimator(classify_chunks, ci_width, min_chunks=50, min_videos=2, batch_size=32):
+    """
+    Defines a sequential estimator of the share of toxic comments, which classifies chunks until its interval is narrow enough.
 
-    print(f"[1/7] Identifying toxicity levels for {args.url}")
+    Args:
+        classify_chunks (function): Called with a list of text chunks, returns their classifications
+        ci_width (float): Width of the 95% interval to stop at
+        min_chunks (int): Min number of classified chunks before stopping
+        min_videos (int): Min number of videos before stopping
+        batch_size (int): Number of chunks classified between checks of the interval
 
-    # create audio path
-    audio_path = create_audio_path()
+    Returns:
+        estimator (dict): Dict with the settings, classified chunks, their classifications, the interval, skipped chunks and whether it stopped
+    """
 
-    # get channel videos
-    print("[2/7] Getting video urls...")
-    video_urls = get_channel_vids(args.url)
+    return {"classify_chunks": classify_chunks, "ci_width": ci_width, "min_chunks": min_chunks, "min_videos": min_videos,
+            "batch_size": batch_size, "text_chunks": [], "classifications": [], "n_videos": 0, "n_skipped": 0, "interval": (0.0, 1.0),
+            "stopped": False}
 
-    # download videos
-    print("[3/7] Downloading .wav files...")
-    used_urls = download_channel(n_vids = args.n_vids, video_urls = video_urls, outpath = audio_path)
 
-    # initialize transcriber and classifier
-    print("[4/7] Initialize models and transcribe audio...")
-    transcriber, classifier = initialize_models(args)
+def update_estimator(estimator, text_chunks):
+    """
+    Classifies the chunks of a finished video in batches, checking the interval after every batch.
+    Chunks are visited in random order, so a stop halfway through a video does not favor its beginning.
 
-    # define empty list to store text chunks
-    all_text_chunks = []
+    Args:
+        estimator (dict): Estimator from define_estimator
+        text_chunks (list): List of cleaned text chunks of the video
 
-    # loop through all files in audio_path
-    for audio_file in os.listdir(audio_path):
-        # transcribe audio
-        text_chunks = transcribe_audio(audio_file, transcriber, audio_path)
+    Returns:
+        confident (bool): True if the interval is narrow enough, i.e. the pipeline can stop
+    """
 
-        # clean transcript
-        text_chunks_cln = clean_text(text_chunks)
+    from classifier import wilson_interval
 
-        # append all elements in text_chunks_cln to all_text_chunks
-        all_text_chunks.extend(text_chunks_cln)
+    estimator["n_videos"] += 1
+    text_chunks = random.sample(text_chunks, len(text_chunks))
 
-        # delete audio file
-        os.remove(audio_path / audio_file)
-        
-    # shuffle list
-    print("[5/7] Merging and shuffling transcript...")
-    random.shuffle(all_text_chunks)
+    for start in range(0, len(text_chunks), estimator["batch_size"]):
+        batch = text_chunks[start:start + estimator["batch_size"]]
+        estimator["text_chunks"].extend(batch)
+        estimator["classifications"].extend(estimator["classify_chunks"](batch))
+
+        # update interval
+        n_comments = len(estimator["classifications"])
+        estimator["interval"] = wilson_interval(estimator["classifications"].count("toxic"), n_comments)
 
-    # classify transcript chunks
+        # stop once enough chunks and videos are seen and the interval is narrow enough
+        lower, upper = estimator["interval"]
+        if n_comments >= estimator["min_chunks"] and estimator["n_videos"] >= estimator["min_videos"] and upper - lower <= estimator["ci_width"]:
+            estimator["n_skipped"] += len(text_chunks) - start - len(batch)
+            estimator["stopped"] = True
+            return True
+
+    return False
+
+
+def interval_output(estimator, n_vids):
+    """
+    Provides the interval of the share of toxic comments and the work that was skipped, ready to be printed.
+
+    Args:
+        estimator (dict): Estimator from define_estimator
+        n_vids (int): Number of videos that would have been analyzed without stopping early
+
+    Returns:
+        interval_output (str): Interval and skipped work
+    """
+
+    lower, upper = estimator["interval"]
+
+    if estimator["stopped"]:
+        skipped_output = f"Stopped early after {estimator['n_videos']} of {n_vids} videos, skipping {n_vids - estimator['n_videos']} videos and {estimator['n_skipped']} transcribed chunks"
+    else:
+        skipped_output = f"Interval did not reach a width of {estimator['ci_width']} within {estimator['n_videos']} videos, nothing was skipped"
+
+    return f'''
+    95% interval of the percentage of toxic comments: [{round(lower, 4)}, {round(upper, 4)}] (width {round(upper - lower, 4)})
+    {skipped_output}
+    '''
+
+
+def main():
+    args = arg_parse()
+
+    print(f"[1/7] Identifying toxicity levels for {args.url}")
+
+    # import heavy packages only after the arguments are parsed
+    from transcriber import run_pipeline, define_sampling, define_prober, transcript_settings
+    from classifier import classify_batched, classify_cached
+    from cache import define_video_store, define_transcript_cache, report_transcript_cache, define_label_cache, report_label_cache
+    from backends import backend_model_name
+
+    # collect per-stage metrics of the run
+    metrics = define_metrics("single_classify")
+
+    # create audio path
+    audio_path = create_audio_path()
+
+    # initialize transcriber and classifier before the pipeline starts, so downloads and transcription can overlap
+    print("Initializing models...")
+    with time_stage(metrics, "load_models"):
+        transcriber, classifier = initialize_models(args)
+
+    # define how videos are sampled and how much audio may be downloaded
+    sampling = define_sampling(args.sample_windows, args.window_s, args.channel_seconds, args.channel_mb)
+
+    # probe candidate videos concurrently, behind a rate limit
+    prober = define_prober(args.probe_workers, args.probe_rate, retries = args.probe_retries)
+
+    # cache raw transcripts per video, model and generation settings
+    transcript_cache = define_transcript_cache(backend_model_name(args.model, args.asr_backend), transcript_settings(args.vad, sampling), max_gb = args.transcript_cache_gb) if args.transcript_cache_gb > 0 else None
+
+    # cache labels per chunk text and classifier model
+    label_cache = None if args.no_label_cache else define_label_cache(backend_model_name("martin-ha/toxic-comment-model", args.classifier_backend))
+
+    def classify_chunks(text_chunks):
+        with time_stage(metrics, "classify"):
+            if label_cache is None:
+                classifications = classify_batched(text_chunks, classifier)
+            else:
+                classifications = classify_cached(text_chunks, classifier, label_cache)
+        count(metrics, "chunks_classified", len(text_chunks))
+        return classifications
+
+    # classify chunks of every video as soon as it is done, stopping once the interval is narrow enough
+    estimator = None
+    on_video = None
+    if args.ci_width is not None:
+        estimator = define_estimator(classify_chunks, args.ci_width, min_chunks = args.min_chunks, min_videos = args.min_videos)
+        on_video = lambda i, url, text_chunks: update_estimator(estimator, text_chunks)
+
+    # get video urls, download, transcribe and merge as overlapping stages
+    print("[2-5/7] Getting video urls, downloading .wav files, transcribing audio and merging transcript...")
+    with time_stage(metrics, "pipeline"):
+        results = list(run_pipeline([(0, args.url)], transcriber, audio_path, n_vids = args.n_vids, queue_depth = args.queue_depth, asr_batch_size = args.asr_batch_size, listing_ttl = args.listing_ttl*60*60, video_store = define_video_store(), on_video = on_video, transcript_cache = transcript_cache, stream = args.stream_audio, metrics = metrics, vad = args.vad, sampling = sampling, prober = prober))
+    _, used_urls, all_text_chunks = results[0]
+
+    # report transcript cache hits and misses
+    if transcript_cache:
+        report_transcript_cache(transcript_cache)
+
+    # classify transcript chunks, unless they were classified while the pipeline ran
     print("[6/7] Classifying transcript chunks...")
-    classifications = classify_transcript(all_text_chunks, classifier)
+    if estimator is not None:
+        all_text_chunks, classifications = estimator["text_chunks"], estimator["classifications"]
+        count(metrics, "chunks_skipped", estimator["n_skipped"])
+        count(metrics, "videos_skipped", args.n_vids - estimator["n_videos"] if estimator["stopped"] else 0)
+    else:
+        classifications = classify_chunks(all_text_chunks)
+    if label_cache is not None:
+        report_label_cache(label_cache)
 
     # calculate toxicity aggregates
     print("[7/7] Calculating aggregates...")
-    main_output, toxic_output = toxicity_output(all_text_chunks, classifications)
+    with time_stage(metrics, "aggregate"):
+        main_output, toxic_output = toxicity_output(all_text_chunks, classifications)
     
 
     # print output
     print(main_output)
+    if estimator is not None:
+        print(interval_output(estimator, args.n_vids))
     print(toxic_output)
 
+    # write run report
+    write_run_report(metrics, args.metrics_path, args.prometheus)
+
 if __name__ in "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,166 @@
+""" storage.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Provides columnar storage for the SafeTuber pipeline.
+    Instead of one row per channel with stringified lists of chunks, transcripts and classifications are stored in long format
+    with one row per chunk in Parquet files, alongside a small per-channel summary table:
+        data/top-youtubers-chunks.parquet            <----- channel_url, name, video_id, chunk_index, text, label (empty, except for videos kept by a refresh)
+        out/top-youtubers-chunks-classified.parquet  <----- same columns with the label filled in
+        out/top-youtubers-summary.parquet            <----- channel metadata with n_comments, n_toxic and pct_toxic per channel
+
+    Downstream stages only load the columns they need, so load time and memory scale with what is queried.
+    The CSV files are still written as an export format.
+"""
+
+from pathlib import Path
+import pandas as pd
+import ast
+import os
+
+
+def define_storage_paths():
+    """
+    Defines paths to the columnar tables.
+
+    Returns:
+        chunks_path (pathlib.PosixPath): Path to the transcribed chunks
+        classified_path (pathlib.PosixPath): Path to the classified chunks
+        summary_path (pathlib.PosixPath): Path to the per-channel summary
+    """
+
+    # define path
+    path = Path(__file__)
+
+    # define paths to tables
+    chunks_path = path.parents[1] / "data" / "top-youtubers-chunks.parquet"
+    classified_path = path.parents[1] / "out" / "top-youtubers-chunks-classified.parquet"
+    summary_path = path.parents[1] / "out" / "top-youtubers-summary.parquet"
+
+    return chunks_path, classified_path, summary_path
+
+
+def chunks_frame(records):
+    """
+    Creates a long-format table of chunks with one row per chunk.
+
+    Args:
+        records (list): List of dicts with channel_url, name, video_id, chunk_index, text and optionally label
+
+    Returns:
+        chunks (pd.DataFrame): Table of chunks
+    """
+
+    chunks = pd.DataFrame(records, columns=["channel_url", "name", "video_id", "chunk_index", "text", "label"])
+
+    # fix column types, so empty columns are still written as strings and integers
+    chunks = chunks.astype({"channel_url": "string", "name": "string", "video_id": "string",
+                            "chunk_index": "int64", "text": "string", "label": "string"})
+
+    return chunks
+
+
+def write_table(table, table_path):
+    """
+    Writes a table to a Parquet file. The table is written to a temporary file first and then moved in place,
+    so readers never see a half-written table.
+
+    Args:
+        table (pd.DataFrame): Table to write
+        table_path (pathlib.PosixPath): Path to the Parquet file
+    """
+
+    # write to temporary file next to the table
+    tmp_path = table_path.with_name(f"{table_path.name}.{os.getpid()}.tmp")
+    table.to_parquet(tmp_path, index=False)
+
+    # move it in place
+    os.replace(tmp_path, table_path)
+
+
+def read_table(table_path, columns=None):
+    """
+    Reads a table from a Parquet file, only loading the given columns.
+
+    Args:
+        table_path (pathlib.PosixPath): Path to the Parquet file
+        columns (list): List of columns to load, None to load all columns
+
+    Returns:
+        table (pd.DataFrame): Table with the given columns
+    """
+
+    return pd.read_parquet(table_path, columns=columns)
+
+
+def read_chunk_store(chunks_path, classified_path, columns=None):
+    """
+    Reads the most recent table of chunks, e.g. as the starting point of an incremental refresh.
+    The classified table is preferred when it is at least as new as the transcribed table, so labels of earlier runs are kept.
+
+    Args:
+        chunks_path (pathlib.PosixPath): Path to the transcribed chunks
+        classified_path (pathlib.PosixPath): Path to the classified chunks
+        columns (list): List of columns to load, None to load all columns
+
+    Returns:
+        chunks (pd.DataFrame): Table of chunks, None if neither table exists
+    """
+
+    if classified_path.exists() and (not chunks_path.exists() or classified_path.stat().st_mtime >= chunks_path.stat().st_mtime):
+        return read_table(classified_path, columns)
+
+    if chunks_path.exists():
+        return read_table(chunks_path, columns)
+
+    return None
+
+
+def chunks_from_csv(csv_path):
+    """
+    Converts a transcribed CSV file with stringified lists of chunks into a long-format table of chunks.
+    Used for transcriptions made before the columnar tables existed. The video of each chunk is unknown in these files.
+
+    Args:
+        csv_path (pathlib.PosixPath): Path to the transcribed CSV file
+
+    Returns:
+        chunks (pd.DataFrame): Table of chunks
+    """
+
+    # load channels with their chunks
+    data = pd.read_csv(csv_path, usecols=["name", "channel_url", "transcript_chunks"])
+
+    # change data type of transcript_chunks to list
+    data["transcript_chunks"] = data["transcript_chunks"].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else [])
+
+    records = [{"channel_url": row["channel_url"], "name": row["name"], "video_id": None, "chunk_index": chunk_index, "text": text_chunk}
+               for _, row in data.iterrows() for chunk_index, text_chunk in enumerate(row["transcript_chunks"])]
+
+    return chunks_frame(records)
+
+
+def summarize_chunks(chunks, channels):
+    """
+    Calculates toxicity aggregates per channel from classified chunks.
+
+    Args:
+        chunks (pd.DataFrame): Table of classified chunks with channel_url and label columns
+        channels (pd.DataFrame): Table of channel metadata with a channel_url column
+
+    Returns:
+        summary (pd.DataFrame): Channel metadata with n_comments, n_toxic and pct_toxic per channel
+    """
+
+    # count chunks and toxic chunks per channel
+    counts = chunks.assign(is_toxic = chunks["label"] == "toxic").groupby("channel_url").agg(n_comments = ("label", "size"), n_toxic = ("is_toxic", "sum")).reset_index()
+
+    # add counts to channel metadata, channels without chunks get zero
+    summary = channels.merge(counts, on="channel_url", how="left")
+    summary[["n_comments", "n_toxic"]] = summary[["n_comments", "n_toxic"]].fillna(0).astype("int64")
+
+    # calculate percentage of toxic comments
+    summary["pct_toxic"] = (summary["n_toxic"] / summary["n_comments"].where(summary["n_comments"] > 0)).round(3).fillna(0)
+
+    return summary
@@ -18,21 +18,109 @@ Desc:
     This script analyzes all the 100 channels in the top-youtubers-curated.csv file and provides transcriptions of their recent
     videos in data/top-youtubers-transcribed.csv.
 
+    Steps 2-5 run as overlapping stages connected by bounded queues, so the next video is downloaded while the current one
+    is transcribed and cleaned. The queue depth bounds how many downloaded files can wait in the temporary audio storage.
+    Every finished video and channel is checkpointed to data/checkpoints, so a restart skips work that is already done.
+    Besides the CSV export, transcripts are written with one row per chunk to data/top-youtubers-chunks.parquet.
+    With --stream_audio, audio is decoded straight into memory as 16 kHz mono samples and no .wav files are written.
+    Every run writes a report with per-stage wall times, video and chunk counts and the real-time factor of the transcriber
+    to out/metrics/transcriber-run.json, and optionally a Prometheus textfile (see metrics.py).
+    With --vad, only speech regions found by a cheap voice-activity detector (see vad.py) are transcribed, keeping the original timestamps.
+    With --sample_windows, only K windows of --window_s seconds spread across every video are downloaded (in a low-bitrate format),
+    and --channel_seconds / --channel_mb cap the audio downloaded per channel, so cost scales with the sample instead of video length.
+    Candidate videos of a channel are probed --probe_workers at a time behind a global rate limit (--probe_rate), retrying transient
+    errors with exponential backoff. Usable videos are still selected in listing order, so the same videos are picked as when probing one by one.
+    With --refresh, only videos uploaded since the last run are downloaded and transcribed: every channel keeps a rolling window of its
+    --n_vids most recent videos, where videos already in the chunk tables keep their chunks (and labels) and older videos are dropped.
+
 Usage:
-    $ python src/transcriber.py --n_vids 4 --model "openai/whisper-medium.en"
+    $ python src/transcriber.py --n_vids 4 --model "openai/whisper-medium.en" --queue_depth 2
 """
 
 # import packages
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError, download_range_func
 from pathlib import Path
 from tqdm import tqdm
-from transformers import pipeline
 from utils import *
+from cache import define_cache_path, cache_key, read_json_cache, write_json_cache, define_video_store, lookup_video, record_video, define_transcript_cache, transcript_cache_file, read_transcript, write_transcript, report_transcript_cache
+from checkpoints import define_checkpoint_path, clear_checkpoints, save_video_checkpoint, save_channel_checkpoint, load_channel_progress, load_channel_chunks, load_video_chunks, merge_checkpoints
+from storage import define_storage_paths, chunks_frame, write_table, read_chunk_store
+from backends import build_transcriber, backend_model_name
+from metrics import define_metrics, count, time_stage, write_run_report, define_report_path
+from vad import detect_speech, compact_speech, restore_timestamps, speech_seconds
+from urllib.parse import parse_qs, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import pandas as pd
+import numpy as np
+import torch
+import argparse
 import os
+import queue
 import random
-import io
-import sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+
+
+def arg_parse():
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - The number of videos to be analyzed per channel
+    - The model to be used for transcription
+    - The number of downloaded videos that may wait for transcription
+    - The number of 30 second windows decoded in one forward pass
+    - How long cached channel listings are reused
+    - The max size of the transcript cache
+    - Whether to stream audio into memory instead of writing .wav files
+    - Whether to only transcribe speech regions found by voice-activity detection
+    - Whether to only download sampled windows of every video, and the max audio downloaded per channel
+    - How many videos are probed at once, how many probes per second are allowed and how often transient errors are retried
+    - The inference backend and thread counts of the transcriber
+    - Whether to start from scratch, only merge checkpoints of earlier runs or only process videos that are new since the last run
+    - Where to write the run report and Prometheus textfile
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Transcribe recent videos of the top YouTube channels')
+
+    # add arguments
+    parser.add_argument('-n', '--n_vids', default=3, type=int, help='Number of videos to be analyzed per channel')
+    parser.add_argument('-m', '--model', default="openai/whisper-base.en", help='Model to be used for transcription')
+    parser.add_argument('-q', '--queue_depth', default=2, type=int, help='Max number of downloaded videos waiting for transcription (bounds disk usage)')
+    parser.add_argument('-b', '--asr_batch_size', default=1, type=int, help='Number of 30 second windows decoded in one forward pass, packed across videos and channels')
+    parser.add_argument('-t', '--listing_ttl', default=6, type=float, help='Hours a cached channel listing is reused (0 to always list channels again)')
+    parser.add_argument('-c', '--transcript_cache_gb', default=2, type=float, help='Max size of the transcript cache in gigabytes (0 to disable it)')
+    parser.add_argument('-s', '--stream_audio', action='store_true', help='Stream audio into memory instead of writing .wav files to audio_files')
+    parser.add_argument('--vad', action='store_true', help='Only transcribe speech regions found by voice-activity detection (check vad.py for more info)')
+    parser.add_argument('--sample_windows', default=0, type=int, help='Number of windows spread across every video to download instead of the whole video (0 to download whole videos)')
+    parser.add_argument('--window_s', default=30, type=float, help='Length of every sampled window in seconds')
+    parser.add_argument('--channel_seconds', default=None, type=float, help='Max seconds of audio downloaded per channel (default: no limit)')
+    parser.add_argument('--channel_mb', default=None, type=float, help='Max megabytes of audio downloaded per channel (default: no limit)')
+    parser.add_argument('--probe_workers', default=4, type=int, help='Number of candidate videos of a channel probed at once')
+    parser.add_argument('--probe_rate', default=4, type=float, help='Max number of probes per second, across all channels')
+    parser.add_argument('--probe_retries', default=3, type=int, help='Number of retries of a probe that failed with a transient error (e.g. a network blip)')
+    parser.add_argument('--asr_backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the transcriber (check backends.py for more info)')
+    parser.add_argument('--intra_threads', default=None, type=int, help='Number of threads used within an op of the transcriber (default: torch default)')
+    parser.add_argument('--inter_threads', default=None, type=int, help='Number of threads used to run independent ops of the transcriber in parallel (default: torch default)')
+    parser.add_argument('--restart', action='store_true', help='Delete checkpoints of earlier runs and start from scratch')
+    parser.add_argument('--merge_only', action='store_true', help='Only merge checkpoints of earlier runs into the transcribed table')
+    parser.add_argument('--refresh', action='store_true', help='Only process videos that are new since the last run, keeping the --n_vids most recent videos per channel')
+    parser.add_argument('--metrics_path', default=str(define_report_path("transcriber")), help='Path to write the JSON run report to')
+    parser.add_argument('--prometheus', default=None, help='Path to write a Prometheus textfile to, e.g. for the node_exporter textfile collector')
+
+    # parse arguments
+    args = parser.parse_args()
+
+    return args
 
 def define_paths():
     """
@@ -63,235 +151,1555 @@ def define_paths():
     return inpath, outpath, audio_path
 
 
-def get_channel_vids(channel_url):
+def channel_videos_url(channel_url):
     """
-    Uses yt_dlp to get the video urls from a channel url.
-    It is necessary to obtain these urls from the terminal output as extract_info does not return those.
+    Points a channel url at the channel's videos tab, unless it already points at a tab.
+    A flat listing of the channel root only lists its tabs, not the videos in them.
 
     Args:
         channel_url (str): URL of the YouTube channel
-    
+
     Returns:
-        urls (list): List of video urls
+        videos_url (str): URL of the channel's videos tab
+    """
+
+    # strip trailing slash
+    url = channel_url.rstrip("/")
+
+    # keep urls that already point at a tab
+    if url.split("/")[-1] in ("videos", "shorts", "streams", "featured", "playlists"):
+        return url
+
+    return url + "/videos"
+
+
+def flatten_entries(info_dict):
+    """
+    Collects video entries from a flat listing, also from playlists nested in the listing (e.g. channel tabs).
+
+    Args:
+        info_dict (dict): Info dict returned by yt_dlp
+
+    Returns:
+        entries (list): List of video entries
+    """
+
+    entries = []
+
+    for entry in info_dict.get("entries") or []:
+        # skip entries that failed
+        if not entry:
+            continue
+
+        # walk nested playlists
+        if entry.get("entries") is not None:
+            entries.extend(flatten_entries(entry))
+
+        # keep only videos
+        elif entry.get("ie_key", "Youtube") == "Youtube" and entry.get("id"):
+            entries.append(entry)
+
+    return entries
+
+
+def list_channel_videos(channel_url, max_videos=30, ttl=6*60*60):
+    """
+    Uses yt_dlp to get a flat listing of the most recent videos of a channel.
+    The listing is not resolved per video, so it only carries cheap metadata, i.e. id, title and duration.
+    Listings are cached on disk per channel url, so repeated runs within ttl skip the listing entirely.
+
+    Args:
+        channel_url (str): URL of the YouTube channel
+        max_videos (int): Max number of videos to list
+        ttl (float): Max age of a cached listing in seconds, 0 to always list the channel again
+
+    Returns:
+        videos (list): List of dicts with id, url, title and duration (None if unknown) of each video
     """
 
-    # create a StringIO object to capture stdout
-    captured_output = io.StringIO()
+    # look for a cached listing
+    cache_file = define_cache_path("listings") / f"{cache_key(channel_url, max_videos)}.json"
+    videos = read_json_cache(cache_file, ttl=ttl)
 
-    # redirect stdout to the StringIO object
-    sys.stdout = captured_output
+    if videos is not None:
+        return videos
 
     # define ydl options
-    ydl_opts = {'outtmpl': '%(id)s.%(ext)s', 
-                'playlistend': 30,
+    ydl_opts = {'extract_flat': 'in_playlist', # do not resolve every video in the listing
+                'playlistend': max_videos,
+                'quiet': True,
                 'ignoreerrors': True # necessary to skip videos that fail (e.g. due to age or country restrictions)
                 }
-    
-    # download the channel
+
+    # list the channel
     with YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(
-            channel_url,
-            download=False
-        )
+        info_dict = ydl.extract_info(channel_videos_url(channel_url), download=False)
+
+    # keep cheap metadata from the listing
+    videos = [{"id": entry["id"],
+               "url": "https://www.youtube.com/watch?v=" + entry["id"],
+               "title": entry.get("title"),
+               "duration": entry.get("duration")}
+              for entry in flatten_entries(info_dict or {})][:max_videos]
+
+    # only cache listings that found videos, so a failed listing is retried next run
+    if videos:
+        write_json_cache(cache_file, videos)
 
-    # restore stdout to its original value
-    sys.stdout = sys.__stdout__
+    return videos
 
-    # get output
-    output = captured_output.getvalue()
 
-    # extract all urls from output
-    urls = []
+def get_channel_vids(channel_url, ttl=6*60*60):
+    """
+    Uses yt_dlp to get the video urls from a channel url.
 
-    for line in output.splitlines():
-        if "https://www.youtube.com/watch?v=" in line:
-            
-            # extract only the url from the line
-            url = line.split(" ")[-1]
-            urls.append(url)
+    Args:
+        channel_url (str): URL of the YouTube channel
+        ttl (float): Max age of a cached listing in seconds
+    
+    Returns:
+        urls (list): List of video urls
+    """
 
-    return urls
+    return [video["url"] for video in list_channel_videos(channel_url, ttl=ttl)]
 
 
-def download_wav(outpath, url, max_duration, min_duration):
+def video_id_from_url(url):
     """
-    Downloads a .wav file from a YouTube video.
-    NOTE: This is immediately deleted after the audio has been transcribed to comply with YouTube's terms of service and save memory.
+    Gets the YouTube id of a video from its url.
 
     Args:
-        outpath (pathlib.PosixPath): Path to output
         url (str): URL of the YouTube video
-        max_duration (int): Maximum allowed duration of a video in seconds (check channel_reqs.txt for more info)
-        min_duration (int): Minimum allowed duration of a video in seconds (check channel_reqs.txt for more info)
 
     Returns:
-        success_fail (int): 1 if the download was successful, 0 if it failed.
+        video_id (str): YouTube id of the video
     """
 
-    # get info on video
-    ydl = YoutubeDL()
-    info_dict = ydl.extract_info(url, download=False)
+    # watch urls carry the id in the query string
+    query = parse_qs(urlparse(url).query)
+    if "v" in query:
+        return query["v"][0]
 
-    # check duration
-    duration = info_dict.get('duration')
+    # short urls (youtu.be/<id>, /shorts/<id>) carry it in the path
+    return urlparse(url).path.rstrip("/").split("/")[-1]
+
+
+def is_permanent_error(error):
+    """
+    Checks whether a yt_dlp error will happen again on a later run (e.g. age or georestrictions),
+    as opposed to transient errors like network blips.
+
+    Args:
+        error (str): Error message from yt_dlp
+
+    Returns:
+        permanent (bool): True if the error is permanent
+    """
+
+    # phrases in yt_dlp errors for videos that will never be downloadable for us
+    permanent_phrases = ["confirm your age", "age-restricted", "inappropriate for some users", "not available in your country",
+                         "private video", "video unavailable", "has been removed", "members-only", "join this channel",
+                         "premieres in", "this live event"]
+
+    return any(phrase in error.lower() for phrase in permanent_phrases)
+
+
+def check_duration(duration, url, max_duration=1200, min_duration=120):
+    """
+    Checks whether the duration of a video is within the allowed range (check channel_reqs.md for more info).
+
+    Args:
+        duration (float): Duration of the video in seconds, None if unknown (e.g. live streams)
+        url (str): URL of the YouTube video
+        max_duration (float): Maximum allowed duration of a video in seconds
+        min_duration (float): Minimum allowed duration of a video in seconds
+
+    Returns:
+        admitted (bool): True if the video can be used
+    """
+
+    # unknown duration, e.g. live streams
+    if duration is None:
+        print("Video has no duration, skipping to next..." + url)
+        return False
 
     # if duration is too long, skip
-    if duration > 1200:
+    if duration > max_duration:
         print("Video too long, skipping to next..." + url)
-        return 0 # return 0 for fail
+        return False
     
     # if duration is too short, skip
-    if duration < 120:
+    if duration < min_duration:
         print("Video too short, skipping to next..." + url)
-        return 0 # return 0 for fail
-
-    # else initialize ydl options
-    else:
-        ydl_opts = {
-        'outtmpl': str(outpath) + '/%(title)s.%(ext)s',
-        'format': 'bestaudio/best', # downloads best audio
-        'ignoreerrors': True , # necessary to skip videos that fail (e.g. due to age or country restrictions)
-        'quiet': True,
-        'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'wav' # use .wav format
-    }],
-        }
-
-        # attempt to download the video
-        with YoutubeDL(ydl_opts) as ydl:
-            try:
-                ydl.download([url])
-                return 1 # return 1 for success
-            except:
-                return 0 # return 0 for a failed download
+        return False
 
+    return True
 
-def download_channel(n_vids, video_urls, outpath):
+
+def rejection_reason(duration, max_duration=1200):
     """
-    Uses download_wav function to download videos from a channel, the number is determined by n_vids.
+    Names why check_duration rejects a duration, for counting rejected videos.
 
     Args:
-        n_vids (int): Number of videos to be downloaded
-        video_urls (list): List of video urls
-        outpath (pathlib.PosixPath): Path to output
-    
+        duration (float): Duration of the video in seconds, None if unknown
+        max_duration (float): Maximum allowed duration of a video in seconds
+
     Returns:
-        used_urls (list): List of urls that were used to download videos
+        reason (str): "no_duration", "too_long" or "too_short"
     """
 
-    # get max n_vids from channel based on how many videos are available
-    max_attempts = len(video_urls)
-    
-    # initialize list of used urls
-    used_urls = []
+    if duration is None:
+        return "no_duration"
 
-    # set download and attempt counters
-    n_downloads = 0
-    n_attempt = 0  
+    return "too_long" if duration > max_duration else "too_short"
+
+
+def define_prober(workers=4, rate=4.0, burst=None, retries=3, backoff_s=1.0, ydl_factory=None):
+    """
+    Defines how candidate videos are probed: how many at once, behind which rate limit and with how many retries.
+    The rate limit is a token bucket shared by everything that uses the same prober, e.g. all channels of a run.
+
+    Args:
+        workers (int): Number of candidate videos of a channel probed at once
+        rate (float): Max number of probes per second on average
+        burst (int): Max number of probes sent at once after an idle period, None for the number of workers
+        retries (int): Number of retries of a probe that failed with a transient error
+        backoff_s (float): Seconds to wait before the first retry, doubled for every further retry
+        ydl_factory (function): Called with the ydl options to create a YoutubeDL instance (e.g. a fake extractor), None for yt_dlp.YoutubeDL
+
+    Returns:
+        prober (dict): Dict with the settings, the token bucket and its lock
+    """
+
+    burst = burst or max(workers, 1)
+
+    return {"workers": workers, "rate": rate, "burst": burst, "retries": retries, "backoff_s": backoff_s, "ydl_factory": ydl_factory,
+            "tokens": float(burst), "updated_at": time.monotonic(), "lock": threading.Lock(), "rng": random.Random()}
+
+
+def acquire_token(prober):
+    """
+    Waits until the token bucket of the prober allows another probe and takes a token. Safe to call from several threads.
+
+    Args:
+        prober (dict): Prober from define_prober
+    """
+
+    while True:
+        with prober["lock"]:
+            # refill tokens for the time passed since the last update
+            now = time.monotonic()
+            prober["tokens"] = min(prober["burst"], prober["tokens"] + (now - prober["updated_at"]) * prober["rate"])
+            prober["updated_at"] = now
+
+            if prober["tokens"] >= 1:
+                prober["tokens"] -= 1
+                return
+
+            wait = (1 - prober["tokens"]) / prober["rate"]
+
+        time.sleep(wait)
+
+
+def extract_with_retries(ydl, url, prober=None, metrics=None):
+    """
+    Gets the info dict of a video behind the rate limit of the prober, retrying transient errors with exponential backoff.
+    Permanent errors (see is_permanent_error) are never retried.
+
+    Args:
+        ydl (YoutubeDL): YoutubeDL instance
+        url (str): URL of the YouTube video
+        prober (dict): Prober from define_prober, None to get the info once without rate limit
+        metrics (dict): Metrics from define_metrics to count retries in, None to not count
+
+    Returns:
+        info_dict (dict): Info dict of the video
+    """
+
+    attempt = 0
+    while True:
+        if prober is not None:
+            acquire_token(prober)
 
-    # download videos
-    while n_downloads < n_vids and n_attempt < max_attempts:
-        url = video_urls[n_attempt]
-        n_attempt += 1
-    
         try:
-            success_fail = download_wav(outpath, url, max_duration=3000, min_duration=120)
-            n_downloads += success_fail
-        
-        except:
-            print("Error downloading video: ", url)
-        
-        # only append url if download was successful
-        if success_fail == 1:
-            used_urls.append(url)
-    
-    return used_urls
+            return ydl.extract_info(url, download=False)
+        except DownloadError as e:
+            if prober is None or attempt >= prober["retries"] or is_permanent_error(str(e)):
+                raise
 
-def transcribe_audio(filename, transcriber, audio_path):
+        # back off exponentially, with jitter so workers that failed together do not retry together
+        count(metrics, "probe_retries")
+        time.sleep(prober["backoff_s"] * 2**attempt * prober["rng"].uniform(0.5, 1.0))
+        attempt += 1
+
+
+def probe_video(ydl, url, video_store=None, metrics=None, prober=None, max_duration=1200, min_duration=120):
     """
-    Transcribes an audio file using the HuggingFace pipeline.
-    The transcription is done with timestamps in order to ensure proper chunking.
+    Probes a video once and decides whether it can be used.
+    If a video store is given, videos that are known to be unavailable or out of range are rejected without touching the network,
+    and the outcome of the probe is remembered for later runs.
 
     Args:
-        filename (str): Name of the audio file
-        transcriber (pipeline): HuggingFace pipeline for transcription
-        audio_path (pathlib.PosixPath): Path to audio file storage
-    
+        ydl (YoutubeDL): YoutubeDL instance that will also be used to get the audio
+        url (str): URL of the YouTube video
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        metrics (dict): Metrics from define_metrics to count probed and rejected videos in, None to not count
+        prober (dict): Prober from define_prober to rate limit and retry the probe with, None to probe once
+        max_duration (float): Maximum allowed duration of a video in seconds
+        min_duration (float): Minimum allowed duration of a video in seconds
+
     Returns:
-        text_chunks (list): List of text chunks from the transcription
+        info_dict (dict): Info dict of the video, None if the video can't be used
     """
 
-    # get audio file path
-    file_path = str(audio_path / filename)
+    # check what is already known about the video
+    video_id = video_id_from_url(url)
+    known = lookup_video(video_store, video_id) if video_store else None
 
-    # transcribe the audio
-    transcript_dict = transcriber(file_path, max_new_tokens = 448)
+    if known is not None:
+        # skip videos that failed permanently on an earlier run
+        if known["status"] == "unavailable":
+            print("Video unavailable on an earlier run, skipping to next..." + url)
+            count(metrics, "videos_rejected_unavailable")
+            return None
 
-    # get text chunks
-    text_chunks = transcript_dict['chunks']
+        # skip videos with a known duration out of range
+        if known["duration"] is not None and not check_duration(known["duration"], url, max_duration, min_duration):
+            count(metrics, "videos_rejected_" + rejection_reason(known["duration"], max_duration))
+            return None
 
-    # remove timestamps
-    text_chunks = [item["text"] for item in text_chunks]
+    # get info on video
+    count(metrics, "videos_probed")
+    try:
+        info_dict = extract_with_retries(ydl, url, prober, metrics)
+    except DownloadError as e:
+        # remember videos that will fail again (e.g. due to age or country restrictions)
+        if video_store and is_permanent_error(str(e)):
+            record_video(video_store, video_id, status="unavailable", error=str(e))
+        print("Error getting info on video, skipping to next..." + url)
+        count(metrics, "videos_rejected_error")
+        return None
 
-    return text_chunks
+    # check duration
+    duration = info_dict.get('duration')
 
-def main():
-    # define paths
-    inpath, outpath, audio_path = define_paths()
+    # remember the duration, so the video is never probed again
+    if video_store:
+        record_video(video_store, video_id, duration=duration, status="ok")
 
-    # load data from inpath
-    print("Loading data...")
-    data = pd.read_csv(inpath)
+    if not check_duration(duration, url, max_duration, min_duration):
+        count(metrics, "videos_rejected_" + rejection_reason(duration, max_duration))
+        return None
 
-    # initialize models
-    transcriber = pipeline('automatic-speech-recognition', 
-                           model='openai/whisper-base.en',
-                           chunk_length_s = 30, # must be 30 to chunk correctly
-                           return_timestamps=True)
-    
-    # create empty columns for later variables
-    data["transcript_chunks"] = None
-    data["video_urls"] = None
+    return info_dict
 
-    # loop through all channels
-    print("Downloading videos and transcribing...")
-    for i, row in tqdm(data.iterrows(), total = len(data)):
-        # get channel url
-        channel_url = row["channel_url"]
 
-        # get channel videos
-        video_urls = get_channel_vids(channel_url)
+def define_sampling(n_windows=0, window_s=30, max_seconds=None, max_mb=None):
+    """
+    Defines how videos are sampled and how much audio may be downloaded per channel.
+
+    Args:
+        n_windows (int): Number of windows spread across every video to download, 0 to download whole videos
+        window_s (float): Length of every window in seconds
+        max_seconds (float): Max seconds of audio downloaded per channel, None for no limit
+        max_mb (float): Max megabytes of audio downloaded per channel, None for no limit
 
-        # download videos
-        used_urls = download_channel(n_vids = 3, video_urls = video_urls, outpath = audio_path)
+    Returns:
+        sampling (dict): Dict with the number and length of windows and the per-channel budget, None if whole videos are downloaded without limits
+    """
 
-        # define empty list to store text chunks
-        all_text_chunks = []
+    if not n_windows and max_seconds is None and max_mb is None:
+        return None
 
-        # loop through all files in audio_path
-        for audio_file in os.listdir(audio_path):
-            # transcribe audio
-            text_chunks = transcribe_audio(audio_file, transcriber, audio_path)
+    return {"n_windows": n_windows, "window_s": window_s, "max_seconds": max_seconds,
+            "max_bytes": max_mb * 1024**2 if max_mb is not None else None}
 
-            # clean transcript
-            text_chunks_cln = clean_text(text_chunks)
 
-            # append all elements in text_chunks_cln to all_text_chunks
-            all_text_chunks.extend(text_chunks_cln)
+def define_budget():
+    """
+    Defines the audio downloaded so far for a channel.
 
-            # delete audio file
-            os.remove(audio_path / audio_file)
-        
-        # shuffle list
-        random.shuffle(all_text_chunks)
+    Returns:
+        budget (dict): Dict with the seconds and bytes downloaded
+    """
 
-        # append to dataframe
-        data.at[i, "video_urls"] = used_urls
-        data.at[i, "transcript_chunks"] = all_text_chunks
+    return {"seconds": 0.0, "bytes": 0}
+
+
+def budget_left(sampling, budget):
+    """
+    Checks whether more audio may be downloaded for a channel.
+
+    Args:
+        sampling (dict): Sampling from define_sampling, None for no limits
+        budget (dict): Budget from define_budget, None for no limits
+
+    Returns:
+        left (bool): True if the channel is within its budget
+    """
+
+    if sampling is None or budget is None:
+        return True
+
+    if sampling["max_seconds"] is not None and budget["seconds"] >= sampling["max_seconds"]:
+        return False
+
+    if sampling["max_bytes"] is not None and budget["bytes"] >= sampling["max_bytes"]:
+        return False
+
+    return True
+
+
+def sample_windows(duration, sampling):
+    """
+    Spreads windows evenly across a video, each centered in its own equal share of the video.
+    The windows are deterministic, so a video is always sampled the same way.
+
+    Args:
+        duration (float): Duration of the video in seconds
+        sampling (dict): Sampling from define_sampling, None to download whole videos
+
+    Returns:
+        windows (list): List of (start, end) tuples in seconds, None to download the whole video
+    """
+
+    if sampling is None or not sampling["n_windows"] or duration is None:
+        return None
+
+    n_windows, window_s = sampling["n_windows"], sampling["window_s"]
+
+    # windows cover the whole video anyway
+    if n_windows * window_s >= duration:
+        return None
+
+    share = duration / n_windows
+
+    return [(round(i * share + (share - window_s) / 2, 2), round(i * share + (share + window_s) / 2, 2)) for i in range(n_windows)]
+
+
+def sampled_seconds(duration, windows):
+    """
+    Calculates the seconds of audio downloaded for a video.
+
+    Args:
+        duration (float): Duration of the video in seconds
+        windows (list): List of (start, end) tuples in seconds, None for the whole video
+
+    Returns:
+        seconds (float): Seconds of audio downloaded
+    """
+
+    if windows is None:
+        return duration or 0.0
+
+    return sum(end - start for start, end in windows)
+
+
+def audio_format(sampling=None):
+    """
+    Defines the yt_dlp format of the audio, the same when probing and downloading so the probed info dict can be reused.
+
+    Args:
+        sampling (dict): Sampling from define_sampling, None to download whole videos
+
+    Returns:
+        format (str): yt_dlp format selector
+    """
+
+    # sampled windows are read in a low-bitrate format, as Whisper resamples to 16 kHz anyway
+    if sampling is not None and sampling["n_windows"]:
+        return 'bestaudio[abr<=64]/worstaudio/bestaudio/best'
+
+    return 'bestaudio/best'
+
+
+def download_wav(outpath, url, max_duration=1200, min_duration=120, video_store=None, metrics=None, sampling=None, budget=None, info_dict=None):
+    """
+    Downloads a .wav file from a YouTube video.
+    The video is probed once (see probe_video) and the same info dict is used for the download.
+    NOTE: This is immediately deleted after the audio has been transcribed to comply with YouTube's terms of service and save memory.
+
+    Args:
+        outpath (pathlib.PosixPath): Path to output
+        url (str): URL of the YouTube video
+        max_duration (int): Maximum allowed duration of a video in seconds (check channel_reqs.md for more info)
+        min_duration (int): Minimum allowed duration of a video in seconds (check channel_reqs.md for more info)
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        metrics (dict): Metrics from define_metrics to count probed and rejected videos in, None to not count
+        sampling (dict): Sampling from define_sampling, None to download the whole video
+        budget (dict): Budget from define_budget to add the downloaded seconds and bytes to, None to not track them
+        info_dict (dict): Info dict of a video that was already probed (see probe_candidates), None to probe it here with the duration limits above
+
+    Returns:
+        success_fail (int): 1 if the download was successful, 0 if it failed.
+    """
+
+    # initialize ydl options
+    ydl_opts = {
+    'outtmpl': str(outpath) + '/%(title)s.%(ext)s',
+    'format': audio_format(sampling), # downloads best audio
+    'quiet': True,
+    'postprocessors': [{
+    'key': 'FFmpegExtractAudio',
+    'preferredcodec': 'wav' # use .wav format
+}],
+    }
+
+    # sampled windows are saved as one file each
+    if sampling is not None and sampling["n_windows"]:
+        ydl_opts['outtmpl'] = str(outpath) + '/%(title)s.%(section_start)s.%(ext)s'
+
+    # count downloaded bytes
+    if budget is not None:
+        def count_bytes(d):
+            if d["status"] == "finished":
+                budget["bytes"] += d.get("total_bytes") or d.get("downloaded_bytes") or 0
+
+        ydl_opts['progress_hooks'] = [count_bytes]
+
+    with YoutubeDL(ydl_opts) as ydl:
+        # probe video, unless it was probed already
+        if info_dict is None:
+            info_dict = probe_video(ydl, url, video_store, metrics, max_duration=max_duration, min_duration=min_duration)
+        if info_dict is None:
+            return 0 # return 0 for fail
+
+        # only download the sampled windows of the video
+        windows = sample_windows(info_dict.get('duration'), sampling)
+        if windows is not None:
+            ydl.params['download_ranges'] = download_range_func(None, windows)
+
+        # attempt to download the video, reusing the info dict from the probe
+        try:
+            ydl.process_ie_result(info_dict, download=True)
+            if budget is not None:
+                budget["seconds"] += sampled_seconds(info_dict.get('duration'), windows)
+            return 1 # return 1 for success
+        except DownloadError as e:
+            if video_store and is_permanent_error(str(e)):
+                record_video(video_store, video_id_from_url(url), status="unavailable", error=str(e))
+            count(metrics, "videos_rejected_error")
+            return 0 # return 0 for a failed download
+
+
+def decode_audio(source, headers=None, sampling_rate=16000, start=None, duration=None):
+    """
+    Decodes audio with ffmpeg straight into memory as mono float32 samples, the input format Whisper expects.
+
+    Args:
+        source (str): URL or path of the audio
+        headers (dict): HTTP headers needed to read the URL
+        sampling_rate (int): Sampling rate to resample the audio to
+        start (float): Second to start decoding at, None to start at the beginning
+        duration (float): Seconds to decode, None to decode until the end
+
+    Returns:
+        audio (np.ndarray): Array of mono float32 samples at sampling_rate
+    """
+
+    # define ffmpeg command that writes raw samples to stdout
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+    if headers:
+        command += ["-headers", "".join(f"{key}: {value}\r\n" for key, value in headers.items())]
+    if start is not None:
+        command += ["-ss", str(start)] # seek before opening the input, so only the window is fetched
+    command += ["-i", source]
+    if duration is not None:
+        command += ["-t", str(duration)]
+    command += ["-f", "f32le", "-ac", "1", "-ar", str(sampling_rate), "-"]
+
+    # decode the audio
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+
+    return np.frombuffer(output, dtype=np.float32)
+
+
+def stream_audio(url, video_store=None, sampling_rate=16000, metrics=None, sampling=None, budget=None, info_dict=None):
+    """
+    Streams the audio of a YouTube video into memory as 16 kHz mono float32 samples, without writing any files.
+    The video is probed once (see probe_video) and the audio url from the same info dict is decoded by ffmpeg.
+    NOTE: The audio only lives in memory until it has been transcribed to comply with YouTube's terms of service.
+
+    Args:
+        url (str): URL of the YouTube video
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        sampling_rate (int): Sampling rate to resample the audio to
+        metrics (dict): Metrics from define_metrics to count probed and rejected videos in, None to not count
+        sampling (dict): Sampling from define_sampling, None to decode the whole video
+        budget (dict): Budget from define_budget to add the decoded seconds and (estimated) bytes to, None to not track them
+        info_dict (dict): Info dict of a video that was already probed (see probe_candidates), None to probe it here
+
+    Returns:
+        audio (np.ndarray): Array of mono float32 samples, None if the video can't be used. Sampled windows are concatenated.
+    """
+
+    # probe video, unless it was probed already
+    if info_dict is None:
+        with YoutubeDL({'format': audio_format(sampling), 'quiet': True}) as ydl:
+            info_dict = probe_video(ydl, url, video_store, metrics)
+        if info_dict is None:
+            return None
+
+    # get url of the selected audio format
+    audio_url = info_dict.get("url")
+    if audio_url is None:
+        print("No direct audio url for video, skipping to next..." + url)
+        count(metrics, "videos_rejected_error")
+        return None
+
+    # decode the audio, or only the sampled windows of it
+    windows = sample_windows(info_dict.get("duration"), sampling)
+    try:
+        if windows is None:
+            audio = decode_audio(audio_url, headers=info_dict.get("http_headers"), sampling_rate=sampling_rate)
+        else:
+            audio = np.concatenate([decode_audio(audio_url, headers=info_dict.get("http_headers"), sampling_rate=sampling_rate, start=start, duration=end - start)
+                                    for start, end in windows])
+    except subprocess.CalledProcessError:
+        print("Error decoding audio of video, skipping to next..." + url)
+        count(metrics, "videos_rejected_error")
+        return None
+
+    # ffmpeg does not report bytes read, so estimate them from the bitrate (in kbit/s) of the format
+    if budget is not None:
+        seconds = sampled_seconds(info_dict.get("duration"), windows)
+        budget["seconds"] += seconds
+        budget["bytes"] += int((info_dict.get("abr") or 0) * 1000 / 8 * seconds)
+
+    return audio
+
+
+def probe_url(url, prober=None, video_store=None, metrics=None, sampling=None):
+    """
+    Probes a single video behind the rate limit of the prober, with a YoutubeDL instance of its own (they are not thread-safe).
+
+    Args:
+        url (str): URL of the YouTube video
+        prober (dict): Prober from define_prober, None to probe once without rate limit or retries
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        metrics (dict): Metrics from define_metrics to count probed and rejected videos in, None to not count
+        sampling (dict): Sampling from define_sampling, decides the audio format that is probed
+
+    Returns:
+        info_dict (dict): Info dict of the video, None if the video can't be used
+    """
+
+    ydl_factory = (prober["ydl_factory"] if prober is not None else None) or YoutubeDL
+
+    with ydl_factory({'format': audio_format(sampling), 'quiet': True}) as ydl:
+        return probe_video(ydl, url, video_store, metrics, prober)
+
+
+def probe_candidates(video_urls, prober=None, video_store=None, metrics=None, sampling=None, needs_probe=None):
+    """
+    Probes the candidate videos of a channel and yields the usable ones in listing order, so the same videos are selected as when
+    probing one by one. Up to prober["workers"] videos ahead are probed at once behind the rate limit of the prober, so the next
+    usable video is usually known by the time the current one is downloaded.
+    Iteration can stop at any time (e.g. once n_vids videos are found): probes that have not started yet are then cancelled,
+    and probes that are running finish in the background without being waited for.
+
+    Args:
+        video_urls (list): List of video urls in listing order
+        prober (dict): Prober from define_prober, None to probe one video ahead without rate limit or retries
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        metrics (dict): Metrics from define_metrics to count probed and rejected videos in, None to not count
+        sampling (dict): Sampling from define_sampling, decides the audio format that is probed
+        needs_probe (function): Called with a url, returns False for videos that need no probe (e.g. with a cached transcript), None to probe all
+
+    Yields:
+        url (str): URL of a usable video
+        info_dict (dict): Info dict of the video, None if it was not probed
+    """
+
+    workers = prober["workers"] if prober is not None else 1
+
+    def probe(url):
+        return probe_url(url, prober, video_store, metrics, sampling)
+
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+    candidates = iter(video_urls)
+    pending = deque()
+
+    def submit_next():
+        url = next(candidates, None)
+        if url is not None:
+            pending.append((url, executor.submit(probe, url) if needs_probe is None or needs_probe(url) else None))
+
+    try:
+        # probe the first candidates at once
+        for _ in range(max(workers, 1)):
+            submit_next()
+
+        while pending:
+            url, future = pending.popleft()
+            submit_next()
+
+            # videos that need no probe are passed on as they are
+            if future is None:
+                yield url, None
+                continue
+
+            try:
+                info_dict = future.result()
+            except Exception:
+                print("Error probing video, skipping to next..." + url)
+                count(metrics, "videos_rejected_error")
+                continue
+
+            if info_dict is not None:
+                yield url, info_dict
+    finally:
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
+
+
+def download_channel(n_vids, video_urls, outpath, video_store=None, metrics=None, sampling=None, prober=None):
+    """
+    Uses download_wav function to download videos from a channel, the number is determined by n_vids.
+    Candidates are probed ahead (see probe_candidates) and downloaded in listing order until n_vids downloads succeeded.
+
+    Args:
+        n_vids (int): Number of videos to be downloaded
+        video_urls (list): List of video urls
+        outpath (pathlib.PosixPath): Path to output
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        metrics (dict): Metrics from define_metrics to count probed, rejected and downloaded videos in, None to not count
+        sampling (dict): Sampling from define_sampling, None to download whole videos without limits
+        prober (dict): Prober from define_prober, None to probe one video ahead without rate limit or retries
+    
+    Returns:
+        used_urls (list): List of urls that were used to download videos
+    """
+
+    # initialize list of used urls
+    used_urls = []
+
+    # track audio downloaded for the channel
+    budget = define_budget()
+
+    # download videos, checking before waiting for the next probe
+    candidates = probe_candidates(video_urls, prober, video_store, metrics, sampling)
+    try:
+        while len(used_urls) < n_vids:
+            # stop when the channel has used up its budget
+            if not budget_left(sampling, budget):
+                print("Download budget of channel used up, skipping remaining videos...")
+                break
+
+            # stop when no usable candidates are left
+            url, info_dict = next(candidates, (None, None))
+            if url is None:
+                break
+
+            try:
+                success_fail = download_wav(outpath, url, max_duration=1200, min_duration=120, video_store=video_store, metrics=metrics, sampling=sampling, budget=budget, info_dict=info_dict)
+            except Exception:
+                print("Error downloading video: ", url)
+                count(metrics, "videos_rejected_error")
+                success_fail = 0
+
+            # only append url if download was successful
+            if success_fail == 1:
+                used_urls.append(url)
+                count(metrics, "videos_downloaded")
+    finally:
+        candidates.close()
+
+    return used_urls
+
+def transcribe_audio(filename, transcriber, audio_path):
+    """
+    Transcribes an audio file using the HuggingFace pipeline.
+    The transcription is done with timestamps in order to ensure proper chunking.
+
+    Args:
+        filename (str): Name of the audio file
+        transcriber (pipeline): HuggingFace pipeline for transcription
+        audio_path (pathlib.PosixPath): Path to audio file storage
+    
+    Returns:
+        text_chunks (list): List of text chunks from the transcription
+    """
+
+    # get audio file path
+    file_path = str(audio_path / filename)
+
+    # transcribe the audio
+    with torch.inference_mode():
+        transcript_dict = transcriber(file_path, max_new_tokens = 448)
+
+    # get text chunks
+    text_chunks = transcript_dict['chunks']
+
+    # remove timestamps
+    text_chunks = [item["text"] for item in text_chunks]
+
+    return text_chunks
+
+def transcribe_batch(inputs, transcriber, batch_size=8):
+    """
+    Transcribes several audio inputs in one call to the HuggingFace pipeline.
+    The pipeline cuts every input into 30 second windows and packs windows from all inputs into batches of batch_size.
+
+    Args:
+        inputs (list): List of paths to audio files or dicts with "raw" (np.ndarray) and "sampling_rate" (int) for audio in memory
+        transcriber (pipeline): HuggingFace pipeline for transcription
+        batch_size (int): Number of 30 second windows decoded in one forward pass
+
+    Returns:
+        all_chunks (list): List with the timestamped chunks of every input, e.g. [{"timestamp": (0.0, 4.2), "text": "..."}]
+    """
+
+    # no inputs, no transcripts
+    if not inputs:
+        return []
+
+    # transcribe the audio, the pipeline pops "raw" and "sampling_rate" from dicts, so it gets copies and the inputs stay readable
+    with torch.inference_mode():
+        transcript_dicts = transcriber([str(audio) if isinstance(audio, Path) else dict(audio) for audio in inputs], batch_size = batch_size, max_new_tokens = 448)
+
+    # get timestamped chunks of every input
+    all_chunks = [transcript_dict['chunks'] for transcript_dict in transcript_dicts]
+
+    return all_chunks
+
+
+def transcribe_speech(inputs, transcriber, batch_size=8, sampling_rate=16000):
+    """
+    Transcribes only the speech in several audio inputs, like transcribe_batch.
+    Speech regions of every input are found with detect_speech and concatenated, so Whisper never sees silence or non-verbal
+    segments. Timestamps of the chunks are mapped back to the original audio.
+
+    Args:
+        inputs (list): List of paths to audio files or dicts with "raw" (np.ndarray) and "sampling_rate" (int) for audio in memory
+        transcriber (pipeline): HuggingFace pipeline for transcription
+        batch_size (int): Number of 30 second windows decoded in one forward pass
+        sampling_rate (int): Sampling rate to decode audio files to
+
+    Returns:
+        all_chunks (list): List with the timestamped chunks of every input, empty for inputs without speech
+        total_seconds (float): Length of all inputs in seconds
+        speech_seconds (float): Length of the speech that was transcribed in seconds
+    """
+
+    # decode audio files into memory
+    audios = [decode_audio(str(audio), sampling_rate=sampling_rate) if isinstance(audio, Path) else audio["raw"] for audio in inputs]
+
+    # detect speech regions, and only transcribe inputs that have any
+    regions = [detect_speech(audio, sampling_rate) for audio in audios]
+    has_speech = [i for i, input_regions in enumerate(regions) if len(input_regions)]
+    speech_chunks = transcribe_batch([{"raw": compact_speech(audios[i], regions[i]), "sampling_rate": sampling_rate} for i in has_speech], transcriber, batch_size = batch_size)
+
+    # map timestamps back to the original audio
+    all_chunks = [[] for _ in inputs]
+    for i, chunks in zip(has_speech, speech_chunks):
+        all_chunks[i] = restore_timestamps(chunks, regions[i], sampling_rate)
+
+    total_seconds = sum(len(audio) for audio in audios) / sampling_rate
+
+    return all_chunks, total_seconds, sum(speech_seconds(input_regions, sampling_rate) for input_regions in regions)
+
+
+def audio_seconds(audio):
+    """
+    Gets the length of an audio input in seconds, for measuring the real-time factor of the transcriber.
+
+    Args:
+        audio: Path to a .wav file or dict with "raw" (np.ndarray) and "sampling_rate" (int) for audio in memory
+
+    Returns:
+        seconds (float): Length of the audio in seconds, 0 if it can't be read
+    """
+
+    if isinstance(audio, dict):
+        return len(audio["raw"]) / audio["sampling_rate"]
+
+    try:
+        with wave.open(str(audio), "rb") as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError, OSError):
+        return 0.0
+
+
+def chunk_texts(chunks):
+    """
+    Removes timestamps from timestamped chunks, giving the text chunks that clean_text expects.
+
+    Args:
+        chunks (list): List of timestamped chunks from the HuggingFace pipeline
+
+    Returns:
+        text_chunks (list): List of text chunks
+    """
+
+    return [item["text"] for item in chunks]
+
+
+def put_until_stopped(q, item, stop_event):
+    """
+    Puts an item on a bounded queue, giving up if the pipeline is stopped while waiting for a free slot.
+
+    Args:
+        q (queue.Queue): Queue to put the item on
+        item (tuple): Item to put on the queue
+        stop_event (threading.Event): Event signalling that the pipeline is stopped
+
+    Returns:
+        put (bool): True if the item was put on the queue, False if the pipeline was stopped
+    """
+
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def get_until_stopped(q, stop_event):
+    """
+    Gets an item from a queue, giving up if the pipeline is stopped while waiting.
+
+    Args:
+        q (queue.Queue): Queue to get the item from
+        stop_event (threading.Event): Event signalling that the pipeline is stopped
+
+    Returns:
+        item (tuple): Item from the queue, None if the pipeline was stopped or the upstream stage is done
+    """
+
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+    return None
+
+
+def download_stage(channels, n_vids, audio_path, audio_queue, stop_event, listing_ttl=6*60*60, video_store=None, resume=None, transcript_cache=None, stream=False, metrics=None, sampling=None, prober=None, known=None):
+    """
+    First stage of the pipeline: gets video urls (step 2) and downloads .wav files (step 3) for every channel.
+    Each video is downloaded to its own temporary folder so the next stage knows exactly which files belong to it.
+    In streaming mode the audio is decoded straight into memory instead, and no files are written.
+    Follows the same selection logic as download_channel, with candidates probed ahead (see probe_candidates).
+
+    Args:
+        channels (list): List of (channel index, channel url) tuples
+        n_vids (int): Number of videos to be downloaded per channel
+        audio_path (pathlib.PosixPath): Path to temporary audio storage
+        audio_queue (queue.Queue): Bounded queue to put downloaded videos on
+        stop_event (threading.Event): Event signalling that the pipeline is stopped
+        listing_ttl (float): Max age of a cached channel listing in seconds
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        resume (dict): Dict from channel index to urls of videos that are already done on an earlier run
+        transcript_cache (dict): Transcript cache from define_transcript_cache, None to always download and transcribe
+        stream (bool): Whether to stream audio into memory instead of downloading .wav files
+        metrics (dict): Metrics from define_metrics, None to not collect metrics
+        sampling (dict): Sampling from define_sampling, None to download whole videos without limits
+        prober (dict): Prober from define_prober, shared by all channels, None to probe one video ahead without rate limit or retries
+        known (dict): Dict from channel index to urls of videos processed on earlier runs. They are kept in listing order without
+                      being downloaded again, and count towards n_vids once they are reached (unlike resume, which counts upfront).
+    """
+
+    for channel_idx, channel_url in channels:
+        # get channel videos
+        with time_stage(metrics, "list"):
+            try:
+                videos = list_channel_videos(channel_url, ttl=listing_ttl)
+            except Exception:
+                print("Error getting videos from channel: ", channel_url)
+                videos = []
+        count(metrics, "videos_listed", len(videos))
+
+        # remember durations from the listing, so out of range videos (e.g. Shorts) are never probed
+        if video_store:
+            for video in videos:
+                if video["duration"] is not None:
+                    record_video(video_store, video["id"], duration=video["duration"])
+
+        video_urls = [video["url"] for video in videos]
+
+        # initialize list of used urls with videos that are already done
+        used_urls = list((resume or {}).get(channel_idx, []))
+
+        # videos processed on earlier runs, by id as their urls may be written differently
+        known_ids = {video_id_from_url(url) for url in (known or {}).get(channel_idx, [])}
+
+        # track audio downloaded for the channel
+        budget = define_budget()
+
+        # videos that are already done, known or have a cached transcript need no probe
+        def needs_probe(url):
+            return url not in used_urls and video_id_from_url(url) not in known_ids and not (transcript_cache and transcript_cache_file(transcript_cache, video_id_from_url(url)).exists())
+
+        # probe candidates ahead, checking before waiting for the next probe
+        candidates = probe_candidates(video_urls, prober, video_store, metrics, sampling, needs_probe)
+        try:
+            while len(used_urls) < n_vids and not stop_event.is_set():
+                # stop when no usable candidates are left
+                url, info_dict = next(candidates, (None, None))
+                if url is None:
+                    break
+
+                # skip videos that are already done
+                if url in used_urls:
+                    continue
+
+                # keep videos that were processed on earlier runs
+                if video_id_from_url(url) in known_ids:
+                    used_urls.append(url)
+                    count(metrics, "videos_known")
+                    continue
+
+                # videos with a cached transcript need neither download nor transcription
+                all_chunks = read_transcript(transcript_cache, video_id_from_url(url)) if transcript_cache else None
+                if all_chunks is not None:
+                    used_urls.append(url)
+                    count(metrics, "videos_cached")
+                    if not put_until_stopped(audio_queue, ("cached", channel_idx, url, all_chunks), stop_event):
+                        return
+                    continue
+
+                # stop downloading when the channel has used up its budget
+                if not budget_left(sampling, budget):
+                    print("Download budget of channel used up, skipping remaining videos: ", channel_url)
+                    break
+
+                # stream audio into memory
+                if stream:
+                    with time_stage(metrics, "download"):
+                        try:
+                            audio = stream_audio(url, video_store=video_store, metrics=metrics, sampling=sampling, budget=budget, info_dict=info_dict)
+                        except Exception:
+                            print("Error streaming video: ", url)
+                            count(metrics, "videos_rejected_error")
+                            audio = None
+
+                    if audio is not None:
+                        used_urls.append(url)
+                        count(metrics, "videos_downloaded")
+
+                        # blocks while the queue is full, which keeps the amount of audio in memory bounded
+                        if not put_until_stopped(audio_queue, ("audio", channel_idx, url, audio), stop_event):
+                            return
+                    continue
+
+                # download video to its own temporary folder
+                video_path = Path(tempfile.mkdtemp(dir=audio_path))
+
+                with time_stage(metrics, "download"):
+                    try:
+                        success_fail = download_wav(video_path, url, max_duration=1200, min_duration=120, video_store=video_store, metrics=metrics, sampling=sampling, budget=budget, info_dict=info_dict)
+                    except Exception:
+                        print("Error downloading video: ", url)
+                        count(metrics, "videos_rejected_error")
+                        success_fail = 0
+
+                # only keep videos that actually left an audio file
+                if success_fail == 1 and os.listdir(video_path):
+                    used_urls.append(url)
+                    count(metrics, "videos_downloaded")
+
+                    # blocks while the queue is full, which keeps the number of files in audio_path bounded
+                    if not put_until_stopped(audio_queue, ("video", channel_idx, url, video_path), stop_event):
+                        shutil.rmtree(video_path, ignore_errors=True)
+                        return
+                else:
+                    shutil.rmtree(video_path, ignore_errors=True)
+        finally:
+            candidates.close()
+
+        # count audio downloaded for the channel
+        count(metrics, "download_seconds", budget["seconds"])
+        count(metrics, "download_bytes", budget["bytes"])
+
+        # mark channel as done so later stages can finish it
+        if not put_until_stopped(audio_queue, ("channel", channel_idx, used_urls), stop_event):
+            return
+
+
+def transcribe_stage(transcriber, audio_queue, text_queue, stop_event, asr_batch_size=1, transcript_cache=None, metrics=None, vad=False):
+    """
+    Second stage of the pipeline: transcribes downloaded videos (step 4) and deletes the audio afterwards.
+    When asr_batch_size is above 1, every video that is already waiting on the queue (up to asr_batch_size, across channels)
+    is transcribed in one batched call, so 30 second windows from several files share the same forward passes.
+
+    Args:
+        transcriber (pipeline): HuggingFace pipeline for transcription
+        audio_queue (queue.Queue): Queue to get downloaded videos from
+        text_queue (queue.Queue): Bounded queue to put transcripts on
+        stop_event (threading.Event): Event signalling that the pipeline is stopped
+        asr_batch_size (int): Number of 30 second windows decoded in one forward pass, also the max number of videos gathered per call
+        transcript_cache (dict): Transcript cache from define_transcript_cache, None to not cache transcripts
+        metrics (dict): Metrics from define_metrics, None to not collect metrics
+        vad (bool): Whether to only transcribe speech regions found by voice-activity detection
+    """
+
+    while True:
+        item = get_until_stopped(audio_queue, stop_event)
+
+        # upstream stage is done or pipeline is stopped
+        if item is None:
+            return
+
+        # gather videos that are already waiting, keeping channel markers in their place
+        items = [item]
+        n_videos = int(item[0] in ("video", "audio"))
+        while items[-1] is not None and n_videos < asr_batch_size:
+            try:
+                items.append(audio_queue.get_nowait())
+            except queue.Empty:
+                break
+            n_videos += int(items[-1] is not None and items[-1][0] in ("video", "audio"))
+
+        # list audio inputs of all gathered videos, i.e. the files in their folder or the audio in memory
+        video_items = [item for item in items if item is not None and item[0] in ("video", "audio")]
+        video_inputs = [[item[3] / audio_file for audio_file in os.listdir(item[3])] if item[0] == "video" else [{"raw": item[3], "sampling_rate": 16000}]
+                        for item in video_items]
+
+        # transcribe all inputs in one batched call, then delete downloaded files
+        inputs = [audio for audio_inputs in video_inputs for audio in audio_inputs]
+        try:
+            if vad:
+                with time_stage(metrics, "transcribe"):
+                    all_chunks, total_seconds, transcribed_seconds = transcribe_speech(inputs, transcriber, batch_size = asr_batch_size)
+                count(metrics, "audio_seconds", total_seconds)
+                count(metrics, "speech_seconds", transcribed_seconds)
+            else:
+                with time_stage(metrics, "transcribe"):
+                    all_chunks = transcribe_batch(inputs, transcriber, batch_size = asr_batch_size)
+                if metrics is not None:
+                    count(metrics, "audio_seconds", sum(audio_seconds(audio) for audio in inputs))
+            count(metrics, "videos_transcribed", len(video_items))
+        finally:
+            for item in video_items:
+                if item[0] == "video":
+                    shutil.rmtree(item[3], ignore_errors=True)
+
+        # split transcripts back per video
+        file_chunks = []
+        offset = 0
+        for (_, channel_idx, url, _), audio_inputs in zip(video_items, video_inputs):
+            video_chunks = all_chunks[offset:offset + len(audio_inputs)]
+            file_chunks.append([chunk_texts(chunks) for chunks in video_chunks])
+            offset += len(audio_inputs)
+
+            # cache raw timestamped transcript of the video
+            if transcript_cache:
+                write_transcript(transcript_cache, video_id_from_url(url), video_chunks)
+
+        # forward transcripts and channel markers in their original order
+        file_chunks = iter(file_chunks)
+        for item in items:
+            if item is None:
+                return
+
+            if item[0] in ("video", "audio"):
+                item = ("video", item[1], item[2], next(file_chunks))
+
+            # cached transcripts only need their timestamps removed
+            elif item[0] == "cached":
+                item = ("video", item[1], item[2], [chunk_texts(chunks) for chunks in item[3]])
+
+            if not put_until_stopped(text_queue, item, stop_event):
+                return
+
+
+def run_stage(stage, out_queue, stop_event, errors, *args):
+    """
+    Runs a pipeline stage in a thread. On completion the downstream stage is told that no more items will arrive.
+    If the stage fails, the error is stored and the whole pipeline is stopped.
+
+    Args:
+        stage (function): Pipeline stage to run
+        out_queue (queue.Queue): Queue that the stage puts its items on
+        stop_event (threading.Event): Event signalling that the pipeline is stopped
+        errors (list): List to store errors from the stage in
+        *args: Arguments passed to the stage
+    """
+
+    try:
+        stage(*args)
+        put_until_stopped(out_queue, None, stop_event)
+
+    except Exception as e:
+        errors.append(e)
+        stop_event.set()
+
+
+def run_pipeline(channels, transcriber, audio_path, n_vids, queue_depth=2, asr_batch_size=1, listing_ttl=6*60*60, video_store=None, resume=None, on_video=None, transcript_cache=None, stream=False, metrics=None, vad=False, sampling=None, prober=None, known=None):
+    """
+    Runs steps 2-5 of the SafeTuber pipeline as overlapping stages connected by bounded queues.
+    Downloading happens in one thread and transcription in another, while cleaning and merging happens in the caller.
+    Hence, the next video (and the next channel) is downloaded while the current video is transcribed and cleaned.
+
+    Args:
+        channels (list): List of (channel index, channel url) tuples
+        transcriber (pipeline): HuggingFace pipeline for transcription
+        audio_path (pathlib.PosixPath): Path to temporary audio storage
+        n_vids (int): Number of videos to be downloaded per channel
+        queue_depth (int): Max number of downloaded videos waiting for transcription. At most queue_depth + asr_batch_size + 1 videos are in audio_path at once.
+        asr_batch_size (int): Number of 30 second windows decoded in one forward pass (1 transcribes one video at a time)
+        listing_ttl (float): Max age of a cached channel listing in seconds
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        resume (dict): Dict from channel index to urls of videos that are already done on an earlier run. They count towards n_vids but are not downloaded again.
+        on_video (function): Called as on_video(channel_idx, url, text_chunks) with the cleaned chunks of every video as soon as it is done.
+                             If it returns True, the pipeline stops early: no more videos are downloaded or transcribed, and channels
+                             in progress are yielded with the videos that are done so far.
+        transcript_cache (dict): Transcript cache from define_transcript_cache, None to always download and transcribe
+        stream (bool): Whether to stream audio into memory instead of downloading .wav files to audio_path. queue_depth then bounds memory instead of disk usage.
+        metrics (dict): Metrics from define_metrics to collect stage timings and counts in, None to not collect metrics
+        vad (bool): Whether to only transcribe speech regions found by voice-activity detection
+        sampling (dict): Sampling from define_sampling, None to download whole videos without limits
+        prober (dict): Prober from define_prober to probe candidate videos concurrently behind a rate limit, None to probe one video ahead
+        known (dict): Dict from channel index to urls of videos processed on earlier runs. They are kept when they are among the n_vids
+                      most recent usable videos, without being downloaded again, e.g. for an incremental refresh.
+
+    Yields:
+        channel_idx: Index of the channel as given in channels
+        used_urls (list): List of urls that were used to download videos, including resumed ones
+        all_text_chunks (list): Shuffled list of cleaned text chunks from all videos of the channel processed in this run
+    """
+
+    # bounded queues between the stages
+    audio_queue = queue.Queue(maxsize=queue_depth)
+    text_queue = queue.Queue(maxsize=queue_depth)
+
+    # shared state for stopping the pipeline and surfacing errors from the stages
+    stop_event = threading.Event()
+    errors = []
+
+    # start download and transcription stages
+    threads = [
+        threading.Thread(target=run_stage, args=(download_stage, audio_queue, stop_event, errors, channels, n_vids, audio_path, audio_queue, stop_event, listing_ttl, video_store, resume, transcript_cache, stream, metrics, sampling, prober, known), daemon=True),
+        threading.Thread(target=run_stage, args=(transcribe_stage, text_queue, stop_event, errors, transcriber, audio_queue, text_queue, stop_event, asr_batch_size, transcript_cache, metrics, vad), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    # cleaned text chunks and done urls per channel that is still in progress
+    channel_chunks = {}
+    channel_urls = {}
+    stopped_early = False
+
+    try:
+        while True:
+            item = get_until_stopped(text_queue, stop_event)
+
+            # all stages are done or the pipeline is stopped
+            if item is None:
+                break
+
+            if item[0] == "video":
+                _, channel_idx, url, file_chunks = item
+
+                # clean transcript of every file (step 5)
+                with time_stage(metrics, "clean"):
+                    text_chunks_cln = [text_chunk for text_chunks in file_chunks for text_chunk in clean_text(text_chunks)]
+                count(metrics, "chunks_raw", sum(len(text_chunks) for text_chunks in file_chunks))
+                count(metrics, "chunks_clean", len(text_chunks_cln))
+                channel_chunks.setdefault(channel_idx, []).extend(text_chunks_cln)
+                channel_urls.setdefault(channel_idx, list((resume or {}).get(channel_idx, []))).append(url)
+
+                # hand over the finished video, e.g. for checkpointing, and stop if asked to
+                if on_video is not None and on_video(channel_idx, url, text_chunks_cln):
+                    stopped_early = True
+                    break
+
+            else:
+                _, channel_idx, used_urls = item
+
+                # merge and shuffle transcripts of the channel
+                all_text_chunks = channel_chunks.pop(channel_idx, [])
+                channel_urls.pop(channel_idx, None)
+                random.shuffle(all_text_chunks)
+                count(metrics, "channels_done")
+
+                yield channel_idx, used_urls, all_text_chunks
+
+        # on an early stop, stop the other stages and hand over channels in progress as they are
+        if stopped_early:
+            stop_event.set()
+            for channel_idx, all_text_chunks in channel_chunks.items():
+                random.shuffle(all_text_chunks)
+                yield channel_idx, channel_urls[channel_idx], all_text_chunks
+
+    finally:
+        # stop remaining stages and wait for them to finish
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+        # delete audio that was downloaded but never transcribed
+        while not audio_queue.empty():
+            item = audio_queue.get()
+            if item is not None and item[0] == "video":
+                shutil.rmtree(item[3], ignore_errors=True)
+
+    # surface errors from the stages
+    if errors:
+        raise errors[0]
+
+
+def transcript_settings(vad=False, sampling=None):
+    """
+    Defines the generation settings that transcripts are cached under, so transcripts made with other settings are not reused.
+
+    Args:
+        vad (bool): Whether only speech regions are transcribed
+        sampling (dict): Sampling from define_sampling, None if whole videos are transcribed
+
+    Returns:
+        settings (dict): Generation settings of the transcriber
+    """
+
+    settings = {"chunk_length_s": 30, "return_timestamps": True, "max_new_tokens": 448}
+
+    # only add vad and windows when used, so transcripts cached before they existed stay valid
+    if vad:
+        settings["vad"] = True
+    if sampling is not None and sampling["n_windows"]:
+        settings["windows"] = [sampling["n_windows"], sampling["window_s"]]
+
+    return settings
+
+
+def chunk_table(data, checkpoint_path):
+    """
+    Creates a long-format table with one row per chunk from the checkpoints of a run.
+    Chunks keep their order within each video. Channels that are not complete are left out.
+
+    Args:
+        data (pd.DataFrame): Dataframe with name and channel_url columns
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+
+    Returns:
+        chunks (pd.DataFrame): Table of chunks
+    """
+
+    records = []
+
+    for _, row in data.iterrows():
+        complete, used_urls = load_channel_progress(checkpoint_path, row["channel_url"])
+
+        # skip channels that are not done yet
+        if not complete:
+            continue
+
+        # add one row per chunk of every video
+        for url in used_urls:
+            for chunk_index, text_chunk in enumerate(load_channel_chunks(checkpoint_path, row["channel_url"], [url])):
+                records.append({"channel_url": row["channel_url"], "name": row["name"], "video_id": video_id_from_url(url),
+                                "chunk_index": chunk_index, "text": text_chunk})
+
+    return chunks_frame(records)
+
+
+def known_videos(store):
+    """
+    Finds the videos of every channel that are already in the chunk tables, e.g. from the last run.
+
+    Args:
+        store (pd.DataFrame): Table of chunks with channel_url and video_id columns
+
+    Returns:
+        known (dict): Dict from channel url to urls of its videos. Chunks converted from CSV files have no video and are left out.
+    """
+
+    return {channel_url: ["https://www.youtube.com/watch?v=" + video_id for video_id in group["video_id"].dropna().unique()]
+            for channel_url, group in store.groupby("channel_url", sort=False)}
+
+
+def refresh_table(store, data, checkpoint_path):
+    """
+    Creates the table of chunks after an incremental refresh, with the window of videos that every refreshed channel used.
+    Chunks of new videos come from the checkpoints of the refresh and have no label yet, while chunks of kept videos come from the store
+    with their labels, so only new chunks are classified. Channels that were not refreshed keep their rows from the store.
+
+    Args:
+        store (pd.DataFrame): Table of chunks from earlier runs
+        data (pd.DataFrame): Dataframe with name and channel_url columns
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the refresh
+
+    Returns:
+        chunks (pd.DataFrame): Table of chunks
+    """
+
+    # chunks of every channel and video in the store
+    store_channels = {channel_url: group for channel_url, group in store.groupby("channel_url", sort=False)}
+    store_videos = {key: group for key, group in store.groupby(["channel_url", "video_id"], sort=False)}
+
+    records = []
+
+    for _, row in data.iterrows():
+        complete, used_urls = load_channel_progress(checkpoint_path, row["channel_url"])
+
+        # keep channels that were not refreshed as they are
+        if not complete:
+            if row["channel_url"] in store_channels:
+                records.extend(store_channels[row["channel_url"]].to_dict("records"))
+            continue
+
+        # add one row per chunk of every video in the window, in listing order
+        for url in used_urls:
+            text_chunks = load_video_chunks(checkpoint_path, row["channel_url"], url)
+
+            # new video
+            if text_chunks is not None:
+                records.extend({"channel_url": row["channel_url"], "name": row["name"], "video_id": video_id_from_url(url),
+                                "chunk_index": chunk_index, "text": text_chunk} for chunk_index, text_chunk in enumerate(text_chunks))
+
+            # kept video
+            elif (row["channel_url"], video_id_from_url(url)) in store_videos:
+                records.extend(store_videos[(row["channel_url"], video_id_from_url(url))].to_dict("records"))
+
+    return chunks_frame(records)
+
+
+def transcribed_export(data, chunks):
+    """
+    Creates the transcribed table in its CSV export format from a table of chunks, with one row per channel.
+
+    Args:
+        data (pd.DataFrame): Dataframe with a channel_url column
+        chunks (pd.DataFrame): Table of chunks
+
+    Returns:
+        data (pd.DataFrame): Dataframe with transcript_chunks and video_urls columns
+    """
+
+    # group chunks per channel
+    channel_chunks = {channel_url: group for channel_url, group in chunks.groupby("channel_url", sort=False)}
+
+    # create empty columns for later variables
+    data["transcript_chunks"] = None
+    data["video_urls"] = None
+
+    for i, row in data.iterrows():
+        group = channel_chunks.get(row["channel_url"])
+
+        # skip channels without chunks
+        if group is None:
+            continue
+
+        # shuffle transcripts of the channel, like merge_checkpoints
+        all_text_chunks = group["text"].tolist()
+        random.shuffle(all_text_chunks)
+
+        data.at[i, "video_urls"] = ["https://www.youtube.com/watch?v=" + video_id for video_id in group["video_id"].dropna().unique()]
+        data.at[i, "transcript_chunks"] = all_text_chunks
+
+    return data
+
+
+def main():
+    args = arg_parse()
+
+    # collect per-stage metrics of the run
+    metrics = define_metrics("transcriber")
+
+    # define paths
+    inpath, outpath, audio_path = define_paths()
+
+    # load data from inpath
+    print("Loading data...")
+    with time_stage(metrics, "load"):
+        data = pd.read_csv(inpath)
+
+    # define checkpoints of this run configuration, a refresh keeps its own
+    checkpoint_path = define_checkpoint_path(args.model, args.n_vids, refresh = args.refresh)
+    if args.restart:
+        clear_checkpoints(checkpoint_path)
+
+    # load chunks of earlier runs, whose videos are kept by a refresh instead of being processed again
+    chunks_path, classified_path, _ = define_storage_paths()
+    store = None
+    if args.refresh:
+        with time_stage(metrics, "load"):
+            store = read_chunk_store(chunks_path, classified_path)
+            store = store if store is not None else chunks_frame([])
+        store_urls = known_videos(store)
+
+    # find channels that are complete or partially done on earlier runs
+    channels = []
+    resume = {}
+    known = {}
+    for i, row in data.iterrows():
+        complete, done_urls = load_channel_progress(checkpoint_path, row["channel_url"])
+        if not complete:
+            channels.append((i, row["channel_url"]))
+
+            # new videos done by an interrupted refresh are kept like the videos of earlier runs
+            if args.refresh:
+                known[i] = store_urls.get(row["channel_url"], []) + done_urls
+            else:
+                resume[i] = done_urls
+
+    if not args.merge_only and channels:
+        print(f"Skipping {len(data) - len(channels)} channels that are already complete...")
+
+        # define how videos are sampled and how much audio may be downloaded per channel
+        sampling = define_sampling(args.sample_windows, args.window_s, args.channel_seconds, args.channel_mb)
+
+        # probe candidate videos concurrently, behind one rate limit for all channels
+        prober = define_prober(args.probe_workers, args.probe_rate, retries = args.probe_retries)
+
+        # initialize models on the chosen backend
+        with time_stage(metrics, "load_models"):
+            transcriber = build_transcriber(args.model, backend = args.asr_backend, intra_threads = args.intra_threads, inter_threads = args.inter_threads)
+
+        # commit every video to disk as soon as it is done
+        def on_video(i, url, text_chunks):
+            save_video_checkpoint(checkpoint_path, data.at[i, "channel_url"], url, text_chunks)
+
+        # cache raw transcripts per video, model and generation settings
+        transcript_cache = define_transcript_cache(backend_model_name(args.model, args.asr_backend), transcript_settings(args.vad, sampling), max_gb = args.transcript_cache_gb) if args.transcript_cache_gb > 0 else None
+
+        # download, transcribe and clean as overlapping stages
+        print("Downloading videos and transcribing...")
+        with time_stage(metrics, "pipeline"):
+            for i, used_urls, _ in tqdm(run_pipeline(channels, transcriber, audio_path, n_vids = args.n_vids, queue_depth = args.queue_depth, asr_batch_size = args.asr_batch_size, listing_ttl = args.listing_ttl*60*60, video_store = define_video_store(), resume = resume, on_video = on_video, transcript_cache = transcript_cache, stream = args.stream_audio, metrics = metrics, vad = args.vad, sampling = sampling, prober = prober, known = known or None), total = len(channels)):
+                # mark channel as complete
+                save_channel_checkpoint(checkpoint_path, data.at[i, "channel_url"], used_urls)
+
+        # report transcript cache hits and misses
+        if transcript_cache:
+            report_transcript_cache(transcript_cache)
+            count(metrics, "transcript_cache_hits", transcript_cache["hits"])
+            count(metrics, "transcript_cache_misses", transcript_cache["misses"])
+
+    # merge checkpoints into one row per chunk
+    print("Merging transcripts...")
+    with time_stage(metrics, "merge"):
+        if args.refresh:
+            # merge new videos into the window of every channel, keeping chunks and labels of known videos
+            chunks = refresh_table(store, data, checkpoint_path)
+            data = transcribed_export(data, chunks)
+        else:
+            chunks = chunk_table(data, checkpoint_path)
+
+            # merge checkpoints into one row per channel
+            data = merge_checkpoints(data, checkpoint_path)
+
+    # save chunk table and dataframe to outpath as export format
+    with time_stage(metrics, "save"):
+        write_table(chunks, chunks_path)
+        data.to_csv(outpath / "top-youtubers-transcribed.csv")
+    count(metrics, "chunks_stored", len(chunks))
+
+    # once every channel is merged, the next refresh starts from the chunk tables again
+    if args.refresh:
+        count(metrics, "chunks_unlabeled", int(chunks["label"].isna().sum()))
+        if all(load_channel_progress(checkpoint_path, channel_url)[0] for channel_url in data["channel_url"]):
+            clear_checkpoints(checkpoint_path)
 
-    # save dataframe to outpath
-    data.to_csv(outpath / "top-youtubers-transcribed.csv")
+    # write run report
+    write_run_report(metrics, args.metrics_path, args.prometheus)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
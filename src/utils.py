@@ -5,8 +5,13 @@ Author:
 Desc:
     Provides utility functions for the SafeTuber pipeline.
     It is concerned with functions for cleaning and processing the transcripts.
+
+    remove_long_chunks, remove_duplicates and concatenate_chunks describe the cleaning rules one pass at a time.
+    clean_text applies all three in a single linear pass (iter_clean_text) that gives exactly the same output.
 """
 
+from multiprocessing import Pool
+
 def remove_long_chunks(text_chunks):
     '''
     This function removes chunks that are too long.
@@ -122,6 +127,68 @@ def concatenate_chunks(text_chunks):
     return joined_chunks
 
 
+def iter_clean_text(text_chunks):
+    '''
+    Applies remove_long_chunks, remove_duplicates and concatenate_chunks in a single linear pass.
+    Chunks are consumed one at a time (e.g. as they are produced by Whisper) and cleaned, concatenated chunks are yielded as soon as they are complete.
+    Word counts are kept as running totals and the current string is only joined once it is yielded, so long runs of short chunks cost linear time.
+
+    Args:
+        text_chunks (iterable): iterable of unprocessed text chunks
+
+    Yields:
+        text_chunk (str): processed text chunk
+    '''
+
+    # previous chunk, for removing duplicates
+    prev_text = ""
+
+    # pieces, number of words and last character of the current string
+    current_parts = []
+    current_words = 0
+    current_last = ""
+
+    # whether any chunk made it through the first two passes
+    any_chunks = False
+
+    for text_chunk in text_chunks:
+
+        # if text is beyond maximum input length for classifier, we shorten to nearest punctuation
+        if len(text_chunk) > 512:
+            text_chunk = text_chunk[:512]
+            last_index = max(text_chunk.rfind(i) for i in ".?")
+            text_chunk = text_chunk[:last_index+1]
+
+        # if text of medium length, skip
+        n_words = len(text_chunk.split())
+        if n_words > 25:
+            continue
+
+        # if text is the same as previous text, skip
+        if text_chunk == prev_text:
+            continue
+        prev_text = text_chunk
+        any_chunks = True
+
+        # join current string with next string if current string is too short or it doesn't end in a period
+        if current_words < 10 or current_last != ".":
+            current_parts.append(" ")
+            current_parts.append(text_chunk)
+            current_words += n_words
+            current_last = text_chunk[-1] if text_chunk else " "
+
+        # yield current string if it's long enough
+        else:
+            yield "".join(current_parts).strip()
+            current_parts = [text_chunk]
+            current_words = n_words
+            current_last = text_chunk[-1] if text_chunk else ""
+
+    # yield the last string
+    if any_chunks:
+        yield "".join(current_parts).strip()
+
+
 def clean_text(text_chunks):
     '''
     Combines the above functions to clean the text chunks in single pipeline.
@@ -134,13 +201,28 @@ def clean_text(text_chunks):
         
     '''
 
-    # remove long chunks
-    text_chunks = remove_long_chunks(text_chunks)
+    # remove long chunks, remove duplicates and concatenate chunks in one pass
+    text_chunks_processed = list(iter_clean_text(text_chunks))
+
+    return text_chunks_processed
+
+
+def clean_texts(transcripts, processes=1):
+    '''
+    Cleans many transcripts at once, e.g. for re-cleaning the whole corpus after changing the cleaning rules.
 
-    # remove duplicates
-    text_chunks_no_dup = remove_duplicates(text_chunks)
+    Args:
+        transcripts (list): list of transcripts, each a list of unprocessed text chunks
+        processes (int): number of worker processes, 1 to clean in this process, None for one per CPU
+
+    Returns:
+        cleaned_transcripts (list): list of processed transcripts, in the same order
+    '''
 
-    # concatenate chunks
-    text_chunks_processed = concatenate_chunks(text_chunks_no_dup)
+    # clean in this process
+    if processes == 1:
+        return [clean_text(text_chunks) for text_chunks in transcripts]
 
-    return text_chunks_processed
\ No newline at end of file
+    # clean in worker processes, handing out several transcripts at a time
+    with Pool(processes) as pool:
+        return pool.map(clean_text, transcripts, chunksize = 16)
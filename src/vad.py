@@ -0,0 +1,196 @@
+""" vad.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Cheap voice-activity detection on decoded 16 kHz mono audio, run before Whisper so silence and non-verbal segments
+    (e.g. intros, gameplay without commentary, background music) are not transcribed.
+    These segments are also where Whisper tends to hallucinate repeated phrases, which remove_long_chunks cleans up afterwards.
+
+    Audio is cut in 30 ms frames and a frame counts as speech if it is both:
+        - loud, i.e. its energy is well above the noise floor of the video
+        - voiced, i.e. most of its energy lies in the speech band (300-3400 Hz)
+    Frames are then smoothed into regions (short pauses are bridged, short blips are dropped and regions are padded).
+    All steps are vectorised with numpy. It is an energy detector, so loud music with vocals will still pass.
+
+    Speech regions are concatenated into one array for the transcriber, so Whisper only spends 30 second windows on speech,
+    and timestamps of the transcript are mapped back to the original audio afterwards.
+"""
+
+import numpy as np
+
+
+def frame_features(audio, frame_length, sampling_rate=16000, block_size=4096):
+    """
+    Calculates the energy and speech-band share of non-overlapping frames.
+    Spectra are computed in blocks of frames, so memory stays bounded for long videos.
+
+    Args:
+        audio (np.ndarray): Array of mono float32 samples
+        frame_length (int): Number of samples per frame
+        sampling_rate (int): Sampling rate of the audio
+        block_size (int): Number of frames per block
+
+    Returns:
+        energy_db (np.ndarray): Energy of every frame in dB relative to full scale
+        band_share (np.ndarray): Share of the energy of every frame that lies in the speech band
+    """
+
+    # cut audio in frames, dropping the incomplete last frame
+    n_frames = len(audio) // frame_length
+    frames = audio[:n_frames * frame_length].reshape(n_frames, frame_length)
+
+    # energy per frame
+    energy_db = 10 * np.log10(np.mean(frames.astype(np.float64)**2, axis=1) + 1e-10)
+
+    # share of energy in the speech band per frame
+    freqs = np.fft.rfftfreq(frame_length, d=1/sampling_rate)
+    in_band = (freqs >= 300) & (freqs <= 3400)
+    window = np.hanning(frame_length).astype(np.float32)
+
+    band_share = np.empty(n_frames)
+    for start in range(0, n_frames, block_size):
+        power = np.abs(np.fft.rfft(frames[start:start + block_size] * window, axis=1))**2
+        band_share[start:start + block_size] = power[:, in_band].sum(axis=1) / (power.sum(axis=1) + 1e-10)
+
+    return energy_db, band_share
+
+
+def mask_regions(mask):
+    """
+    Finds runs of True in a boolean mask.
+
+    Args:
+        mask (np.ndarray): Boolean mask
+
+    Returns:
+        regions (np.ndarray): Array of shape (n, 2) with the start (inclusive) and end (exclusive) index of every run
+    """
+
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+
+    return np.stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)], axis=1)
+
+
+def merge_regions(regions, max_gap):
+    """
+    Merges regions that are separated by at most max_gap.
+
+    Args:
+        regions (np.ndarray): Array of shape (n, 2) with sorted start and end indices
+        max_gap (int): Max gap between regions that are merged
+
+    Returns:
+        regions (np.ndarray): Array of shape (m, 2) with merged regions
+    """
+
+    if len(regions) < 2:
+        return regions
+
+    # a region starts a new group if the gap to the previous region is too large
+    new_group = np.concatenate([[True], regions[1:, 0] - regions[:-1, 1] > max_gap])
+    ends_group = np.concatenate([new_group[1:], [True]])
+
+    return np.stack([regions[new_group, 0], regions[ends_group, 1]], axis=1)
+
+
+def detect_speech(audio, sampling_rate=16000, frame_ms=30, margin_db=12, min_db=-50, min_band_share=0.4, min_speech_s=0.3, min_silence_s=0.8, pad_s=0.2):
+    """
+    Detects speech regions in audio.
+
+    Args:
+        audio (np.ndarray): Array of mono float32 samples
+        sampling_rate (int): Sampling rate of the audio
+        frame_ms (int): Length of a frame in milliseconds
+        margin_db (float): Min energy above the noise floor (10th percentile of frame energies) for a frame to count as speech
+        min_db (float): Min energy relative to full scale for a frame to count as speech
+        min_band_share (float): Min share of energy in the speech band for a frame to count as speech
+        min_speech_s (float): Regions shorter than this are dropped
+        min_silence_s (float): Pauses shorter than this are bridged
+        pad_s (float): Padding added around every region, so word onsets and endings are kept
+
+    Returns:
+        regions (np.ndarray): Array of shape (n, 2) with the start and end sample of every speech region
+    """
+
+    frame_length = int(sampling_rate * frame_ms / 1000)
+
+    # too short to hold a single frame
+    if len(audio) < frame_length:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # classify frames as speech
+    energy_db, band_share = frame_features(audio, frame_length, sampling_rate)
+    noise_floor = np.percentile(energy_db, 10)
+    is_speech = (energy_db > max(noise_floor + margin_db, min_db)) & (band_share >= min_band_share)
+
+    # smooth frames into regions
+    regions = merge_regions(mask_regions(is_speech), max_gap = int(min_silence_s * 1000 / frame_ms))
+    regions = regions[regions[:, 1] - regions[:, 0] >= int(min_speech_s * 1000 / frame_ms)]
+
+    # pad regions and merge those that overlap after padding
+    pad = int(pad_s * 1000 / frame_ms)
+    regions = merge_regions(np.stack([np.maximum(regions[:, 0] - pad, 0), regions[:, 1] + pad], axis=1), max_gap = 0)
+
+    # convert frames to samples
+    return np.minimum(regions * frame_length, len(audio)).astype(np.int64)
+
+
+def compact_speech(audio, regions):
+    """
+    Concatenates the speech regions of audio into one array.
+
+    Args:
+        audio (np.ndarray): Array of mono float32 samples
+        regions (np.ndarray): Array of shape (n, 2) with the start and end sample of every speech region
+
+    Returns:
+        speech (np.ndarray): Array with the samples of all speech regions
+    """
+
+    return np.concatenate([audio[start:end] for start, end in regions]) if len(regions) else audio[:0]
+
+
+def restore_timestamps(chunks, regions, sampling_rate=16000):
+    """
+    Maps timestamps of a transcript of compacted speech back to the original audio.
+
+    Args:
+        chunks (list): List of timestamped chunks, e.g. [{"timestamp": (0.0, 4.2), "text": "..."}]
+        regions (np.ndarray): Array of shape (n, 2) with the start and end sample of every speech region
+        sampling_rate (int): Sampling rate of the audio
+
+    Returns:
+        chunks (list): List of chunks with timestamps in seconds of the original audio
+    """
+
+    if len(regions) == 0:
+        return chunks
+
+    # start of every region in the compacted audio
+    compact_starts = np.concatenate([[0], np.cumsum(regions[:, 1] - regions[:, 0])[:-1]])
+
+    def restore(t, side):
+        if t is None:
+            return None
+        sample = t * sampling_rate
+        region = max(int(np.searchsorted(compact_starts, sample, side=side)) - 1, 0)
+        return round(float(regions[region, 0] + sample - compact_starts[region]) / sampling_rate, 2)
+
+    # starts belong to the region that begins at a boundary, ends to the region that stops there
+    return [{**chunk, "timestamp": (restore(chunk["timestamp"][0], "right"), restore(chunk["timestamp"][1], "left"))} for chunk in chunks]
+
+
+def speech_seconds(regions, sampling_rate=16000):
+    """
+    Calculates the total length of speech regions.
+
+    Args:
+        regions (np.ndarray): Array of shape (n, 2) with the start and end sample of every speech region
+        sampling_rate (int): Sampling rate of the audio
+
+    Returns:
+        seconds (float): Length of all speech regions in seconds
+    """
+
+    return float((regions[:, 1] - regions[:, 0]).sum()) / sampling_rate
@@ -1,25 +1,67 @@
 """ visualizations.py
-Author: 
+Author:
     Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
 
 Desc:
     This script creates visualizations of the results of the classifier.
-    Concretely, it takes the top-youtubers-classified.csv file and creates three plots:
+    Concretely, it takes the per-channel summary (top-youtubers-summary.parquet, or top-youtubers-classified.csv if there is none) and creates three plots:
         1. A pie chart displaying the share of youtube channels with at least one toxic comment.
         2. A bar chart displaying the share of toxic comments by category.
         3. A bar chart displaying the most toxic channels.
-        
+    With --per_category, a bar chart of the most toxic channels of every category is created as well (in out/categories).
+
+    Figures are kept in a registry (FIGURES), where every figure has a function calculating the small table of aggregates it shows
+    and a function plotting that table. Only the summary columns are loaded, aggregates are calculated in the main process and
+    figures are rendered in parallel worker processes. A figure is skipped if the content hash of its aggregates (and of the plotting
+    code in this script) is the same as on its last render, so re-running after a refresh that changed nothing renders nothing.
+
 Usage:
     $ python src/visualizations.py
+    $ python src/visualizations.py --per_category --workers 4
 """
 
 
 # install packages
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import seaborn as sns
+from storage import define_storage_paths, read_table
+from cache import define_cache_path, cache_key, read_json_cache, write_json_cache
+import argparse
+import inspect
+import os
+import re
+
+
+def arg_parse():
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - The number of worker processes rendering figures
+    - The resolution of the figures
+    - Whether to also create a figure per category
+    - Whether to render all figures, also those that are unchanged
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Create visualizations of the classified YouTube channels')
+
+    # add arguments
+    parser.add_argument('-w', '--workers', default=os.cpu_count() or 1, type=int, help='Number of worker processes rendering figures')
+    parser.add_argument('--dpi', default=300, type=int, help='Resolution of the figures in dots per inch')
+    parser.add_argument('--per_category', action='store_true', help='Also create a bar chart of the most toxic channels of every category')
+    parser.add_argument('--force', action='store_true', help='Render all figures, also those whose aggregates did not change')
+
+    # parse arguments
+    args = parser.parse_args()
+
+    return args
 
 
 def define_paths():
@@ -42,9 +84,13 @@ def define_paths():
 def set_layout():
     """
     Sets general layout for matplotlib plots that will be used in all the visualizations.
+    Runs once in every worker process, which only saves figures to files.
 
     """
 
+    # render to files only, without a display
+    mpl.use("Agg")
+
     # set style to whitegrid for all plots
     sns.set_style("whitegrid")
 
@@ -52,31 +98,36 @@ def set_layout():
     mpl.rc('font', family='Times New Roman')
 
 
-
-def plot_share_of_toxic(data, results_path):
+def share_of_toxic_aggregates(data):
     '''
-    Plots a piechart displaying the share of youtube channels with at least one toxic comment.
-    Plot is saved as a png file in the out folder.
+    Counts the youtube channels with and without at least one toxic comment.
 
     Args:
         data (pd.DataFrame): dataframe with the results of the classifier
-        results_path (pathlib.PosixPath): path to out folder
-    '''
 
-    # get share of toxic channels
-    toxic_channels = data[data["n_toxic"] > 0]
+    Returns:
+        aggregates (pd.DataFrame): dataframe with a label and value per slice of the pie chart
+    '''
 
     # get share of toxic channels
-    n_toxic_channels = len(toxic_channels)
+    n_toxic_channels = int((data["n_toxic"] > 0).sum())
 
     # get share of non-toxic channels
     n_non_toxic_channels = len(data) - n_toxic_channels
 
-    # create labels
-    labels = ["Has Toxic Comments", "Does not have Toxic Comments"]
+    return pd.DataFrame({"label": ["Has Toxic Comments", "Does not have Toxic Comments"],
+                         "value": [n_toxic_channels, n_non_toxic_channels]})
+
+
+def plot_share_of_toxic(aggregates, file_path, dpi=300):
+    '''
+    Plots a piechart displaying the share of youtube channels with at least one toxic comment.
 
-    # create values
-    values = [n_toxic_channels, n_non_toxic_channels]
+    Args:
+        aggregates (pd.DataFrame): dataframe from share_of_toxic_aggregates
+        file_path (pathlib.PosixPath): path to save the plot to
+        dpi (int): resolution of the plot
+    '''
 
     # set the color palette
     colors = ['#FF6D6A', '#77DD77']
@@ -86,7 +137,7 @@ def plot_share_of_toxic(data, results_path):
     fig, ax = plt.subplots(figsize=(6, 6))
 
     # plot pie chart
-    ax.pie(values, labels=labels, autopct='%1.1f%%', shadow=False, startangle=90)
+    ax.pie(aggregates["value"], labels=aggregates["label"], autopct='%1.1f%%', shadow=False, startangle=90)
 
     # set title
     ax.set_title("Top 100: Share of Channels with at Least One Toxic Comment", fontsize=18, fontweight='bold')
@@ -96,24 +147,37 @@ def plot_share_of_toxic(data, results_path):
     fig.patch.set_facecolor('#F4E3CB')
 
     # save plot
-    plt.savefig(results_path / "share-of-toxic-channels.png", dpi=300, bbox_inches='tight')
+    fig.savefig(file_path, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
 
 
-def plot_toxicity_by_category(data, results_path):
+def toxicity_by_category_aggregates(data):
     '''
-    Plots a bar chart displaying the share of toxic comments by category.
-    Plot is saved as a png file in the out folder.
+    Calculates the share of toxic comments by category.
 
     Args:
         data (pd.DataFrame): dataframe with the results of the classifier
-        results_path (pathlib.PosixPath): path to out folder
+
+    Returns:
+        aggregates (pd.DataFrame): dataframe with categories and their mean share of toxic comments, most toxic first
     '''
 
     # get share of toxic comments by category
     share_toxic = data.groupby("categories")["pct_toxic"].mean().reset_index()
 
     # order by share of toxic comments
-    share_toxic = share_toxic.sort_values(by="pct_toxic", ascending=False)
+    return share_toxic.sort_values(by="pct_toxic", ascending=False).reset_index(drop=True)
+
+
+def plot_toxicity_by_category(aggregates, file_path, dpi=300):
+    '''
+    Plots a bar chart displaying the share of toxic comments by category.
+
+    Args:
+        aggregates (pd.DataFrame): dataframe from toxicity_by_category_aggregates
+        file_path (pathlib.PosixPath): path to save the plot to
+        dpi (int): resolution of the plot
+    '''
 
     # set the color palette
     colors = sns.color_palette("RdYlGn", n_colors=16)
@@ -121,46 +185,62 @@ def plot_toxicity_by_category(data, results_path):
 
     # create bar chart
     fig, ax = plt.subplots(figsize=(12, 6))
-    sns.barplot(x="categories", y="pct_toxic", data=share_toxic, ax=ax)
+    sns.barplot(x="categories", y="pct_toxic", data=aggregates, ax=ax)
 
     # set title and axis labels
     ax.set_title("Share of Toxic Comments by Channel Category", fontsize=24, fontweight='bold')
     ax.set_xlabel("Category", fontsize=14)
     ax.set_ylabel("Percentage of Toxic Comments", fontsize=14)
-    
+
 
     # space out x-axis labels
-    plt.xticks(rotation=45, ha="right")
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
 
     # set background color
     ax.set_facecolor('#F4E3CB')
     fig.patch.set_facecolor('#F4E3CB')
 
     # save plot
-    plt.savefig(results_path / "toxicity-by-category.png", dpi=300, bbox_inches='tight')
+    fig.savefig(file_path, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
 
 
-def plot_most_toxic_channels(data, results_path):
+def most_toxic_aggregates(data, n=10, average_name="Average (All Channels)"):
     '''
-    Plots a barchart showing the 10 most toxic channels in the top 100 as well as the average for all channels.
-    Plot is saved as a png file in the out folder.
+    Gets the most toxic channels as well as the average for all channels.
 
     Args:
         data (pd.DataFrame): dataframe with the results of the classifier
-        results_path (pathlib.PosixPath): path to out folder
+        n (int): number of channels to get
+        average_name (str): name of the bar with the average
+
+    Returns:
+        aggregates (pd.DataFrame): dataframe with name and pct_toxic of the most toxic channels, followed by the average
     '''
 
-    # get the 10 most toxic channels
-    most_toxic = data.sort_values(by="pct_toxic", ascending=False).head(10)
+    # get the most toxic channels
+    most_toxic = data.nlargest(n, "pct_toxic")[["name", "pct_toxic"]]
 
     # get the average toxicity for all channels
     avg_toxic = data["pct_toxic"].mean()
 
     # add average to dataframe
-    most_toxic = most_toxic.append({"name": "Average (All Channels)", "pct_toxic": avg_toxic}, ignore_index=True)
+    return pd.concat([most_toxic, pd.DataFrame([{"name": average_name, "pct_toxic": avg_toxic}])], ignore_index=True)
+
+
+def plot_most_toxic_channels(aggregates, file_path, dpi=300, title="The Most Toxic Channels in the Top 100"):
+    '''
+    Plots a barchart showing the most toxic channels as well as the average for all channels.
+
+    Args:
+        aggregates (pd.DataFrame): dataframe from most_toxic_aggregates
+        file_path (pathlib.PosixPath): path to save the plot to
+        dpi (int): resolution of the plot
+        title (str): title of the plot
+    '''
 
     # set color palette
-    n = len(most_toxic)
+    n = len(aggregates)
     colors = sns.color_palette("Reds_r", n_colors=n)
     sns.set_palette(colors)
 
@@ -168,44 +248,161 @@ def plot_most_toxic_channels(data, results_path):
     fig, ax = plt.subplots(figsize=(10, 6))
 
     # plot bar chart
-    sns.barplot(x="name", y="pct_toxic", data=most_toxic, ax=ax)
+    sns.barplot(x="name", y="pct_toxic", data=aggregates, ax=ax)
 
     # set title
-    ax.set_title("The Most Toxic Channels in the Top 100", fontsize=24, fontweight='bold')
+    ax.set_title(title, fontsize=24, fontweight='bold')
 
     # set x and y axis labels
     ax.set_xlabel("Channel Name", fontsize=14)
     ax.set_ylabel("Percentage of Toxic Comments", fontsize=14)
 
     # space out x-axis labels
-    plt.xticks(rotation=45, ha="right")
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
 
     # set background color
     ax.set_facecolor('#F4E3CB')
     fig.patch.set_facecolor('#F4E3CB')
 
     # save plot
-    plt.savefig(results_path / "most-toxic-channels.png", dpi=300, bbox_inches='tight')
+    fig.savefig(file_path, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
 
 
-def main():
-    # define paths
-    results_path = define_paths()
+def plot_category_channels(aggregates, file_path, dpi=300):
+    '''
+    Plots a barchart showing the most toxic channels of a category as well as the average for the category.
 
-    # load data
-    data = pd.read_csv(results_path / "top-youtubers-classified.csv")
+    Args:
+        aggregates (pd.DataFrame): dataframe from most_toxic_aggregates on the channels of the category, with a categories column
+        file_path (pathlib.PosixPath): path to save the plot to
+        dpi (int): resolution of the plot
+    '''
+
+    plot_most_toxic_channels(aggregates.drop(columns="categories"), file_path, dpi=dpi,
+                             title=f"The Most Toxic {aggregates['categories'].iloc[0]} Channels")
+
+
+# registry of figures, from the name of the figure (and its .png file) to the functions calculating and plotting its aggregates
+FIGURES = {"share-of-toxic-channels": (share_of_toxic_aggregates, plot_share_of_toxic),
+           "toxicity-by-category": (toxicity_by_category_aggregates, plot_toxicity_by_category),
+           "most-toxic-channels": (most_toxic_aggregates, plot_most_toxic_channels)}
+
+
+def category_figures(data):
+    '''
+    Defines a figure of the most toxic channels for every category. The channels are grouped once, so this stays fast for thousands of channels.
+
+    Args:
+        data (pd.DataFrame): dataframe with the results of the classifier
+
+    Returns:
+        figures (dict): dict from the name of every figure to its aggregates and plot function
+    '''
+
+    figures = {}
+
+    for category, group in data.groupby("categories"):
+        name = "categories/" + re.sub(r"[^a-z0-9]+", "-", str(category).lower()).strip("-")
+        figures[name] = (most_toxic_aggregates(group, average_name="Average (Category)").assign(categories=category), plot_category_channels)
+
+    return figures
+
+
+def define_figures(data, per_category=False):
+    '''
+    Calculates the aggregates of every figure in the registry.
+
+    Args:
+        data (pd.DataFrame): dataframe with the results of the classifier
+        per_category (bool): whether to also define a figure per category
+
+    Returns:
+        figures (dict): dict from the name of every figure to its aggregates and plot function
+    '''
+
+    figures = {name: (aggregate(data), plot) for name, (aggregate, plot) in FIGURES.items()}
+
+    if per_category:
+        figures.update(category_figures(data))
+
+    return figures
+
+
+def figure_hash(aggregates, plot, dpi):
+    '''
+    Hashes the content of a figure: its aggregates, its plot function, its resolution and the versions of matplotlib and seaborn.
+    The source of the whole module holding the plot function is hashed, so a change to any helper it calls (e.g. set_layout) renders the figure again.
+
+    Args:
+        aggregates (pd.DataFrame): dataframe shown in the figure
+        plot (function): function plotting the figure
+        dpi (int): resolution of the figure
+
+    Returns:
+        key (str): Hex digest of the figure
+    '''
+
+    return cache_key(aggregates.to_json(orient="split", double_precision=10), plot.__name__, inspect.getsource(inspect.getmodule(plot)),
+                     dpi, mpl.__version__, sns.__version__)
+
+
+def render_figure(plot, aggregates, file_path, dpi):
+    '''
+    Renders a single figure, run in a worker process.
+
+    Args:
+        plot (function): function plotting the figure
+        aggregates (pd.DataFrame): dataframe shown in the figure
+        file_path (pathlib.PosixPath): path to save the plot to
+        dpi (int): resolution of the plot
+    '''
+
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    plot(aggregates, file_path, dpi=dpi)
 
-    # set general layout
-    set_layout()
 
-    # plot share of toxic channels
-    plot_share_of_toxic(data, results_path)
+def main():
+    args = arg_parse()
 
-    # plot toxicity by category
-    plot_toxicity_by_category(data, results_path)
+    # define paths
+    results_path = define_paths()
 
-    # plot most toxic channels
-    plot_most_toxic_channels(data, results_path)
+    # load only the summary columns needed for the plots, from the summary table if there is one
+    _, _, summary_path = define_storage_paths()
+    columns = ["name", "categories", "n_toxic", "pct_toxic"]
+
+    if summary_path.exists():
+        data = read_table(summary_path, columns = columns)
+    else:
+        data = pd.read_csv(results_path / "top-youtubers-classified.csv", usecols = columns)
+
+    # calculate the aggregates of every figure
+    figures = define_figures(data, per_category = args.per_category)
+
+    # skip figures that are unchanged since their last render
+    hashes_file = define_cache_path("figures") / "hashes.json"
+    hashes = read_json_cache(hashes_file) or {}
+    new_hashes = {name: figure_hash(aggregates, plot, args.dpi) for name, (aggregates, plot) in figures.items()}
+    stale = [name for name in figures if args.force or hashes.get(name) != new_hashes[name] or not (results_path / f"{name}.png").exists()]
+
+    # render changed figures in parallel, remembering the hash of every figure that was rendered
+    n_failed = 0
+    if stale:
+        with ProcessPoolExecutor(max_workers = max(1, min(args.workers, len(stale))), initializer = set_layout) as executor:
+            futures = {name: executor.submit(render_figure, figures[name][1], figures[name][0], results_path / f"{name}.png", args.dpi) for name in stale}
+
+            for name, future in futures.items():
+                try:
+                    future.result()
+                    hashes[name] = new_hashes[name]
+                except Exception as e:
+                    print(f"Error rendering {name}: {e}")
+                    n_failed += 1
+
+        write_json_cache(hashes_file, hashes)
+
+    print(f"Rendered {len(stale)} figures, skipped {len(figures) - len(stale)} unchanged figures" + (f", {n_failed} failed" if n_failed else ""))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,586 @@
+""" worker.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Runs the SafeTuber pipeline from a durable job queue (see jobqueue.py) instead of one loop over all channels, so any number of
+    worker processes, on one host or on several hosts that share the repository folder, can work on the same run.
+
+    The queue holds two kinds of jobs:
+        - channel jobs list a channel and probe its candidate videos, and add a video job for each of the n_vids usable videos
+        - video jobs download, transcribe and clean a single video, and classify its chunks
+    Workers claim the oldest pending job, hold a lease on it with heartbeats, and hand it back on errors, so jobs of crashed workers
+    are picked up again once their lease expires. Chunks of every video are written to checkpoints like those of transcriber.py,
+    and their labels are stored as the result of the video job.
+
+    A final merge step writes the chunk table and the transcribed CSV, and when every chunk has a label also the classified table,
+    the per-channel summary and the classified CSV, so classifier.py is not needed (otherwise it classifies the remaining chunks).
+    The queue of a run configuration (model and number of videos) lives next to its checkpoints, in data/checkpoints/<run>-queue/jobs.sqlite,
+    apart from the checkpoints of transcriber.py, so clearing those (e.g. with transcriber.py --restart) never deletes the queue.
+
+Usage:
+    $ python src/worker.py --enqueue               <----- add a channel job for every channel in top-youtubers-raw.csv
+    $ python src/worker.py                         <----- start a worker (in as many processes and on as many hosts as wanted)
+    $ python src/worker.py --kinds channel         <----- start a worker that only lists and probes channels, e.g. without a GPU
+    $ python src/worker.py --status
+    $ python src/worker.py --merge
+"""
+
+from pathlib import Path
+from transcriber import define_paths, list_channel_videos, probe_candidates, probe_url, download_wav, stream_audio, transcribe_batch, transcribe_speech, chunk_texts, video_id_from_url, define_sampling, define_prober, transcript_settings, chunk_table
+from classifier import classify_batched, classify_cached, classified_export
+from jobqueue import define_job_queue, add_jobs, claim_job, keep_alive, finish_job, fail_job, retry_failed, queue_counts, read_jobs
+from checkpoints import define_checkpoint_path, save_video_checkpoint, save_channel_checkpoint, merge_checkpoints
+from cache import define_video_store, record_video, define_transcript_cache, transcript_cache_file, read_transcript, write_transcript, define_label_cache
+from storage import define_storage_paths, write_table, summarize_chunks
+from backends import build_transcriber, build_classifier, backend_model_name
+from metrics import define_metrics, count, time_stage, write_run_report, define_report_path
+from utils import clean_text
+import pandas as pd
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+
+def arg_parse():
+    """
+    Parse command line arguments to script.
+    It is possible to specify:
+    - Whether to add channel jobs, print the status of the queue, retry failed jobs or merge the results, instead of working
+    - The run configuration (number of videos and model), which decides the queue and checkpoints that are used
+    - The kinds of jobs the worker takes and its id
+    - How long jobs are leased for and how often they are attempted
+    - The models and backends, and whether to classify chunks
+    - The pipeline settings also found in transcriber.py
+
+    Returns:
+      args (argparse.Namespace): Parsed arguments.
+    """
+
+    # define parser
+    parser = argparse.ArgumentParser(description='Run the SafeTuber pipeline from a durable job queue shared by many workers')
+
+    # add arguments
+    parser.add_argument('--enqueue', action='store_true', help='Add a channel job for every channel in top-youtubers-raw.csv and exit')
+    parser.add_argument('--status', action='store_true', help='Print the number of jobs of every kind in every state and exit')
+    parser.add_argument('--retry_failed', action='store_true', help='Hand failed jobs back to the queue and exit')
+    parser.add_argument('--merge', action='store_true', help='Merge the results of all workers into the chunk tables and exit')
+    parser.add_argument('-n', '--n_vids', default=3, type=int, help='Number of videos to be analyzed per channel')
+    parser.add_argument('-m', '--model', default="openai/whisper-base.en", help='Model to be used for transcription')
+    parser.add_argument('-k', '--kinds', nargs='+', default=["channel", "video"], choices=["channel", "video"], help='Kinds of jobs the worker takes')
+    parser.add_argument('--worker_id', default=f"{socket.gethostname()}-{os.getpid()}", help='Id of the worker, unique across hosts (default: host name and process id)')
+    parser.add_argument('--lease_s', default=300, type=float, help='Seconds a job is leased for, after which the job of a crashed worker is handed out again')
+    parser.add_argument('--max_attempts', default=3, type=int, help='Max number of times a job is attempted before it fails')
+    parser.add_argument('--poll_s', default=10, type=float, help='Seconds to wait before looking for jobs again when none are pending')
+    parser.add_argument('--asr_backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the transcriber (check backends.py for more info)')
+    parser.add_argument('--classifier_backend', default="pytorch", choices=["pytorch", "int8", "onnx"], help='Inference backend of the classifier (check backends.py for more info)')
+    parser.add_argument('--no_classify', action='store_true', help='Do not classify chunks in the worker, leaving them to classifier.py')
+    parser.add_argument('--no_label_cache', action='store_true', help='Classify every chunk, also chunks with a cached label')
+    parser.add_argument('--batch_size', default=32, type=int, help='Number of chunks classified in one forward pass')
+    parser.add_argument('-b', '--asr_batch_size', default=1, type=int, help='Number of 30 second windows decoded in one forward pass')
+    parser.add_argument('-t', '--listing_ttl', default=6, type=float, help='Hours a cached channel listing is reused (0 to always list channels again)')
+    parser.add_argument('-c', '--transcript_cache_gb', default=2, type=float, help='Max size of the transcript cache in gigabytes (0 to disable it)')
+    parser.add_argument('-s', '--stream_audio', action='store_true', help='Stream audio into memory instead of writing .wav files to audio_files')
+    parser.add_argument('--vad', action='store_true', help='Only transcribe speech regions found by voice-activity detection (check vad.py for more info)')
+    parser.add_argument('--sample_windows', default=0, type=int, help='Number of windows spread across every video to download instead of the whole video (0 to download whole videos)')
+    parser.add_argument('--window_s', default=30, type=float, help='Length of every sampled window in seconds')
+    parser.add_argument('--probe_workers', default=4, type=int, help='Number of candidate videos of a channel probed at once')
+    parser.add_argument('--probe_rate', default=4, type=float, help='Max number of probes per second of this worker')
+    parser.add_argument('--probe_retries', default=3, type=int, help='Number of retries of a probe that failed with a transient error (e.g. a network blip)')
+    parser.add_argument('--metrics_path', default=None, help='Path to write the JSON run report to (default: out/metrics/worker-<worker id>-run.json)')
+    parser.add_argument('--prometheus', default=None, help='Path to write a Prometheus textfile to, e.g. for the node_exporter textfile collector')
+
+    # parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+def define_worker(worker_id, queue_path, checkpoint_path, audio_path, n_vids, loaders, listing_ttl=6*60*60, video_store=None, transcript_cache=None,
+                  label_cache=None, stream=False, vad=False, sampling=None, prober=None, asr_batch_size=1, batch_size=32, metrics=None):
+    """
+    Defines a worker with everything its jobs need. Models are only loaded once the first job that needs them is claimed,
+    so a worker that only takes channel jobs never loads a model.
+
+    Args:
+        worker_id (str): Id of the worker, unique across hosts
+        queue_path (pathlib.PosixPath): Path to the job queue
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+        audio_path (pathlib.PosixPath): Path to temporary audio storage
+        n_vids (int): Number of videos to be analyzed per channel
+        loaders (dict): Dict from "transcriber" and "classifier" to a function loading the model, None to not classify
+        listing_ttl (float): Max age of a cached channel listing in seconds
+        video_store (pathlib.PosixPath): Path to the store of probed videos, None to always probe
+        transcript_cache (dict): Transcript cache from define_transcript_cache, None to always download and transcribe
+        label_cache (dict): Label cache from define_label_cache, None to classify every chunk
+        stream (bool): Whether to stream audio into memory instead of downloading .wav files
+        vad (bool): Whether to only transcribe speech regions found by voice-activity detection
+        sampling (dict): Sampling from define_sampling, None to download whole videos
+        prober (dict): Prober from define_prober, None to probe one video ahead without rate limit or retries
+        asr_batch_size (int): Number of 30 second windows decoded in one forward pass
+        batch_size (int): Number of chunks classified in one forward pass
+        metrics (dict): Metrics from define_metrics, None to not collect metrics
+
+    Returns:
+        worker (dict): Dict with the settings, loaders and loaded models of the worker
+    """
+
+    return {"worker_id": worker_id,
+            "queue_path": queue_path,
+            "checkpoint_path": checkpoint_path,
+            "audio_path": audio_path,
+            "n_vids": n_vids,
+            "loaders": loaders,
+            "models": {},
+            "listing_ttl": listing_ttl,
+            "video_store": video_store,
+            "transcript_cache": transcript_cache,
+            "label_cache": label_cache,
+            "stream": stream,
+            "vad": vad,
+            "sampling": sampling,
+            "prober": prober,
+            "asr_batch_size": asr_batch_size,
+            "batch_size": batch_size,
+            "metrics": metrics}
+
+
+def worker_model(worker, name):
+    """
+    Gets a model of the worker, loading it on first use.
+
+    Args:
+        worker (dict): Worker from define_worker
+        name (str): "transcriber" or "classifier"
+
+    Returns:
+        model (pipeline): HuggingFace pipeline, None if the worker has no loader for it
+    """
+
+    if worker["loaders"].get(name) is None:
+        return None
+
+    if name not in worker["models"]:
+        with time_stage(worker["metrics"], "load_models"):
+            worker["models"][name] = worker["loaders"][name]()
+
+    return worker["models"][name]
+
+
+def enqueue_channels(queue_path, data):
+    """
+    Adds a channel job for every channel. Channels that are already in the queue are left as they are.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the job queue
+        data (pd.DataFrame): Dataframe with a channel_url column
+
+    Returns:
+        n_added (int): Number of channel jobs that were new
+    """
+
+    return add_jobs(queue_path, "channel", [(channel_url, {"channel_url": channel_url}) for channel_url in data["channel_url"]])
+
+
+def check_lease(job):
+    """
+    Stops a job between its stages once its lease was lost (see keep_alive), as the job is handed to another worker by then.
+
+    Args:
+        job (dict): Job from claim_job, held with keep_alive
+    """
+
+    if job.get("lost"):
+        raise RuntimeError(f"lost lease of {job['kind']} job")
+
+
+def select_videos(worker, channel_url):
+    """
+    Lists a channel and picks its n_vids most recent usable videos, probing candidates ahead like download_stage.
+    Unlike download_stage, videos are picked without being downloaded, so a video whose download fails later is not replaced.
+
+    Args:
+        worker (dict): Worker from define_worker
+        channel_url (str): URL of the YouTube channel
+
+    Returns:
+        video_urls (list): List of urls of the picked videos in listing order
+    """
+
+    metrics = worker["metrics"]
+
+    # get channel videos, errors are raised so the job is retried
+    with time_stage(metrics, "list"):
+        videos = list_channel_videos(channel_url, ttl=worker["listing_ttl"])
+    count(metrics, "videos_listed", len(videos))
+
+    # remember durations from the listing, so out of range videos (e.g. Shorts) are never probed
+    if worker["video_store"]:
+        for video in videos:
+            if video["duration"] is not None:
+                record_video(worker["video_store"], video["id"], duration=video["duration"])
+
+    # videos with a cached transcript need no probe
+    transcript_cache = worker["transcript_cache"]
+    def needs_probe(url):
+        return not (transcript_cache and transcript_cache_file(transcript_cache, video_id_from_url(url)).exists())
+
+    video_urls = []
+    candidates = probe_candidates([video["url"] for video in videos], worker["prober"], worker["video_store"], metrics, worker["sampling"], needs_probe)
+    try:
+        while len(video_urls) < worker["n_vids"]:
+            url, _ = next(candidates, (None, None))
+            if url is None:
+                break
+            video_urls.append(url)
+    finally:
+        candidates.close()
+
+    return video_urls
+
+
+def run_channel_job(worker, job):
+    """
+    Runs a channel job: picks the videos of the channel and adds a video job for each of them.
+
+    Args:
+        worker (dict): Worker from define_worker
+        job (dict): Channel job from claim_job
+
+    Returns:
+        result (dict): Dict with the urls of the picked videos
+    """
+
+    channel_url = job["payload"]["channel_url"]
+    video_urls = select_videos(worker, channel_url)
+    check_lease(job)
+
+    # video jobs are added before the channel job is done, adding them twice (e.g. after a lost lease) does nothing
+    add_jobs(worker["queue_path"], "video", [(f"{channel_url} {url}", {"channel_url": channel_url, "url": url}) for url in video_urls])
+
+    return {"video_urls": video_urls}
+
+
+def transcribe_video(worker, url, job=None):
+    """
+    Downloads (or streams) and transcribes a single video, using its cached transcript if there is one.
+    The video is probed again behind the rate limit of the worker, with the same duration limits as in the channel job,
+    and the info dict of the probe is used for the download.
+
+    Args:
+        worker (dict): Worker from define_worker
+        url (str): URL of the video
+        job (dict): Video job from claim_job, checked for a lost lease between stages, None to not check
+
+    Returns:
+        all_chunks (list): List with the timestamped chunks of every audio file of the video, None if the video can't be used
+    """
+
+    metrics = worker["metrics"]
+    transcript_cache = worker["transcript_cache"]
+
+    # videos with a cached transcript need neither download nor transcription
+    all_chunks = read_transcript(transcript_cache, video_id_from_url(url)) if transcript_cache else None
+    if all_chunks is not None:
+        count(metrics, "videos_cached")
+        return all_chunks
+
+    # probe video behind the rate limit (and with the retries) of the worker
+    info_dict = probe_url(url, worker["prober"], worker["video_store"], metrics, worker["sampling"])
+    if info_dict is None:
+        return None
+
+    if job is not None:
+        check_lease(job)
+
+    transcriber = worker_model(worker, "transcriber")
+    video_path = None
+
+    try:
+        # stream audio into memory, or download it to its own temporary folder
+        with time_stage(metrics, "download"):
+            if worker["stream"]:
+                audio = stream_audio(url, video_store=worker["video_store"], metrics=metrics, sampling=worker["sampling"], info_dict=info_dict)
+                inputs = [{"raw": audio, "sampling_rate": 16000}] if audio is not None else []
+            else:
+                video_path = Path(tempfile.mkdtemp(dir=worker["audio_path"]))
+                success_fail = download_wav(video_path, url, video_store=worker["video_store"], metrics=metrics, sampling=worker["sampling"], info_dict=info_dict)
+                inputs = [video_path / audio_file for audio_file in os.listdir(video_path)] if success_fail == 1 else []
+
+        # video can't be used
+        if not inputs:
+            return None
+        count(metrics, "videos_downloaded")
+
+        if job is not None:
+            check_lease(job)
+
+        # transcribe the audio
+        with time_stage(metrics, "transcribe"):
+            if worker["vad"]:
+                all_chunks, total_seconds, transcribed_seconds = transcribe_speech(inputs, transcriber, batch_size = worker["asr_batch_size"])
+                count(metrics, "audio_seconds", total_seconds)
+                count(metrics, "speech_seconds", transcribed_seconds)
+            else:
+                all_chunks = transcribe_batch(inputs, transcriber, batch_size = worker["asr_batch_size"])
+        count(metrics, "videos_transcribed")
+    finally:
+        if video_path is not None:
+            shutil.rmtree(video_path, ignore_errors=True)
+
+    # cache raw timestamped transcript of the video
+    if transcript_cache:
+        write_transcript(transcript_cache, video_id_from_url(url), all_chunks)
+
+    return all_chunks
+
+
+def run_video_job(worker, job):
+    """
+    Runs a video job: transcribes and cleans the video, commits its chunks to the checkpoints of the run and classifies them.
+
+    Args:
+        worker (dict): Worker from define_worker
+        job (dict): Video job from claim_job
+
+    Returns:
+        result (dict): Dict with the number of chunks and their labels (None if the worker does not classify), None if the video can't be used
+    """
+
+    metrics = worker["metrics"]
+    channel_url, url = job["payload"]["channel_url"], job["payload"]["url"]
+
+    all_chunks = transcribe_video(worker, url, job)
+    if all_chunks is None:
+        return None
+    check_lease(job)
+
+    # clean transcript of every file
+    with time_stage(metrics, "clean"):
+        text_chunks = [text_chunk for chunks in all_chunks for text_chunk in clean_text(chunk_texts(chunks))]
+    count(metrics, "chunks_clean", len(text_chunks))
+
+    # commit chunks to disk, writing the same checkpoint twice (e.g. after a lost lease) gives the same file
+    save_video_checkpoint(worker["checkpoint_path"], channel_url, url, text_chunks)
+    check_lease(job)
+
+    # classify chunks
+    classifier = worker_model(worker, "classifier")
+    labels = None
+    if classifier is not None:
+        with time_stage(metrics, "classify"):
+            if worker["label_cache"] is not None:
+                labels = classify_cached(text_chunks, classifier, worker["label_cache"], batch_size = worker["batch_size"])
+            else:
+                labels = classify_batched(text_chunks, classifier, batch_size = worker["batch_size"])
+        count(metrics, "chunks_classified", len(text_chunks))
+
+    return {"n_chunks": len(text_chunks), "labels": labels}
+
+
+def work(worker, kinds, lease_s=300, max_attempts=3, poll_s=10):
+    """
+    Claims and runs jobs until no job is pending or running anymore that this worker could take, now or later.
+    A job is held with heartbeats while it runs, and handed back to the queue if it fails, or if the worker is stopped.
+    A job whose lease was lost is stopped at its next stage and left to the worker that holds it now.
+
+    Args:
+        worker (dict): Worker from define_worker
+        kinds (list): List of kinds of jobs the worker takes
+        lease_s (float): Seconds a job is leased for
+        max_attempts (int): Max number of times a job is attempted before it fails
+        poll_s (float): Seconds to wait before looking for jobs again when none are pending
+
+    Returns:
+        n_jobs (int): Number of jobs the worker finished
+    """
+
+    queue_path, metrics = worker["queue_path"], worker["metrics"]
+    run_job = {"channel": run_channel_job, "video": run_video_job}
+    n_jobs = 0
+
+    while True:
+        job = claim_job(queue_path, worker["worker_id"], kinds, lease_s, max_attempts)
+
+        if job is None:
+            # running channel jobs still add video jobs, so a worker taking video jobs waits for them
+            counts = queue_counts(queue_path)
+            active = sum(n_jobs_state for kind, states in counts.items() for state, n_jobs_state in states.items()
+                         if state in ("pending", "running") and (kind in kinds or kind == "channel"))
+            if active == 0:
+                return n_jobs
+
+            time.sleep(poll_s)
+            continue
+
+        with keep_alive(queue_path, job, lease_s):
+            try:
+                result = run_job[job["kind"]](worker, job)
+            except KeyboardInterrupt:
+                # hand the job back right away instead of waiting for its lease to expire
+                fail_job(queue_path, job, "worker stopped", max_attempts + 1)
+                raise
+            except Exception as e:
+                if job["lost"]:
+                    print(f"Lost lease of {job['kind']} job, stopped it as another worker does it again")
+                    count(metrics, "jobs_lost")
+                    continue
+
+                print(f"Error in {job['kind']} job (attempt {job['attempts']}): {type(e).__name__}: {e}")
+                fail_job(queue_path, job, f"{type(e).__name__}: {e}", max_attempts)
+                count(metrics, "jobs_failed")
+                continue
+
+        # videos that can't be used will not become usable when retried
+        if result is None:
+            fail_job(queue_path, job, "video can't be used", max_attempts, retry=False)
+            count(metrics, "jobs_failed")
+        elif finish_job(queue_path, job, result):
+            count(metrics, f"{job['kind']}_jobs_done")
+            n_jobs += 1
+        else:
+            print(f"Lost lease of {job['kind']} job, another worker records its result")
+            count(metrics, "jobs_lost")
+
+
+def print_status(counts):
+    """
+    Prints the number of jobs of every kind in every state.
+
+    Args:
+        counts (dict): Counts from queue_counts
+    """
+
+    for kind in ["channel", "video"]:
+        states = counts.get(kind, {})
+        print(f"{kind} jobs: " + ", ".join(f"{states.get(state, 0)} {state}" for state in ["pending", "running", "done", "failed"]))
+
+
+def merge_results(queue_path, data, checkpoint_path):
+    """
+    Merges the results of all workers into a table of chunks with one row per chunk.
+    A channel is complete once its channel job is done and each of its video jobs is done or failed. Complete channels are
+    marked in the checkpoints with the videos that were done, so merge_checkpoints sees them too.
+    Chunks get the labels stored by the video jobs, and channels that are not complete are left out.
+
+    Args:
+        queue_path (pathlib.PosixPath): Path to the job queue
+        data (pd.DataFrame): Dataframe with name and channel_url columns
+        checkpoint_path (pathlib.PosixPath): Path to the checkpoints of the run
+
+    Returns:
+        chunks (pd.DataFrame): Table of chunks, with labels where the video jobs classified them
+        n_complete (int): Number of complete channels
+    """
+
+    # find video jobs and their labels
+    video_jobs = {(job["payload"]["channel_url"], job["payload"]["url"]): job for job in read_jobs(queue_path, "video")}
+
+    labels = {}
+    n_complete = 0
+    for channel_job in read_jobs(queue_path, "channel", states=["done"]):
+        channel_url = channel_job["payload"]["channel_url"]
+        jobs = [video_jobs.get((channel_url, url)) for url in channel_job["result"]["video_urls"]]
+
+        # skip channels with videos that are not done yet
+        if any(job is None or job["state"] not in ("done", "failed") for job in jobs):
+            continue
+
+        # mark channel as complete with the videos that were done
+        used_jobs = [job for job in jobs if job["state"] == "done"]
+        save_channel_checkpoint(checkpoint_path, channel_url, [job["payload"]["url"] for job in used_jobs])
+        n_complete += 1
+
+        for job in used_jobs:
+            labels[(channel_url, video_id_from_url(job["payload"]["url"]))] = job["result"]["labels"]
+
+    # one row per chunk of every complete channel, with the label of the chunk if it was classified
+    chunks = chunk_table(data, checkpoint_path)
+    video_labels = [labels.get((channel_url, video_id)) for channel_url, video_id in zip(chunks["channel_url"], chunks["video_id"])]
+    chunks["label"] = pd.Series([video_label[chunk_index] if video_label is not None and chunk_index < len(video_label) else None
+                                 for video_label, chunk_index in zip(video_labels, chunks["chunk_index"])], index = chunks.index, dtype = "string")
+
+    return chunks, n_complete
+
+
+def main():
+    args = arg_parse()
+
+    # define paths
+    inpath, outpath, audio_path = define_paths()
+    chunks_path, classified_path, summary_path = define_storage_paths()
+
+    # the queue lives next to the checkpoints of the run configuration, which all workers share, apart from transcriber.py's checkpoints
+    checkpoint_path = define_checkpoint_path(args.model, args.n_vids, queue = True)
+    queue_path = define_job_queue(checkpoint_path / "jobs.sqlite")
+
+    if args.enqueue:
+        data = pd.read_csv(inpath)
+        print(f"Added {enqueue_channels(queue_path, data)} channel jobs ({len(data)} channels)")
+        return
+
+    if args.retry_failed:
+        print(f"Handed {retry_failed(queue_path)} failed jobs back to the queue")
+        return
+
+    if args.status:
+        print_status(queue_counts(queue_path))
+        return
+
+    if args.merge:
+        data = pd.read_csv(inpath)
+        print("Merging results of all workers...")
+        chunks, n_complete = merge_results(queue_path, data, checkpoint_path)
+        print(f"{n_complete} of {len(data)} channels are complete")
+
+        # save chunk table and dataframe to outpath as export format
+        write_table(chunks, chunks_path)
+        merge_checkpoints(data.copy(), checkpoint_path).to_csv(outpath / "top-youtubers-transcribed.csv")
+
+        # chunks classified by the workers go straight to the classified table, otherwise classifier.py classifies the rest
+        n_unlabeled = int(chunks["label"].isna().sum())
+        if n_unlabeled:
+            print(f"{n_unlabeled} chunks have no label, run classifier.py to classify them")
+            return
+
+        write_table(chunks, classified_path)
+        write_table(summarize_chunks(chunks, data), summary_path)
+        classified_export(chunks, data).to_csv(classified_path.parent / "top-youtubers-classified.csv", index = False)
+        print(f"Saved {len(chunks)} classified chunks")
+        return
+
+    # collect per-stage metrics of the worker
+    metrics = define_metrics("worker")
+
+    # define how videos are sampled, and probe candidate videos concurrently behind one rate limit for the worker
+    sampling = define_sampling(args.sample_windows, args.window_s)
+    prober = define_prober(args.probe_workers, args.probe_rate, retries = args.probe_retries)
+
+    # models are loaded once the first video job is claimed
+    classifier_model = "martin-ha/toxic-comment-model"
+    loaders = {"transcriber": lambda: build_transcriber(args.model, backend = args.asr_backend),
+               "classifier": None if args.no_classify else lambda: build_classifier(classifier_model, backend = args.classifier_backend)}
+
+    # cache raw transcripts and labels like transcriber.py and classifier.py
+    transcript_cache = define_transcript_cache(backend_model_name(args.model, args.asr_backend), transcript_settings(args.vad, sampling), max_gb = args.transcript_cache_gb) if args.transcript_cache_gb > 0 else None
+    label_cache = None if args.no_label_cache or args.no_classify else define_label_cache(backend_model_name(classifier_model, args.classifier_backend))
+
+    worker = define_worker(args.worker_id, queue_path, checkpoint_path, audio_path, args.n_vids, loaders, listing_ttl = args.listing_ttl*60*60,
+                           video_store = define_video_store(), transcript_cache = transcript_cache, label_cache = label_cache, stream = args.stream_audio,
+                           vad = args.vad, sampling = sampling, prober = prober, asr_batch_size = args.asr_batch_size, batch_size = args.batch_size, metrics = metrics)
+
+    print(f"Worker {args.worker_id} taking {' and '.join(args.kinds)} jobs...")
+    with time_stage(metrics, "work"):
+        n_jobs = work(worker, args.kinds, lease_s = args.lease_s, max_attempts = args.max_attempts, poll_s = args.poll_s)
+    print(f"Worker {args.worker_id} finished {n_jobs} jobs, no jobs are left")
+    print_status(queue_counts(queue_path))
+
+    # write run report per worker, so workers on the same run don't overwrite each other's reports
+    write_run_report(metrics, args.metrics_path or define_report_path(f"worker-{args.worker_id}"), args.prometheus)
+
+
+if __name__ == "__main__":
+    main()
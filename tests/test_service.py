@@ -0,0 +1,88 @@
+""" test_service.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    End-to-end test of the scoring service on localhost: the service is started in --offline mode (a fake downloader serving
+    a synthetic catalog, see benchmark.py, and tiny randomly initialised models) on a free port, a channel job is submitted over
+    HTTP and its classified result is checked.
+
+Usage:
+    $ python -m pytest tests
+"""
+
+from pathlib import Path
+import json
+import shutil
+import sys
+import time
+import urllib.error
+import urllib.request
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("yt_dlp")
+
+# the pipeline reads the downloaded audio with ffmpeg
+if shutil.which("ffmpeg") is None:
+    pytest.skip("ffmpeg is not installed", allow_module_level=True)
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from service import arg_parse, load_service, start_service, stop_service
+from benchmark import FakeYoutubeDL
+
+
+def request_json(url, body=None):
+    """
+    Sends a GET request, or a POST request if a body is given, and decodes the JSON response.
+    """
+
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=30) as response:
+        return response.status, json.loads(response.read())
+
+
+@pytest.fixture(scope="module")
+def service_url():
+    # port 0 lets the OS pick a free port
+    args = arg_parse(["--offline", "--port", "0", "--workers", "1"])
+    service = load_service(args)
+    server = start_service(service, args.host, args.port, args.workers)
+
+    yield f"http://{args.host}:{server.server_address[1]}"
+
+    stop_service(service, server)
+
+
+def test_channel_job(service_url):
+    channel_url = list(FakeYoutubeDL.catalog["channels"])[0]
+
+    status, job = request_json(f"{service_url}/jobs", {"url": channel_url, "n_vids": 2})
+    assert status == 202
+    assert job["status"] == "queued"
+
+    # wait for the job to finish
+    deadline = time.time() + 300
+    while job["status"] in ("queued", "running") and time.time() < deadline:
+        time.sleep(0.5)
+        _, job = request_json(f"{service_url}/jobs/{job['job_id']}")
+    assert job["status"] == "done", job.get("error")
+
+    status, body = request_json(f"{service_url}/jobs/{job['job_id']}/result")
+    result = body["result"]
+    assert status == 200
+    assert len(result["video_urls"]) == 2
+    assert 0 <= result["n_toxic"] <= result["n_comments"]
+    assert result["pct_toxic"] == (round(result["n_toxic"] / result["n_comments"], 4) if result["n_comments"] else 0)
+
+    _, health = request_json(f"{service_url}/health")
+    assert health["jobs"] == {"done": 1}
+
+
+def test_invalid_job(service_url):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        request_json(f"{service_url}/jobs", {"url": "https://www.youtube.com/@someone", "audio": "some.wav"})
+
+    assert error.value.code == 400
@@ -0,0 +1,52 @@
+""" test_transcriber.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Regression tests for audio in memory in transcriber.py: the HuggingFace ASR pipeline pops "raw" and "sampling_rate" from
+    dict inputs, so transcribe_batch must hand it copies, and the inputs must still be readable afterwards (e.g. by audio_seconds
+    when --stream_audio is used without --vad).
+
+Usage:
+    $ python -m pytest tests
+"""
+
+from pathlib import Path
+import sys
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("yt_dlp")
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from transcriber import transcribe_batch, audio_seconds
+
+
+class PoppingPipeline:
+    """
+    Stub of the ASR pipeline that consumes its dict inputs like transformers 4.28.1 does in preprocess.
+    """
+
+    def __call__(self, inputs, batch_size=1, max_new_tokens=448):
+        outputs = []
+        for audio in inputs:
+            raw, sampling_rate = audio.pop("raw"), audio.pop("sampling_rate")
+            outputs.append({"chunks": [{"timestamp": (0.0, len(raw) / sampling_rate), "text": "hello"}]})
+
+        return outputs
+
+
+def test_transcribe_batch_keeps_inputs():
+    inputs = [{"raw": np.zeros(16000 * 3, dtype=np.float32), "sampling_rate": 16000},
+              {"raw": np.zeros(16000 * 2, dtype=np.float32), "sampling_rate": 16000}]
+
+    all_chunks = transcribe_batch(inputs, PoppingPipeline(), batch_size=2)
+
+    assert [chunks[0]["timestamp"] for chunks in all_chunks] == [(0.0, 3.0), (0.0, 2.0)]
+    assert sum(audio_seconds(audio) for audio in inputs) == 5.0
+
+
+def test_transcribe_batch_without_inputs():
+    assert transcribe_batch([], PoppingPipeline()) == []
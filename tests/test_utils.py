@@ -0,0 +1,105 @@
+""" test_utils.py
+Author:
+    Anton Drasbæk Schiønning (202008161), GitHub: @drasbaek
+
+Desc:
+    Property tests for the single-pass clean_text in utils.py: on random transcripts, it must give exactly the same output as
+    the three cleaning passes applied one after another. Transcripts are generated around the edges of the cleaning rules,
+    i.e. empty strings, repeated chunks, chunks around 10 and 25 words and chunks around and beyond 512 characters.
+
+Usage:
+    $ python -m pytest tests
+"""
+
+from pathlib import Path
+import random
+import sys
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from utils import remove_long_chunks, remove_duplicates, concatenate_chunks, clean_text, clean_texts
+
+
+WORDS = ["the", "video", "is", "great", "guys", "subscribe", "okay", "so", "like", "what", "why", "no", "yes", "bro"]
+
+
+def three_pass_clean(text_chunks):
+    """
+    Cleans text chunks with the three cleaning passes one after another, the reference for clean_text.
+    """
+
+    return concatenate_chunks(remove_duplicates(remove_long_chunks(text_chunks)))
+
+
+def random_chunk(rng):
+    """
+    Generates a chunk with a length close to one of the edges of the cleaning rules.
+    """
+
+    kind = rng.choice(["empty", "words", "words", "words", "long", "long_no_punctuation", "exact_512", "space"])
+
+    if kind == "empty":
+        return ""
+
+    if kind == "space":
+        return " "
+
+    # long chunks, cut at 512 characters and shortened to the last period or question mark (if there is one)
+    if kind in ("long", "long_no_punctuation"):
+        text = " ".join(rng.choice(WORDS) + ("" if kind == "long_no_punctuation" else rng.choice(["", "", ".", "?"])) for _ in range(rng.randint(80, 200)))
+        return text
+
+    if kind == "exact_512":
+        text = ("a " * 256)[:rng.choice([511, 512, 513])]
+        return text[:-1] + rng.choice([".", "?", "a"])
+
+    # chunks around 10 and 25 words, ending in a period, a question mark or nothing
+    n_words = rng.choice([0, 1, 5, 9, 10, 11, 24, 25, 26, 30])
+    text = " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+    return text + rng.choice(["", ".", ".", "?", " ", ","])
+
+
+def random_transcript(rng):
+    """
+    Generates a transcript of random chunks, where chunks are often repeated back to back like in Whisper transcripts.
+    """
+
+    text_chunks = []
+    for _ in range(rng.randint(0, 60)):
+        if text_chunks and rng.random() < 0.25:
+            text_chunks.append(text_chunks[-1])
+        else:
+            text_chunks.append(random_chunk(rng))
+
+    return text_chunks
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_clean_text_matches_three_passes(seed):
+    text_chunks = random_transcript(random.Random(seed))
+
+    assert clean_text(text_chunks) == three_pass_clean(text_chunks)
+
+
+def test_clean_text_edge_cases():
+    cases = [[], [""], ["", ""], [" "], ["one."], ["a " * 300], ["word " * 10 + "."] * 3,
+             ["short", "short", "also short."], ["x" * 600], ["x" * 511 + "."], ["x" * 512 + "."]]
+
+    for text_chunks in cases:
+        assert clean_text(text_chunks) == three_pass_clean(text_chunks)
+
+
+def test_clean_text_consumes_iterators():
+    text_chunks = random_transcript(random.Random(1))
+
+    assert clean_text(iter(text_chunks)) == three_pass_clean(text_chunks)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_clean_texts_matches_three_passes(processes):
+    rng = random.Random(processes)
+    transcripts = [random_transcript(rng) for _ in range(40)]
+
+    assert clean_texts(transcripts, processes = processes) == [three_pass_clean(text_chunks) for text_chunks in transcripts]